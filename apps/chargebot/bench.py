@@ -0,0 +1,316 @@
+"""
+Benchmarks for the planner and load balancer hot paths.
+
+Runs create_a_charge_plan, get_continues_timespan and the load balancer on
+synthetic nordpool payloads (hourly and 15 minute slots, 1-7 days) and long
+power traces using the ReplayChargebot from replay.py, so no ha is needed.
+
+Every run is appended to a jsonl file together with a label (git describe by
+default) so regressions between versions is easy to spot. The default file is
+bench_results.jsonl in the root of the repo (two levels up from this file) so
+it isn't in the apps directory appdaemon loads:
+
+    python bench.py                   # run everything and store the result
+    python bench.py --filter plan     # only the benchmarks with plan in the name
+    python bench.py --compare         # compare the last two stored runs
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+# replay has to be imported first, it makes sure appdaemon can be found.
+from replay import ReplayChargebot
+from chargebot_core import get_continues_timespan
+
+PRICE_ENTITY = "sensor.nordpool_kwh_bench"
+STATUS_ENTITY = "sensor.easee_bench_status"
+
+ARGS = {
+    "load_balance": "input_boolean.bench_load_balance",
+    "smart_charging": "input_boolean.bench_smart_charging",
+    "power_usage_in_w": "sensor.bench_power",
+    "power_price_entity": PRICE_ENTITY,
+    "charger_ready_at": "input_datetime.bench_ready_at",
+    "car_battery_sensor_entity": "sensor.bench_soc",
+    "car_battery_size_kwh": 72.5,
+    "car_onboard_charger_kwh": 11.0,
+    "main_fuse": 63.0,
+    "volt": 230.0,
+    "phase": 3.0,
+    "notify": False,
+    "verify_car_connected_and_home": False,
+}
+
+START = datetime(2024, 1, 8, tzinfo=timezone(timedelta(hours=1)))
+
+# apps/chargebot/bench.py -> the root of the repo.
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+RESULTS_FILE = os.path.join(ROOT, "bench_results.jsonl")
+
+
+def nordpool_payload(days, slot_minutes=60, seed=1):
+    """Create raw_today and raw_tomorrow like the nordpool integration does,
+    everything after the first day ends up in raw_tomorrow."""
+    rnd = random.Random(seed)
+    fmt = "%Y-%m-%dT%H:%M:%S%z"
+    slot = timedelta(minutes=slot_minutes)
+    slots = []
+    start = START
+    for i in range(days * 24 * 60 // slot_minutes):
+        hour = start.hour
+        value = 0.8 + 0.4 * rnd.random() + (0.9 if 7 <= hour <= 20 else 0.0)
+        slots.append(
+            {
+                "start": start.strftime(fmt),
+                "end": (start + slot).strftime(fmt),
+                "value": round(value, 4),
+            }
+        )
+        start += slot
+
+    per_day = 24 * 60 // slot_minutes
+    return {
+        "raw_today": slots[:per_day],
+        "raw_tomorrow": slots[per_day:],
+        "currency": "NOK",
+    }
+
+
+def power_trace(samples, seed=1):
+    """House usage in watt sampled once a second with a few big loads."""
+    rnd = random.Random(seed)
+    amps = 20.0
+    trace = []
+    for i in range(samples):
+        amps = min(max(amps + rnd.gauss(0, 0.5), 5.0), 45.0)
+        spike = 20.0 if i % 1800 < 120 else 0.0
+        trace.append((amps + spike) * 398.37)
+    return trace
+
+
+def create_app(days=1, slot_minutes=60, **args):
+    """A ReplayChargebot that is initialized and ready to plan and balance."""
+    app = ReplayChargebot(dict(ARGS, **args))
+    app.now = START.timestamp()
+    ready_at = START + timedelta(days=days) - timedelta(minutes=1)
+    states = {
+        STATUS_ENTITY: ("CHARGING", {"id": "EHBENCH", "circuit_id": 1}),
+        "sensor.easee_bench_in_current": ("16.0", {}),
+        "sensor.easee_bench_dynamic_circuit_current": ("16.0", {}),
+        "sensor.easee_bench_max_circuit_current": ("32.0", {}),
+        ARGS["load_balance"]: ("on", {}),
+        ARGS["smart_charging"]: ("on", {}),
+        ARGS["charger_ready_at"]: (ready_at.strftime("%Y-%m-%d %H:%M:%S"), {}),
+        ARGS["car_battery_sensor_entity"]: ("20", {}),
+        ARGS["power_usage_in_w"]: ("8000", {}),
+        PRICE_ENTITY: ("1.0", nordpool_payload(days, slot_minutes)),
+    }
+    for entity, (state, attributes) in states.items():
+        app.set_state(entity, state=state, attributes=attributes)
+    app.initialize()
+    return app
+
+
+def measure(func, number):
+    """Return the time per call for number calls."""
+    gc.collect()
+    started = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - started) / number
+
+
+def measure_allocations(func):
+    """Peak and retained memory allocated by one call in bytes."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak, current
+
+
+def bench(name, func, number=10, repeat=5, items=1):
+    """Run func number times repeat times and collect the stats.
+
+    items is how many units of work one call is, used for the throughput.
+    """
+    func()
+    timings = sorted(measure(func, number) for _ in range(repeat))
+    peak, retained = measure_allocations(func)
+    best = timings[0]
+    return {
+        "name": name,
+        "best_ms": best * 1000,
+        "median_ms": statistics.median(timings) * 1000,
+        "worst_ms": timings[-1] * 1000,
+        "alloc_peak_kb": peak / 1024,
+        "alloc_retained_kb": retained / 1024,
+        "throughput_per_s": items / best if best else 0.0,
+    }
+
+
+# Each benchmark yields (name, func, kwargs to bench)
+
+
+def bench_plan():
+    for slot_minutes in (60, 15):
+        for days in (1, 2, 7):
+            app = create_app(days=days, slot_minutes=slot_minutes)
+            yield (
+                "create_a_charge_plan[%smin-%sd]" % (slot_minutes, days),
+                app.create_a_charge_plan,
+                {"number": 5},
+            )
+
+
+def bench_timespan():
+    for slot_minutes in (60, 15):
+        for days in (1, 7):
+            payload = nordpool_payload(days, slot_minutes)
+            slots = []
+            for i in payload["raw_today"] + payload["raw_tomorrow"]:
+                start = datetime.fromisoformat(i["start"])
+                end = datetime.fromisoformat(i["end"])
+                slots.append({"start": start, "end": end, "value": i["value"]})
+            # Every other cheap slot so there is something to merge.
+            picked = sorted(slots, key=lambda x: x["value"])[: len(slots) // 2]
+            yield (
+                "get_continues_timespan[%smin-%sd]" % (slot_minutes, days),
+                lambda picked=picked: get_continues_timespan(picked),
+                {"number": 20, "items": len(picked)},
+            )
+
+
+def bench_load_balance():
+    for samples in (10000, 100000):
+        trace = power_trace(samples)
+        app = create_app()
+
+        def refresh_charger():
+            # Like the easee integration polling the charger.
+            if app.now % 60 == 0:
+                app.set_state("sensor.easee_bench_in_current", state="16.0")
+
+        def check_load():
+            for value in trace:
+                app.now += 1
+                refresh_charger()
+                app.check_load(value)
+
+        def load_balance():
+            for value in trace:
+                app.now += 1
+                refresh_charger()
+                app.load_balance_cb(ARGS["power_usage_in_w"], None, None, value, {})
+                if app.now % app.load_balance_tick_interval == 0:
+                    app.load_balance_tick({})
+
+        options = {"number": 1, "repeat": 3, "items": samples}
+        yield "check_load[%s]" % samples, check_load, options
+        yield "load_balance_cb+tick[%s]" % samples, load_balance, options
+
+
+BENCHMARKS = [bench_plan, bench_timespan, bench_load_balance]
+
+
+def git_label():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "describe", "--always", "--dirty"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def load_runs(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(runs):
+    """Print the change from the second last run to the last run."""
+    if len(runs) < 2:
+        print("Need at least two runs to compare")
+        return
+    old, new = runs[-2], runs[-1]
+    old_results = {r["name"]: r for r in old["results"]}
+    print("%s -> %s" % (old["label"], new["label"]))
+    for result in new["results"]:
+        prev = old_results.get(result["name"])
+        if prev is None:
+            print("%-40s %10.3fms (new)" % (result["name"], result["best_ms"]))
+            continue
+        change = (result["best_ms"] - prev["best_ms"]) / prev["best_ms"] * 100
+        print(
+            "%-40s %10.3fms %10.3fms %+7.1f%%"
+            % (result["name"], prev["best_ms"], result["best_ms"], change)
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark chargebot.")
+    parser.add_argument("--filter", help="only run benchmarks with this in the name")
+    parser.add_argument("--label", help="label for the run, default git describe")
+    parser.add_argument(
+        "--output",
+        default=RESULTS_FILE,
+        help="jsonl file the results are appended to, default %s" % RESULTS_FILE,
+    )
+    parser.add_argument("--compare", action="store_true", help="compare the last two runs")
+    parser.add_argument("--no-store", action="store_true", help="don't store the results")
+    options = parser.parse_args(argv)
+
+    if options.compare:
+        compare(load_runs(options.output))
+        return
+
+    results = []
+    for benchmark in BENCHMARKS:
+        for name, func, kwargs in benchmark():
+            if options.filter and options.filter not in name:
+                continue
+            result = bench(name, func, **kwargs)
+            results.append(result)
+            print(
+                "%-40s %10.3fms %10.3fms %10.1fKiB %12.0f/s"
+                % (
+                    result["name"],
+                    result["best_ms"],
+                    result["median_ms"],
+                    result["alloc_peak_kb"],
+                    result["throughput_per_s"],
+                )
+            )
+
+    if not options.no_store:
+        run = {
+            "label": options.label or git_label(),
+            "date": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "results": results,
+        }
+        with open(options.output, "a") as f:
+            f.write(json.dumps(run) + "\n")
+
+
+if __name__ == "__main__":
+    main()
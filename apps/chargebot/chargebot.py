@@ -1,12 +1,52 @@
+import asyncio
+import inspect
+import json
 import math
+import os
 import re
-import statistics
+import threading
+import zlib
+from bisect import bisect_right
 from datetime import datetime, timedelta
+from functools import wraps
 from operator import itemgetter
+from time import perf_counter
 
 import hassapi as hass
 from adbase import app_lock
 
+from chargebot_core import (
+    PRIORITY_CONTROL,
+    PRIORITY_PROTECT,
+    TRACE_BALANCE,
+    TRACE_CHANGED,
+    TRACE_PAUSED,
+    TRACE_PHASES,
+    TRACE_PLAN,
+    BalancedCharger,
+    ChargeCurve,
+    ChargePlanner,
+    CommandQueue,
+    DecisionTrace,
+    LoadForecast,
+    LoadProfile,
+    Metrics,
+    PIController,
+    PeakTracker,
+    PowerSampler,
+    PriceSeries,
+    StateMirror,
+    StepController,
+    Vehicle,
+    calibrate_charge_curve,
+    compare_controllers,
+    discover_entities,
+    get_continues_timespan,
+    parse_timestamp,
+    plan_vehicles,
+    split_headroom,
+)
+
 
 """
 EaseeChargebot
@@ -49,19 +89,183 @@ charge_bot:
   volt: 230.0, reqiored
   # float, required
   phase: 3.0
+  # Optional, seconds without a new value from a load_balance_phase_sensors
+  # before it is treated as stale and the load balancer falls back to safe
+  # values. The charger sensors can keep the same value for hours, they are
+  # only treated as stale when ha reports them as unavailable or unknown.
+  state_max_age: 600
+  # Optional, seconds between each load balance decision, 0 balances on every sample.
+  load_balance_tick: 5
+  # Optional, what sample in the window to balance on. max, last or ewma
+  load_balance_sample: max
+  load_balance_ewma_alpha: 0.3
+  # Optional, if the power usage sensor hasn't been updated in power_usage_max_age
+  # seconds the charger is lowered to load_balance_fallback_amps.
+  power_usage_max_age: 60
+  load_balance_fallback_amps: 6
+  # Optional, step (default) jumps straight to the available amps, pi ramps up
+  # slowly using a pi controller, reductions are always done at once.
+  load_balance_mode: step
+  # Optional, pi tuning. slew_up is max increase in A/s and changes
+  # smaller then the deadband (A) is ignored.
+  load_balance_kp: 0.5
+  load_balance_ki: 0.05
+  load_balance_deadband: 1.0
+  load_balance_slew_up: 0.5
+  load_balance_integral_max: 10.0
+  # Optional, keep a margin to the main fuse based on a forecast of the house
+  # usage instead of main_fuse_limit. The forecast uses the last
+  # load_balance_forecast_size samples and looks horizon seconds ahead, the margin
+  # is the trend plus the percentile of how much the usage jumps above the trend,
+  # but never less then load_balance_min_margin (A).
+  load_balance_forecast: false
+  load_balance_forecast_size: 120
+  load_balance_forecast_horizon: 10
+  load_balance_forecast_percentile: 95
+  load_balance_min_margin: 2.0
+  # Optional, capacity tariff. The grid tariff is the average of the
+  # capacity_peaks highest hours (kwh, one for each day) in the month. The load
+  # balancer and the chargeplan keeps the usage of every hour under the peaks
+  # that is already made this month, unless that makes the car miss ready_at.
+  # Until there is a peak for every billed hour the peaks of last month is
+  # used, the first month nothing is limited until there is enough peaks.
+  capacity_tariff: false
+  capacity_peaks: 3
+  # Optional, the steps (kW) of the tariff, a new peak is allowed as long as
+  # the average stays in the same step.
+  capacity_steps: [2, 5, 10, 15, 20, 25]
+  # Optional, balance each phase on its own using the current (A) of each phase
+  # measured at the main fuse, the charger gets a separate limit for each phase.
+  # Only used with a single charger, falls back to the total power usage if a
+  # sensor is stale.
+  load_balance_phase_sensors:
+    - sensor.main_l1_current
+    - sensor.main_l2_current
+    - sensor.main_l3_current
+  # Optional, the current for each phase used by the charger, if not set the
+  # charger is assumed to use the in_current on every phase.
+  charger_phase_sensors:
+    - sensor.easee_charger_eh385021_current_l1
+    - sensor.easee_charger_eh385021_current_l2
+    - sensor.easee_charger_eh385021_current_l3
+  # Optional, balance several chargers sharing the main fuse. A list of charger
+  # status entities in priority order, or all to use every charger that is found.
+  load_balance_chargers:
+    - sensor.easee_home_status
+    - sensor.easee_garage_status
+  # Optional, fair splits the amps using load_balance_weights (default 1),
+  # priority gives the first charger all it can use before the next gets anything.
+  load_balance_policy: fair
+  load_balance_weights:
+    sensor.easee_garage_status: 2
+  # Optional, plan several cars together so they don't all charge in the same
+  # cheap hours and gets throttled by the load balancer. Each car is charged
+  # by one of the load_balance_chargers, the plan is the max amps for each
+  # charger in every slot. Planned again when a car is connected or ready_at
+  # is changed.
+  vehicles:
+    - name: tesla
+      charger_status_entity: sensor.easee_home_status
+      car_battery_sensor_entity: sensor.tesla_model_3_battery_sensor
+      charger_ready_at: input_datetime.tesla_ready_at
+      car_battery_size_kwh: 72.5
+      car_onboard_charger_kwh: 11.0
+      car_target_soc: 80
   ### END POWERSTUFF ###
 
   ### Charger options ###
+  # Optional, min seconds between two commands to the same charger.
+  command_min_interval: 2
+  # Optional, how many times a failed command is retried and the backoff
+  # in seconds before the first retry, it doubles for each retry.
+  command_max_retries: 3
+  command_retry_backoff: 2
+  # Optional, a command that is the same as the last one the charger got is
+  # only sent again after this many seconds.
+  command_resend_after: 600
+  # Optional, seconds to wait for a charger command before it is retried.
+  # Commands are sent from the appdaemon event loop so a slow reply never
+  # holds up the load balancer.
+  command_timeout: 10
+  # Optional, appdaemon worker thread the planning runs on so a slow plan
+  # never delays the load balancer. Needs total_threads in appdaemon.yaml
+  # to be bigger then this, the default is to run on the app thread.
+  planner_thread: 9
+  # Optional, call counts, latency histograms, command errors/retries,
+  # commands per hour and the time the chargers was paused by the load
+  # balancer. charger_call is how long the service calls to the charger
+  # takes and command_queue_wait how long a command waited to be sent.
+  # Written every metrics_interval seconds as a prometheus text file (for
+  # the node_exporter textfile collector) and/or as the sensors
+  # sensor.chargebot_<app>_latency_ms, _commands_per_hour and _paused_minutes.
+  metrics_file: /conf/apps/chargebot.prom
+  metrics_sensors: true
+  metrics_interval: 60
+  # Optional, the last decision_trace_size load balancer decisions and plans
+  # are kept in memory (32 bytes each, 0 disables it). The service
+  # chargebot/dump_decision_trace writes them to decision_trace_dump, use
+  # decode_trace.py to turn the dump into a csv.
+  decision_trace_size: 10000
+  decision_trace_dump: /conf/apps/chargebot_decisions.bin
   charger_ready_at: "input_datetime.car_ready_at"
   charger_status_entity: "sensor.easee_charger_eh385021_status"
   # Optional
   charger_no_current_entity: "sensor.easee_charger_eh385021_reason_for_no_current"
+  # Optional, the chargers and the nordpool sensor that was found is cached here
+  # so ha doesn't have to be searched on every reload. Set to false to disable it.
+  discovery_cache: /conf/apps/chargebot_entities.json
+  # Optional, every start/stop of the charger cost this much (in the price currency)
+  # when the charge plan is created, use it to avoid many short sessions.
+  charge_session_penalty: 0.0
+  # Optional, max number of charge sessions and the min length of a session.
+  charge_max_sessions: 2
+  charge_min_session_minutes: 60
+  # Optional, on_off charges at full speed in the cheapest slots. current plans
+  # the amps for every slot and charges in one session using the dynamic circuit
+  # current. charge_current_loss is the part of the power lost for each amp,
+  # higher spreads the charging more.
+  charge_mode: on_off
+  charge_current_loss: 0.005
+  # Optional, how fast the car charges at a soc as a list of [soc, part of
+  # car_onboard_charger_kwh], linear in between. Of the power from the charger
+  # charge_efficiency ends up in the battery minus charge_overhead_kw (the car
+  # being awake). Use auto to learn all of it from the last charge_curve_days
+  # of the recorder, it is updated every day. Not set charges at a flat rate.
+  charge_curve: [[0, 1.0], [80, 1.0], [100, 0.3]]
+  charge_efficiency: 0.92
+  charge_overhead_kw: 0.25
+  charge_curve_days: 30
+  # Optional, where the learned curve is stored when charge_curve is auto.
+  # true (default) stores it next to this file, false doesn't store it.
+  charge_curve_store: /conf/apps/chargebot_charge_curve.json
+  # Optional, follow the soc while a chargeplan is running. Charging is stopped
+  # when car_target_soc is reached, and if the car is behind the plan the next
+  # cheapest slots before ready_at is added. Checked every charge_monitor_interval
+  # seconds.
+  charge_monitor: false
+  charge_monitor_interval: 300
+  # Optional, learn the house usage for each hour of the week from the recorder
+  # and use it to estimate how fast the car can charge in each slot of the plan.
+  # true stores it next to this file, or a path to the file.
+  load_profile: false
+  # The history is read load_profile_chunk_hours at a time and older data fades
+  # out with a half-life of load_profile_days. The usage that is used for a hour
+  # is the load_profile_percentile of that hour.
+  load_profile_days: 28
+  load_profile_chunk_hours: 24
+  load_profile_percentile: 90
+  # Optional, file the chargeplan and load balancer state is saved to so it
+  # survives a restart, defaults to chargebot_<app name>.json next to this file.
+  # Set to false to disable it.
+  plan_store: /conf/apps/chargebot_state.json
   ## END charger options ###
 
   ### Car options ###
   # optional, default to 0 the state cant be reached
   car_battery_sensor: "sensor.tesla_model_3_battery_sensor"
   car_battery_size_kwh: 72.5 # kwh
+  # Optional, the soc the car should be charged to.
+  car_target_soc: 100
   car_onboard_charger_kwh = 11.0
   verify_car_connected_and_home: true # Set this to false
   # Optional, required if verify_car_connected_and_home is true
@@ -71,79 +275,219 @@ charge_bot:
 needed_ = ["car_onboard_charger_kwh", "car_onboard_charger_kwh"]
 needed_inputs = ["charger_temp_override", "load_balance", "load_balance"]
 req_entities_user_added = ["charger_ready_at", "car_battery_sensor", ""]
-#entities = ["car_connected_to_charger", "charger_no_current_entity", "car_device_tracker_entity", "car_battery_sensor_entity", "charger_temp_override", "charger_ready_at"]
+#entities = ["car_connected_to_charger", "charger_no_current_entity", "car_device_tracker_entity",
+#            "car_battery_sensor_entity", "charger_temp_override", "charger_ready_at"]
 """
 
 
-def get_continues_timespan(data):
-    data = sorted(data, key=itemgetter("start"))
-    m = None
-    xam = None
-    result = []
-    for i, d in enumerate(data):
-        if m is None:
-            m = d["start"]
-        if xam is None:
-            xam = d["end"]
+async def maybe_await(value):
+    """Appdaemon api calls made from the event loop returns a task, from a
+    worker thread they return the value."""
+    if inspect.isawaitable(value):
+        return await value
+    return value
 
-        try:
-            if d["start"] == data[i + 1]["start"] - timedelta(hours=1):
-                xam = data[i + 1]["end"]
-            else:
-                result.append((m, xam))
-                m = None
-                xam = None
-        except IndexError:
-            if m is not None:
-                result.append((m, d["end"]))
 
-    return result
+def timed(name):
+    """Count the calls to a EaseeChargebot method and how long they take."""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            started = perf_counter()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self.metrics.observe(name, perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+# Config options that changes the chargeplan, a stored plan is only reused if these are the same.
+PLAN_OPTIONS = (
+    "car_battery_size_kwh",
+    "car_onboard_charger_kwh",
+    "charge_session_penalty",
+    "charge_max_sessions",
+    "charge_min_session_minutes",
+    "charge_mode",
+    "charge_current_loss",
+    "car_target_soc",
+    "charge_curve",
+    "charge_efficiency",
+    "charge_overhead_kw",
+)
+
+PLAN_STORE_VERSION = 1
 
 
 class EaseeChargebot(hass.Hass):
     def initialize(self):
+        self.metrics = Metrics()
+        self.decisions = None
+        size = int(self.args.get("decision_trace_size", 10000))
+        if size > 0:
+            self.decisions = DecisionTrace(size)
         self.setup_config()
         # Chargeplans
         self.charge_plan = []
         # listener callbacks.
         self.app_callbacks = []
-        self._serial = None
+        self.setup_state_mirror()
+        self._price_series = None
         # cancel timer callbacks.
-        self.chargeplan_handles = []
+        # (start, end) -> {"start": handle, "stop": handle}
+        self.chargeplan_handles = {}
+        self.chargeplan = []
+        # plan_inputs() when the chargeplan was created.
+        self.chargeplan_inputs = None
+        # [(start, end, amps)] when charge_mode is current.
+        self.charge_profile = []
+        self._charge_profile_starts = []
+        # (time, amps) -> handle
+        self.charge_profile_handles = {}
+        # vehicle name -> {(time, amps): handle} for the joint chargeplan.
+        self.vehicle_profile_handles = {}
+        self.chargeplan_version = 0
         self._loadbalancer_last_value = None
         self._charger_paused_by_loadbalance = None
+        # The last limit for each phase, the same value three times unless
+        # the phases are balanced one by one.
+        self._phase_last_values = None
+        self._phase_stale = False
+
+        # Raw power samples are collected here and consumed on a fixed tick.
+        self.sampler = PowerSampler(
+            alpha=float(self.args.get("load_balance_ewma_alpha", 0.3))
+        )
+        self.load_balance_tick_interval = float(self.args.get("load_balance_tick", 5))
+        self.handle_load_balance_tick = None
+        self._power_usage_stale = False
+        self._charger_current_stale = False
+
+        # All service calls to the charger goes through this queue.
+        self.command_queue = CommandQueue(
+            min_interval=float(self.args.get("command_min_interval", 2)),
+            max_retries=int(self.args.get("command_max_retries", 3)),
+            backoff=float(self.args.get("command_retry_backoff", 2)),
+            resend_after=float(self.args.get("command_resend_after", 600)),
+        )
+        self.command_timeout = float(self.args.get("command_timeout", 10))
+        # The queue is used from the worker threads and the command pump in
+        # the event loop, never hold this while calling appdaemon.
+        self.command_lock = threading.Lock()
+        self._command_pump_handle = None
+        self._command_pump_at = None
+
+        self.load_balance_controller = self.create_load_balance_controller(
+            self.args.get("load_balance_mode", "step")
+        )
+        # The planning callbacks runs in their own lane when planner_thread is set.
+        self.planner_lane = {}
+        if self.args.get("planner_thread") is not None:
+            self.planner_lane = {"pin_thread": int(self.args["planner_thread"])}
+
+        self.load_profile = None
+        self.load_profile_file = None
+        if self.args.get("load_profile", False):
+            self.load_profile_file = self.app_file("load_profile", "_load_profile")
+            self.load_profile = self.read_load_profile()
+            self.handle_load_profile = self.run_every(
+                self.update_load_profile, "now", 24 * 3600, **self.planner_lane
+            )
 
-        self.PID = None
+        self.capacity = None
+        self.capacity_override = False
+        if self.args.get("capacity_tariff", False):
+            self.capacity = PeakTracker(
+                peaks=int(self.args.get("capacity_peaks", 3)),
+                steps=[float(i) for i in self.args.get("capacity_steps") or ()],
+            )
+            self.capacity_tz = self.datetime(aware=True).tzinfo
+
+        self.charge_curve = None
+        curve = self.args.get("charge_curve")
+        if curve == "auto":
+            self.charge_curve_file = self.app_file("charge_curve_store", "_charge_curve")
+            self.charge_curve = self.read_charge_curve()
+            self.handle_charge_curve = self.run_every(
+                self.update_charge_curve, "now", 24 * 3600, **self.planner_lane
+            )
+        elif curve:
+            self.charge_curve = ChargeCurve(
+                curve,
+                float(self.args.get("charge_efficiency", 0.92)),
+                float(self.args.get("charge_overhead_kw", 0.25)),
+            )
 
-        # To simulate..
-        self.simulate()
-        return
+        # (timestamp, soc) while a chargeplan is running
+        self.monitor_socs = []
+        if self.args.get("charge_monitor", False):
+            self.handle_charge_monitor = self.run_every(
+                self.monitor_charge,
+                "now",
+                float(self.args.get("charge_monitor_interval", 300)),
+                **self.planner_lane
+            )
+
+        self.load_forecast = None
+        if self.args.get("load_balance_forecast", False):
+            self.load_forecast = LoadForecast(
+                int(self.args.get("load_balance_forecast_size", 120))
+            )
+        self.phase_controllers = []
+        if self.args.get("load_balance_phase_sensors"):
+            self.phase_controllers = [
+                self.create_load_balance_controller(
+                    self.args.get("load_balance_mode", "step")
+                )
+                for _ in range(3)
+            ]
+
+        self.metrics_file = self.args.get("metrics_file")
+        if self.metrics_file or self.args.get("metrics_sensors", False):
+            self.handle_metrics = self.run_every(
+                self.publish_metrics, "now", float(self.args.get("metrics_interval", 60))
+            )
+
+        self.plan_store = self.app_file("plan_store", "")
+        self._plan_store_handle = None
+        self._plan_store_written = None
+        # The plan store is saved from both the app and the planner thread.
+        self.plan_store_lock = threading.Lock()
 
         self.handle_cb_load_balance = self.listen_state(
             self.load_balance_cb, self.args["power_usage_in_w"]
         )
+        if self.load_balance_tick_interval > 0:
+            self.handle_load_balance_tick = self.run_every(
+                self.load_balance_tick, "now", self.load_balance_tick_interval
+            )
 
         self.handle_cb_charge_plan = self.listen_state(
-            self.cb_charger_status, self.args["charger_status_entity"]
+            self.cb_charger_status, self.args["charger_status_entity"], **self.planner_lane
         )
         self.handle_cb_edit_ready_at = self.listen_state(
-            self.cb_charger_ready_at, self.args["charger_ready_at"]
+            self.cb_charger_ready_at, self.args["charger_ready_at"], **self.planner_lane
         )
 
         self.handle_cb_smart_charge = self.listen_state(
-            self.cb_smart_charging, self.args["smart_charging"]
+            self.cb_smart_charging, self.args["smart_charging"], **self.planner_lane
         )
 
-        self.handle_cb_temp_allow = self.listen_state(
-            self.cb_temp_allow, self.args["charger_temp_override"]
-        )
+        if self.args.get("charger_temp_override"):
+            self.handle_cb_temp_allow = self.listen_state(
+                self.cb_temp_allow, self.args["charger_temp_override"]
+            )
+            self.app_callbacks.append(self.handle_cb_temp_allow)
 
         # Add some callbacks
         self.app_callbacks.append(self.handle_cb_charge_plan)
         self.app_callbacks.append(self.handle_cb_load_balance)
         self.app_callbacks.append(self.handle_cb_edit_ready_at)
         self.app_callbacks.append(self.handle_cb_smart_charge)
-        self.app_callbacks.append(self.handle_cb_temp_allow)
 
         # Lets add this as a service so it can get
         # executed manually using the api
@@ -151,19 +495,74 @@ class EaseeChargebot(hass.Hass):
             "chargebot/create_a_charge_plan", self.reschedule_charge_plan
         )
         self.register_service("chargebot/cancel_change_plans", self.cancel_change_plans)
+        self.register_service(
+            "chargebot/compare_load_balancers", self.compare_load_balancers
+        )
+        self.register_service("chargebot/export_trace", self.export_trace)
+        self.register_service("chargebot/dump_decision_trace", self.dump_decision_trace)
+
+        self.restore_plan_store()
+
+        if self.vehicles:
+            for vehicle in self.vehicles:
+                for entity in (
+                    vehicle.charger.status_entity,
+                    self.mirror.entity_of(vehicle.field("charger_ready_at")),
+                ):
+                    self.app_callbacks.append(
+                        self.listen_state(self.cb_vehicle_changed, entity, **self.planner_lane)
+                    )
+            self.register_service(
+                "chargebot/create_a_joint_charge_plan", self.create_joint_charge_plan
+            )
+            self.create_joint_charge_plan()
+
+    def app_file(self, key, suffix):
+        """Path from the config option key, if it is true or missing the file
+        is stored next to this file. None if it is disabled."""
+        path = self.args.get(key, True)
+        if path is True:
+            path = os.path.join(
+                os.path.dirname(os.path.abspath(__file__)),
+                "chargebot_%s%s.json" % (self.name, suffix),
+            )
+        return path or None
+
+    def discover_entities(self):
+        """Find the chargers and the nordpool sensor, uses the cached result
+        as long as all the cached entities still exists."""
+        cache = self.app_file("discovery_cache", "_entities")
+        if cache is not None and os.path.exists(cache):
+            try:
+                with open(cache) as f:
+                    found = json.load(f)
+                entities = list(found["power_price_entities"])
+                for charger in found["chargers"]:
+                    entities.append(charger["charger_status_entity"])
+                    if charger["charger_no_current_entity"]:
+                        entities.append(charger["charger_no_current_entity"])
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                self.log("Failed to read %s %s", cache, e, level="WARNING")
+            else:
+                if found["chargers"] and all(self.entity_exists(i) for i in entities):
+                    self.log("Using cached entities from %s", cache, level="DEBUG")
+                    return found
+
+        # Only the sensor domain is needed.
+        found = discover_entities(self.get_state("sensor") or {})
+        if cache is not None:
+            try:
+                with open(cache, "w") as f:
+                    json.dump(found, f)
+            except OSError as e:
+                self.log("Failed to write %s %s", cache, e, level="WARNING")
+        return found
 
     def setup_config(self):
         """Try to find some settings for the user."""
-        # This is way to messy. FIXME
-
-        all_states = self.get_state()
         conf = {}
-
-        serial = None
         OK = False
 
-        entity_start_name = ""
-
         # Inputs the user has to create in home assistant
         needed_inputs = ["charger_temp_override", "smart_charging", "load_balance"]
         non_discoverable_entities = ["power_usage_in_w"]
@@ -172,18 +571,26 @@ class EaseeChargebot(hass.Hass):
 
         if_missing_add_as_false = ["notify"]
 
-        # try to find the correct name
-        for entity in all_states:
-            if entity.startswith("sensor.easee") and entity.endswith("status"):
-                # Seems to be some changes to the entity names..
-                entity_start_name = entity.split(".")[1].replace("_status", "")
-                serial = self.get_state(
-                    "sensor.%s_status" % entity_start_name, attribute="id"
-                )
-                self._serial = serial.lower()
-                self.args["serial"] = serial
-                self.args["entity_start_name"] = entity_start_name
+        found = self.discover_entities()
+        self.chargers = found["chargers"]
+
+        # The configured charger is the main one, the first one found if none is configured.
+        charger = None
+        for i in self.chargers:
+            if i["charger_status_entity"] == self.args.get("charger_status_entity"):
+                charger = i
                 break
+        else:
+            if self.chargers:
+                charger = self.chargers[0]
+
+        if charger is not None:
+            self._serial = charger["serial"].lower()
+            self.args["serial"] = charger["serial"]
+            self.args["entity_start_name"] = charger["entity_start_name"]
+            conf["charger_status_entity"] = charger["charger_status_entity"]
+            if charger["charger_no_current_entity"]:
+                conf["charger_no_current_entity"] = charger["charger_no_current_entity"]
 
         for config_arg in self.args:
             if config_arg in needed_inputs:
@@ -197,25 +604,197 @@ class EaseeChargebot(hass.Hass):
                 else:
                     needed_inputs.remove(config_arg)
 
-        # Add any sensor that we can find.
-        for entity in all_states:
-            if entity == "sensor.%s_reason_for_no_current" % entity_start_name:
-                conf["charger_no_current_entity"] = entity
-            elif entity == "sensor.%s_status" % entity_start_name:
-                conf["charger_status_entity"] = entity
-
-            elif entity.startswith("sensor.nordpool"):
-                conf["power_price_entity"] = entity
+        if found["power_price_entities"]:
+            conf["power_price_entity"] = found["power_price_entities"][0]
+            if len(found["power_price_entities"]) > 1 and "power_price_entity" not in self.args:
+                self.log(
+                    "Found %s nordpool sensors using %s, set power_price_entity to use another",
+                    len(found["power_price_entities"]),
+                    conf["power_price_entity"],
+                    level="WARNING",
+                )
 
         # Add the one we found as default.
         for key, value in conf.items():
             if key not in self.args:
                 self.args[key] = value
 
-        self.log("Found %s using entities", conf, level="DEBUG")
+        self.log(
+            "Found %s chargers using entities %s", len(self.chargers), conf, level="DEBUG"
+        )
 
         return OK
 
+    def setup_state_mirror(self):
+        """Mirror every charger, toggle and car entity we read so the hot path
+        doesn't have to call get_state."""
+        esn = self.args.get("entity_start_name")
+        status_entity = self.args.get("charger_status_entity")
+
+        self.mirror = StateMirror()
+        # Toggles
+        self.mirror.add_field("load_balance", self.args.get("load_balance"))
+        self.mirror.add_field("smart_charging", self.args.get("smart_charging"))
+        self.mirror.add_field(
+            "charger_temp_override", self.args.get("charger_temp_override")
+        )
+        self.mirror.add_field("charger_ready_at", self.args.get("charger_ready_at"))
+
+        # Only used to know when the price series has to be parsed again.
+        price_entity = self.args.get("power_price_entity")
+        self.mirror.add_field("power_price", price_entity, cast=float)
+
+        # Charger
+        self.mirror.add_field("power_usage", self.args.get("power_usage_in_w"), cast=float)
+        self.mirror.add_field("charger_status", status_entity)
+        self.mirror.add_field(
+            "circuit_id", status_entity, attribute="circuit_id", cast=lambda x: x
+        )
+        self.mirror.add_field(
+            "charger_authorization_required",
+            status_entity,
+            attribute="config.authorizationRequired",
+            cast=lambda x: x,
+        )
+        if esn:
+            self.mirror.add_field(
+                "charger_current", "sensor.%s_in_current" % esn, cast=float
+            )
+            self.mirror.add_field(
+                "dynamic_circuit_current",
+                "sensor.%s_dynamic_circuit_current" % esn,
+                cast=float,
+            )
+            self.mirror.add_field(
+                "max_circuit_current", "sensor.%s_max_circuit_current" % esn, cast=float
+            )
+
+        # Per phase
+        for i, entity in enumerate(self.args.get("load_balance_phase_sensors") or ()):
+            self.mirror.add_field("phase_current_%s" % (i + 1), entity, cast=float)
+        for i, entity in enumerate(self.args.get("charger_phase_sensors") or ()):
+            self.mirror.add_field("charger_phase_current_%s" % (i + 1), entity, cast=float)
+
+        # Car
+        self.mirror.add_field(
+            "car_battery", self.args.get("car_battery_sensor_entity"), cast=float
+        )
+        self.mirror.add_field(
+            "car_connected", self.args.get("car_connected_to_charger")
+        )
+        self.mirror.add_field(
+            "car_location", self.args.get("car_device_tracker_entity")
+        )
+
+        self.balanced_chargers = self.setup_balanced_chargers()
+        self.vehicles = self.setup_vehicles()
+
+        now = self.get_now_ts()
+        for entity in self.mirror.entities():
+            self.mirror.update(entity, self.get_state(entity, attribute="all"), now)
+            self.app_callbacks.append(
+                self.listen_state(self.cb_state_mirror, entity, attribute="all")
+            )
+
+    def setup_balanced_chargers(self):
+        """Create the chargers from load_balance_chargers and mirror their entities.
+
+        Returns a empty list if only the main charger is balanced.
+        """
+        wanted = self.args.get("load_balance_chargers")
+        if not wanted:
+            return []
+
+        chargers = {i["charger_status_entity"]: i for i in self.chargers}
+        if wanted == "all":
+            wanted = list(chargers)
+
+        weights = self.args.get("load_balance_weights") or {}
+        balanced = []
+        for status_entity in wanted:
+            found = chargers.get(status_entity)
+            if found is None:
+                self.log("Can't find the charger %s", status_entity, level="WARNING")
+                continue
+            esn = found["entity_start_name"]
+            charger = BalancedCharger(
+                esn,
+                status_entity,
+                max(float(weights.get(status_entity, 1.0)), 0.01),
+                self.create_load_balance_controller(
+                    self.args.get("load_balance_mode", "step")
+                ),
+                serial=found["serial"],
+            )
+            self.mirror.add_field(charger.field("charger_status"), status_entity)
+            self.mirror.add_field(
+                charger.field("circuit_id"),
+                status_entity,
+                attribute="circuit_id",
+                cast=lambda x: x,
+            )
+            self.mirror.add_field(
+                charger.field("charger_current"), "sensor.%s_in_current" % esn, cast=float
+            )
+            self.mirror.add_field(
+                charger.field("max_circuit_current"),
+                "sensor.%s_max_circuit_current" % esn,
+                cast=float,
+            )
+            balanced.append(charger)
+
+        self.log(
+            "Balancing %s on the same main fuse",
+            [i.name for i in balanced],
+            level="DEBUG",
+        )
+        return balanced
+
+    def setup_vehicles(self):
+        """Create the cars from the vehicles config and mirror their entities."""
+        chargers = {i.status_entity: i for i in self.balanced_chargers}
+        vehicles = []
+        for conf in self.args.get("vehicles") or ():
+            charger = chargers.get(conf.get("charger_status_entity"))
+            if charger is None:
+                self.log(
+                    "%s is not one of the load_balance_chargers, can't plan %s",
+                    conf.get("charger_status_entity"),
+                    conf["name"],
+                    level="WARNING",
+                )
+                continue
+            vehicle = Vehicle(
+                conf["name"],
+                charger,
+                float(conf["car_battery_size_kwh"]),
+                float(conf.get("car_onboard_charger_kwh", 11.0)),
+                float(conf.get("car_target_soc", 100)),
+            )
+            self.mirror.add_field(
+                vehicle.field("car_battery"), conf["car_battery_sensor_entity"], cast=float
+            )
+            self.mirror.add_field(vehicle.field("charger_ready_at"), conf["charger_ready_at"])
+            vehicles.append(vehicle)
+        return vehicles
+
+    def price_series(self):
+        """The parsed prices, only parsed again when the price sensor has changed."""
+        updated = self.mirror.updated("power_price")
+        series = self._price_series
+        if series is None or updated is None or series.last_updated != updated:
+            state = self.get_state(self.args["power_price_entity"], attribute="all") or {}
+            series = PriceSeries.from_nordpool(
+                state.get("attributes"), last_updated=updated
+            )
+            self._price_series = series
+            self.log("Parsed %s price slots", len(series), level="DEBUG")
+        return series
+
+    def cb_state_mirror(self, entity, attribute, old, new, kwargs):
+        """Keep the state mirror up to date."""
+        self.mirror.update(entity, new, self.get_now_ts())
+
     def access_level(self, locked=True):
         """Change access level on the charger, this will also start and stop the charge."""
         serial = self.args["serial"]
@@ -244,34 +823,49 @@ class EaseeChargebot(hass.Hass):
     def toggle_charge(self, verify=True):
         return self.charger_service(self.cmd("easee/toggle"), verify=verify)
 
-    def set_circuit_current_limit(self, value, verify=False):
-        if self._loadbalancer_last_value is None:
-            self._loadbalancer_last_value = value
+    def set_circuit_current_limit(self, value, verify=False, charger=None, phases=None):
+        """Set the dynamic current of the main charger or a BalancedCharger.
 
-        circuit_id = self.get_state(
-            self.args["charger_status_entity"], attribute="circuit_id"
-        )
+        phases is a limit for each phase, value is only used for the logging then.
+        """
         value = math.floor(float(value))
-        self._loadbalancer_last_value = value
+        if phases is None:
+            phases = [value] * 3
+        else:
+            phases = [math.floor(float(i)) for i in phases]
+
+        if charger is not None:
+            previous = [charger.last_value] * 3
+            charger.last_value = value
+            circuit_id = self.mirror.get(charger.field("circuit_id"))
+            serial = charger.serial
+        else:
+            previous = self._phase_last_values or [self._loadbalancer_last_value] * 3
+            self._loadbalancer_last_value = value
+            self._phase_last_values = phases
+            circuit_id = self.mirror.get("circuit_id")
+            serial = self.args.get("serial")
+        self.save_plan_store(delay=10)
         call = {
             "service": "easee/set_circuit_dynamic_current",
             "data": {
                 "circuit_id": circuit_id,
-                "currentP1": value,
-                "currentP2": value,
-                "currentP3": value,
+                "currentP1": phases[0],
+                "currentP2": phases[1],
+                "currentP3": phases[2],
             },
         }
         self.log("%s", call, level="DEBUG")
+        self.metrics.set_paused(
+            "main" if charger is None else charger.name, value < 6, self.get_now_ts()
+        )
 
-        # Just for debugging so i can graph it
-        self.set_value("input_number.kw_set_by_loadbalance", self.amp_to_watt(value) / 1000)
-        self.set_value("input_number.amps_set_by_loadbalance", value)
-        if value < 6:
-            self.set_value("input_number.charger_paused_by_loadbalance", 0)
+        # Reducing the current protects the main fuse so it goes before anything else.
+        if any(old is None or new < old for old, new in zip(previous, phases)):
+            priority = PRIORITY_PROTECT
         else:
-            self.set_value("input_number.charger_paused_by_loadbalance", 30)
-        return self.charger_service(call, verify=verify)
+            priority = PRIORITY_CONTROL
+        return self.charger_service(call, verify=verify, priority=priority, target=serial)
 
     def cb_temp_allow(self, entity, attribute, old, new, kwargs):
         """Open the charger, this will also start the charge"""
@@ -291,10 +885,7 @@ class EaseeChargebot(hass.Hass):
 
         # Handle when the cars is connected or ready to charge.
         if old == "STANDBY" and new in ("READY_TO_CHARGE", "CAR_CONNECTED"):
-            if (
-                self.entity_exits("charger_temp_override")
-                and self.get_state("charger_temp_override") == "on"
-            ):
+            if self.mirror.get("charger_temp_override") == "on":
                 self.access_level(False)
                 self.log(
                     "Manual override is used, unlocking charger and relocking after charge is done."
@@ -307,17 +898,14 @@ class EaseeChargebot(hass.Hass):
         # if disconnected before the next poll from the api.
         elif old == "CHARGING" and new == "READY_TO_CHARGE":
             self.notify("Charging is finished")
-            if self.entity_exits("charger_temp_override"):
+            if self.mirror.has("charger_temp_override"):
                 # We want to check if the charger is locked or unlocked.
                 # incase somebody uses the easee app to unlock. use HASS FFS!
-                is_locked = self.get_state(
-                    self.args["charger_status_entity"],
-                    attribute="config.authorizationRequired",
-                )
+                is_locked = self.mirror.get("charger_authorization_required")
 
                 if (
                     is_locked is False
-                    or self.get_state("charger_temp_override") == "on"
+                    or self.mirror.get("charger_temp_override") == "on"
                 ):
                     self.turn_off("charger_temp_override")
                     self.access_level(True)
@@ -362,32 +950,153 @@ class EaseeChargebot(hass.Hass):
 
         self.log(message, level="DEBUG")
 
-    def charger_service(self, data, verify=True, notify=False):
-        """Send a service call to the charger."""
-        service = data.pop("service")
-        kw = data.pop("data", {})
-        call = None
+    @timed("charger_service")
+    def charger_service(
+        self, data, verify=True, notify=False, priority=PRIORITY_CONTROL, target=None
+    ):
+        """Queue a service call to the charger.
+
+        target is the charger the command is rate limited by, the charger_id
+        or circuit_id in the data if it isn't set.
+        """
+        service = data["service"]
+        kw = dict(data.get("data", {}))
         if self.args["verify_car_connected_and_home"] is True and verify is True:
-            if self.verify_car() is True:
-                call = self.call_service(service, **kw)
+            if self.verify_car() is not True:
+                return
+
+        if target is None:
+            target = kw.get("charger_id", kw.get("circuit_id"))
+        if service in ("easee/start", "easee/stop", "easee/pause", "easee/resume"):
+            # Only the last start/stop/pause/resume matters.
+            key = ("charge", target)
+        elif service == "easee/toggle":
+            # A toggle can't be coalesced, two toggles is not the same as one.
+            key = (service, target, object())
         else:
-            call = self.call_service(service, **kw)
+            key = (service, target)
+
+        self.queue_command(key, target, service, kw, priority)
+        if notify is True:
+            self.notify("Sent charge service")
+        return True
+
+    def queue_command(self, key, target, service, data, priority):
+        """Add a command to the command queue and make sure it gets pumped."""
+        now = self.get_now_ts()
+        with self.command_lock:
+            self.command_queue.put(key, target, service, data, priority, now)
+        self.schedule_command_pump(0)
+
+    def claim_command_pump(self, due):
+        """Mark that the pump runs at due. Returns False if it already runs
+        before that, else the handle of the old pump to cancel (or None)."""
+        with self.command_lock:
+            if self._command_pump_at is not None and self._command_pump_at <= due:
+                return False
+            stale = self._command_pump_handle
+            self._command_pump_at = due
+            self._command_pump_handle = None
+            return stale
+
+    def store_command_pump(self, due, handle):
+        """Keep the handle unless the pump already ran or got replaced."""
+        with self.command_lock:
+            if self._command_pump_at == due:
+                self._command_pump_handle = handle
+
+    def schedule_command_pump(self, delay):
+        """Make sure pump_commands runs in delay seconds or sooner, this is
+        used from the worker threads, the pump reschedules itself."""
+        due = self.get_now_ts() + delay
+        stale = self.claim_command_pump(due)
+        if stale is False:
+            return
+        if stale is not None:
+            self.cancel_timer(stale)
+        self.store_command_pump(due, self.run_in(self.pump_commands, delay))
+
+    async def pump_commands(self, kwargs):
+        """Send every command that is allowed to be sent now.
+
+        This runs in the appdaemon event loop and every service call is
+        awaited for at most command_timeout, so a slow charger only delays
+        the commands and never the load balancer or the planner.
+        """
+        with self.command_lock:
+            self._command_pump_handle = None
+            self._command_pump_at = None
+
+        while True:
+            now = await maybe_await(self.get_now_ts())
+            with self.command_lock:
+                cmd = self.command_queue.pop_ready(now)
+            if cmd is None:
+                break
+            # Since it was first queued, a retry includes the backoff.
+            self.metrics.observe("command_queue_wait", now - cmd.queued_at)
+
+            started = perf_counter()
+            try:
+                result = await asyncio.wait_for(
+                    maybe_await(self.call_service(cmd.service, **cmd.data)),
+                    self.command_timeout,
+                )
+                if isinstance(result, dict) and result.get("success") is False:
+                    raise RuntimeError(result)
+            except Exception as e:
+                self.metrics.observe("charger_call", perf_counter() - started)
+                if isinstance(e, asyncio.TimeoutError):
+                    e = "no reply in %ss" % self.command_timeout
+                with self.command_lock:
+                    retry = self.command_queue.retry(cmd, now)
+                if retry:
+                    self.log(
+                        "%s failed (%s), retry %s", cmd.service, e, cmd.attempts,
+                        level="WARNING",
+                    )
+                else:
+                    self.log(
+                        "%s failed (%s), giving up after %s attempts",
+                        cmd.service,
+                        e,
+                        cmd.attempts,
+                        level="ERROR",
+                    )
+            else:
+                self.metrics.observe("charger_call", perf_counter() - started)
+                with self.command_lock:
+                    self.command_queue.done(cmd, now)
+                self.metrics.command_sent(now)
+
+        now = await maybe_await(self.get_now_ts())
+        with self.command_lock:
+            stats = self.command_queue.stats()
+            delay = self.command_queue.next_due(now)
+        self.log("Command queue %s", stats, level="DEBUG")
+        if delay is None:
+            return
 
-        if call is not None:
-            if notify is True:
-                self.notify("Sent charge service")
-            return call
+        # Like schedule_command_pump, only with the api calls awaited.
+        stale = self.claim_command_pump(now + delay)
+        if stale is False:
+            return
+        if stale is not None:
+            await maybe_await(self.cancel_timer(stale))
+        handle = await maybe_await(self.run_in(self.pump_commands, delay))
+        self.store_command_pump(now + delay, handle)
 
     def verify_car(self):
         """verify that the car is home and connected to a charger."""
-        if self.get_tracker_state(self.args["car_device_tracker_entity"]) in (
+        # This used to be in (...), that refused to charge when the car was home.
+        if self.mirror.get("car_location") not in (
             "home",
             "on",
         ):
             self.notify("Didn't execute as your car isnt home.")
             return False
 
-        if self.get_state(self.args["car_connected_to_charger"]) != "on":
+        if self.mirror.get("car_connected") != "on":
             self.notify("Didnt execute as your car isnt connected")
             return False
 
@@ -395,11 +1104,15 @@ class EaseeChargebot(hass.Hass):
 
     def terminate(self):
         """Cancel all listeners and cancel everything."""
+        # Timers are cancelled by appdaemon, make sure nothing pending is lost.
+        self.save_plan_store()
         return
         # untested
         for handle in self.app_callbacks:
             self.cancel_listen_state(handle)
         self.app_callbacks.clear()
+        if self.handle_load_balance_tick is not None:
+            self.cancel_timer(self.handle_load_balance_tick)
         self.cancel_change_plans()
 
     def cb_charger_ready_at(self, entity, attribute, old, new, kwargs):
@@ -413,97 +1126,311 @@ class EaseeChargebot(hass.Hass):
         self.reschedule_charge_plan()
 
     def reschedule_charge_plan(self, *args, **kwargs):
-        """Reschedule and recreate a chargeplan."""
+        """Reschedule and recreate a chargeplan, only the timers that changed is touched."""
         self.log("Reschedule changeplans", level="DEBUG")
-        self.cancel_change_plans()
         self.create_and_schedule_chargeplan()
 
     def cancel_change_plans(self, *args, **kwargs):
         """Cancel all chargeplans and timers."""
         self.log("Canceling chargeplans", level="DEBUG")
-        if len(self.chargeplan_handles):
-            for handle in self.chargeplan_handles:
+        for handles in self.chargeplan_handles.values():
+            for handle in handles.values():
                 self.cancel_timer(handle)
-            self.chargeplan_handles.clear()
+        self.chargeplan_handles.clear()
+        self.chargeplan = []
+        self.schedule_charge_profile([])
+        self.save_plan_store()
 
     def create_and_schedule_chargeplan(self):
         """Create and schedule chargeplans."""
         self.log("called create_and_schedule_chargeplan", level="DEBUG")
         if self.create_a_charge_plan() is True:
-            if len(self.chargeplan):
-                for start, end in self.chargeplan:
-                    self.log(
-                        "Added starting charging at %s and stop at %s",
-                        start,
-                        end,
-                        level="DEBUG",
-                    )
+            self.schedule_chargeplan(self.chargeplan)
+            self.schedule_charge_profile(self.charge_profile)
+        else:
+            self.cancel_change_plans()
+            self.notify("Failed to create a chargeplan")
+
+    def schedule_chargeplan(self, chargeplan):
+        """Make the timers match the chargeplan.
+
+        Timers that is in both the old and the new plan is kept, so there is
+        never a window without timers and a plan that didn't change doesn't
+        touch the scheduler at all.
+        """
+        # (kind, time) -> handle for the old plan
+        old_timers = {}
+        for (start, end), handles in self.chargeplan_handles.items():
+            for kind, handle in handles.items():
+                old_timers[(kind, start if kind == "start" else end)] = handle
+
+        now = self.datetime(aware=True)
+        chargeplan_handles = {}
+        added = 0
+        for start, end in chargeplan:
+            handles = {}
+            for kind, at in (("start", start), ("stop", end)):
+                handle = old_timers.pop((kind, at), None)
+                if handle is None:
+                    self.log("Added %s charging at %s", kind, at, level="DEBUG")
+                    if at > now:
+                        handle = self.run_at(
+                            self.cb_chargeplan_timer, at, kind=kind, at=at
+                        )
+                    elif kind == "start" and end > now:
+                        # We are already in this part of the plan.
+                        handle = self.run_in(
+                            self.cb_chargeplan_timer, 0, kind=kind, at=at
+                        )
+                    else:
+                        continue
+                    added += 1
+                handles[kind] = handle
+            chargeplan_handles[(start, end)] = handles
+
+        for handle in old_timers.values():
+            self.cancel_timer(handle)
+
+        self.chargeplan_handles = chargeplan_handles
+        self.chargeplan_version += 1
+        self.log(
+            "Chargeplan version %s added %s and cancelled %s timers",
+            self.chargeplan_version,
+            added,
+            len(old_timers),
+            level="DEBUG",
+        )
+        self.save_plan_store()
+
+    def plan_inputs(self):
+        """Everything the chargeplan is created from, used to check if a stored
+        plan is still valid."""
+        series = self.price_series()
+        return {
+            "prices": zlib.crc32(series.starts.tobytes() + series.values.tobytes()),
+            "ready_at": self.mirror.get("charger_ready_at"),
+            "soc": self.mirror.get("car_battery"),
+            "smart_charging": self.mirror.get("smart_charging"),
+            "options": [self.args.get(key) for key in PLAN_OPTIONS],
+        }
+
+    def save_plan_store(self, delay=None):
+        """Write the chargeplan and the load balancer state to the plan store.
+
+        With a delay the write is postponed so a burst of changes only writes
+        the file once.
+        """
+        if self.plan_store is None:
+            return
+        if delay is not None:
+            with self.plan_store_lock:
+                if self._plan_store_handle is not None:
+                    return
+                # Claimed, the timer is created without holding the lock.
+                self._plan_store_handle = True
+            handle = self.run_in(self.cb_save_plan_store, delay)
+            with self.plan_store_lock:
+                if self._plan_store_handle is True:
+                    self._plan_store_handle = handle
+            return
+
+        data = {
+            "version": PLAN_STORE_VERSION,
+            "plan": [[start.isoformat(), end.isoformat()] for start, end in self.chargeplan],
+            "profile": [
+                [start.isoformat(), end.isoformat(), amps]
+                for start, end, amps in self.charge_profile
+            ],
+            "inputs": self.chargeplan_inputs if self.chargeplan else None,
+            "loadbalancer_last_value": self._loadbalancer_last_value,
+            "charger_paused_by_loadbalance": self._charger_paused_by_loadbalance,
+            "balanced_chargers": {
+                charger.name: [charger.last_value, charger.paused]
+                for charger in self.balanced_chargers
+            },
+            "capacity": None if self.capacity is None else self.capacity.to_dict(),
+            "capacity_override": self.capacity_override,
+        }
+        content = json.dumps(data, separators=(",", ":"))
+        with self.plan_store_lock:
+            if content == self._plan_store_written:
+                return
+
+            tmp = self.plan_store + ".tmp"
+            try:
+                with open(tmp, "w") as f:
+                    f.write(content)
+                os.replace(tmp, self.plan_store)
+            except OSError as e:
+                self.log("Failed to write %s %s", self.plan_store, e, level="WARNING")
+                return
+            self._plan_store_written = content
+
+    def cb_save_plan_store(self, kwargs):
+        with self.plan_store_lock:
+            self._plan_store_handle = None
+        self.save_plan_store()
+
+    def restore_plan_store(self):
+        """Restore the chargeplan and the load balancer state after a restart.
+
+        The timers for the stored plan are armed again if nothing the plan
+        depends on has changed, otherwise a new plan is created.
+        """
+        if self.plan_store is None or not os.path.exists(self.plan_store):
+            return
+        try:
+            with open(self.plan_store) as f:
+                content = f.read()
+            data = json.loads(content)
+            plan = [
+                (datetime.fromisoformat(start), datetime.fromisoformat(end))
+                for start, end in data["plan"]
+            ]
+            profile = [
+                (datetime.fromisoformat(start), datetime.fromisoformat(end), amps)
+                for start, end, amps in data.get("profile", [])
+            ]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.log("Failed to read %s %s", self.plan_store, e, level="WARNING")
+            return
+        if data.get("version") != PLAN_STORE_VERSION:
+            return
+
+        self._plan_store_written = content
+        self._loadbalancer_last_value = data.get("loadbalancer_last_value")
+        self._charger_paused_by_loadbalance = data.get("charger_paused_by_loadbalance")
+        if self.capacity is not None and data.get("capacity"):
+            self.capacity.restore(data["capacity"])
+            self.capacity_override = data.get("capacity_override", False)
+        balanced = data.get("balanced_chargers") or {}
+        for charger in self.balanced_chargers:
+            if charger.name in balanced:
+                charger.last_value, charger.paused = balanced[charger.name]
 
-                    start_handle = self.run_at(self.start_charge, start)
-                    end_handle = self.run_at(self.stop_charge, end)
-                    self.chargeplan_handles.append(start_handle)
-                    self.chargeplan_handles.append(end_handle)
+        now = self.datetime(aware=True)
+        plan = [(start, end) for start, end in plan if end > now]
+        if not plan:
+            return
 
+        if data.get("inputs") == self.plan_inputs():
+            self.log("Restored chargeplan %s", plan, level="INFO")
+            self.chargeplan = plan
+            self.chargeplan_inputs = data["inputs"]
+            self.schedule_chargeplan(plan)
+            self.schedule_charge_profile(profile)
         else:
-            self.notify("Failed to create a chargeplan")
+            self.log("Stored chargeplan is outdated, creating a new one", level="INFO")
+            self.create_and_schedule_chargeplan()
+
+    def schedule_charge_profile(self, profile):
+        """Make the timers that sets the dynamic current match the profile,
+        like schedule_chargeplan only the timers that changed is touched."""
+        # The balancer can read these from its own thread, starts is set
+        # first and planned_amps checks the length.
+        self._charge_profile_starts = [start.timestamp() for start, _, _ in profile]
+        self.charge_profile = profile
+        old_timers = self.charge_profile_handles
+        now = self.datetime(aware=True)
+        handles = {}
+        previous = None
+        for start, end, amps in profile:
+            if amps == previous:
+                continue
+            previous = amps
+            key = (start, amps)
+            handle = old_timers.pop(key, None)
+            if handle is None:
+                if start > now:
+                    handle = self.run_at(
+                        self.cb_charge_profile_timer, start, at=start, amps=amps
+                    )
+                elif end > now:
+                    handle = self.run_in(
+                        self.cb_charge_profile_timer, 0, at=start, amps=amps
+                    )
+                else:
+                    continue
+            handles[key] = handle
+
+        for handle in old_timers.values():
+            self.cancel_timer(handle)
+        self.charge_profile_handles = handles
+
+    def cb_charge_profile_timer(self, kwargs):
+        """Set the dynamic current for the next part of the charge profile."""
+        amps = kwargs["amps"]
+        self.charge_profile_handles.pop((kwargs["at"], amps), None)
+        self.set_circuit_current_limit(amps)
+
+    def planned_amps(self, now):
+        """The amps the charge profile wants now, None without a profile."""
+        profile = self.charge_profile
+        i = bisect_right(self._charge_profile_starts, now) - 1
+        if i < 0 or i >= len(profile):
+            return None
+        start, end, amps = profile[i]
+        if now >= end.timestamp():
+            return 0
+        return amps
+
+    def cb_chargeplan_timer(self, kwargs):
+        """Start or stop the charging for a part of the chargeplan."""
+        kind = kwargs["kind"]
+        at = kwargs["at"]
+        for (start, end), handles in self.chargeplan_handles.items():
+            if (start if kind == "start" else end) == at:
+                handles.pop(kind, None)
+
+        if kind == "start":
+            self.start_charge()
+        else:
+            self.stop_charge()
 
+    @timed("create_a_charge_plan")
     def create_a_charge_plan(self):
         """Create a chargeplan"""
         self.log("called create_a_charge_plan", level="DEBUG")
 
-        if self.get_state(self.args["smart_charging"], default="off") == "off":
+        if self.mirror.get("smart_charging", "off") == "off":
             self.log("Smart charging is off")
             return False
 
-        now = self.datetime(aware=True)
-        ip_state = self.get_state(self.args["charger_ready_at"])
-        ready_until = self.parse_datetime(ip_state, aware=True)
+        # Only ignore the capacity tariff if this plan needs it.
+        self.capacity_override = False
+        # What the plan is made from, the plan store checks it after a restart.
+        self.chargeplan_inputs = self.plan_inputs()
 
-        if ready_until is not None and now > ready_until:
-            ready_until = ready_until + timedelta(days=1)
+        now = self.datetime(aware=True)
+        ready_until = self.get_ready_until(now)
 
-        car_soc = float(
-            self.get_state(self.args["car_battery_sensor_entity"], default=0)
-        )
-        car_kwh_battery = float(self.args["car_battery_size_kwh"])
+        car_soc = self.mirror.get("car_battery", 0.0)
+        planner = self.charge_planner()
         # Based on the onboard charger in the car and the charger.
-        max_charge_speed = float(self.args.get("car_onboard_charger_kwh", 11.0))
-
-        state = self.get_state(self.args["power_price_entity"], attribute="all")
-        tomorrow = state.get("attributes", {}).get("raw_tomorrow", [])
-        today = state.get("attributes", {}).get("raw_today", [])
-        currency = state.get("attributes", {}).get("currency")
-        possible_hours = today + tomorrow
-        str_format = "%Y-%m-%dT%H:%M:%S%z"
+        max_charge_speed = planner.max_kw
+
+        series = self.price_series()
+        currency = series.currency
         nor_str_format = "%d.%m.%Y %H:%M:%S"
 
-        avail_hours = []
-        for i in possible_hours:
-            start = datetime.strptime(i["start"], str_format)
-            end = datetime.strptime(i["end"], str_format)
-            # Lets skip all hours that is already passed.
-            if now > start:
-                self.log(
-                    "skipped %s bc hour is passed %s", start, i["value"], level="DEBUG"
-                )
-                continue
-            elif ready_until is not None and start > ready_until:
-                self.log(
-                    "skipped %s  %s bc hour is after the car should be ready",
-                    start,
-                    i["value"],
-                    level="DEBUG",
-                )
-                continue
-            else:
-                data = {"start": start, "end": end, "value": i["value"]}
-                if i["value"] is not None:
-                    avail_hours.append(data)
+        # Skip all hours that is already passed or after the car should be ready.
+        first, last = series.window(
+            now.timestamp(),
+            ready_until.timestamp() if ready_until is not None else float("inf"),
+        )
+        avail_hours = range(first, last)
+        self.log(
+            "%s of %s price slots is between now and %s",
+            len(avail_hours),
+            len(series),
+            ready_until,
+            level="DEBUG",
+        )
 
         if len(avail_hours):
-            number_of_kwh_to_charge = car_kwh_battery - car_kwh_battery / 100 * car_soc
-            numbers_of_hours_required_to_be_fully_charged = math.ceil(
-                number_of_kwh_to_charge / max_charge_speed
+            number_of_kwh_to_charge = planner.kwh_to_charge(car_soc)
+            numbers_of_hours_required_to_be_fully_charged = planner.hours_to_charge(
+                car_soc, number_of_kwh_to_charge
             )
 
             self.log(
@@ -522,11 +1449,27 @@ class EaseeChargebot(hass.Hass):
                 self.notify(msg)
                 self.log(msg, level="INFO")
 
-            hours = list(sorted(avail_hours, key=itemgetter("value")))
-
-            cheapest_hours = hours[:numbers_of_hours_required_to_be_fully_charged]
+            if self.args.get("charge_mode", "on_off") == "current":
+                return self.create_charge_profile(
+                    series, avail_hours.start, avail_hours.stop, number_of_kwh_to_charge
+                )
+            self.charge_profile = []
 
-            nexp_hours = hours[numbers_of_hours_required_to_be_fully_charged:]
+            cheapest_hours = []
+            for i, start, end in self.pick_charge_slots(
+                series,
+                avail_hours.start,
+                avail_hours.stop,
+                numbers_of_hours_required_to_be_fully_charged,
+                kwh=number_of_kwh_to_charge,
+            ):
+                cheapest_hours.append(
+                    {
+                        "start": series.to_datetime(start, i),
+                        "end": series.to_datetime(end, i),
+                        "value": series.values[i],
+                    }
+                )
 
             # Just some logging for debugging.
             for cch in cheapest_hours:
@@ -537,14 +1480,6 @@ class EaseeChargebot(hass.Hass):
                     cch["value"],
                     level="DEBUG",
                 )
-            for exph in nexp_hours:
-                self.log(
-                    "skipped %s - %s price %s",
-                    exph["start"],
-                    exph["end"],
-                    exph["value"],
-                    level="DEBUG",
-                )
 
             # Create a chargeplan with continues start and end as cars/chargers
             # dont like to get stopped/started
@@ -554,6 +1489,7 @@ class EaseeChargebot(hass.Hass):
             cost = 0
 
             msg = []
+            slots = iter(cheapest_hours)
             for i, part_plan in enumerate(chargeplan):
                 self.log(
                     "Charge should start at %s and end at %s",
@@ -561,22 +1497,37 @@ class EaseeChargebot(hass.Hass):
                     part_plan[1],
                     level="DEBUG",
                 )
-                price_for_hour = []
-                for ch in cheapest_hours:
-                    if part_plan[0] <= ch["start"] and ch["end"] <= part_plan[1]:
-                        self.log(
-                            f"{part_plan[0]} {part_plan[1]} {ch['start']} {ch['end']} {ch['value']}",
-                            level="DEBUG",
-                        )
-                        price_for_hour.append(ch["value"])
-                        cost += float(ch["value"])
+                # The slots is sorted the same way as the plan.
+                part_cost = 0
+                part_hours = 0
+                for slot in slots:
+                    hours = (slot["end"] - slot["start"]).total_seconds() / 3600
+                    part_cost += slot["value"] * hours * max_charge_speed
+                    part_hours += hours
+                    if slot["end"] == part_plan[1]:
+                        break
+                cost += part_cost
 
                 msg.append(
-                    f"{i+1}: {part_plan[0].strftime(nor_str_format)} - {part_plan[1].strftime(nor_str_format)} avg: {statistics.mean(price_for_hour)}"
+                    f"{i+1}: {part_plan[0].strftime(nor_str_format)} - "
+                    f"{part_plan[1].strftime(nor_str_format)} "
+                    f"avg: {part_cost / part_hours / max_charge_speed}"
                 )
 
             self.notify("\n".join(msg), title="Created chargeplan")
             self.log("Total cost should be %s %s", cost, currency, level="DEBUG")
+            if self.decisions is not None:
+                self.decisions.record(
+                    TRACE_PLAN,
+                    0,
+                    0,
+                    now.timestamp(),
+                    number_of_kwh_to_charge,
+                    sum((end - start).total_seconds() for start, end in chargeplan) / 3600,
+                    cost,
+                    len(chargeplan),
+                    0.0,
+                )
 
             self.charge_plan.clear()
             self.chargeplan = chargeplan
@@ -597,6 +1548,434 @@ class EaseeChargebot(hass.Hass):
             self.log(msg, level="INFO")
             self.charger_service(self.args["charger_service_start"], verify=False)
 
+    def get_ready_until(self, now):
+        """When the car should be ready, the next time charger_ready_at is."""
+        ready_until = self.parse_datetime(self.mirror.get("charger_ready_at"), aware=True)
+        if ready_until is not None and now > ready_until:
+            ready_until = ready_until + timedelta(days=1)
+        return ready_until
+
+    def monitor_charge(self, kwargs):
+        """Check the progress of the running chargeplan against the soc.
+
+        Stops the charging when the target soc is reached and adds the next
+        cheapest slots to the plan when the car falls behind, the plan that
+        is already made is kept as it is.
+        """
+        if not self.chargeplan:
+            self.monitor_socs.clear()
+            return
+        soc = self.mirror.get("car_battery")
+        if soc is None:
+            return
+
+        now = self.datetime(aware=True)
+        ts = now.timestamp()
+        target = float(self.args.get("car_target_soc", 100))
+        if soc >= target:
+            self.log("The car is at %s%% stopping the chargeplan", soc, level="INFO")
+            self.cancel_change_plans()
+            self.stop_charge()
+            self.notify("The car is charged to %s%%, stopped charging" % soc)
+            return
+
+        if not self.monitor_socs or self.monitor_socs[-1][1] != soc:
+            self.monitor_socs.append((ts, soc))
+        # Only the last hour is used for the charge rate.
+        while self.monitor_socs and self.monitor_socs[0][0] < ts - 3600:
+            self.monitor_socs.pop(0)
+
+        battery_kwh = float(self.args["car_battery_size_kwh"])
+        kw = float(self.args.get("car_onboard_charger_kwh", 11.0))
+        # The rate the battery has been charged with, the planned rate until we know.
+        rate = kw if self.charge_curve is None else self.charge_curve.battery_kw(soc, kw, kw)
+        if len(self.monitor_socs) > 1:
+            (ts0, soc0), (ts1, soc1) = self.monitor_socs[0], self.monitor_socs[-1]
+            if ts1 - ts0 >= 900 and soc1 > soc0:
+                rate = (soc1 - soc0) / 100 * battery_kwh * 3600 / (ts1 - ts0)
+
+        seconds_left = sum(
+            max(0.0, (end - max(start, now)).total_seconds()) for start, end in self.chargeplan
+        )
+        need = (target - soc) / 100 * battery_kwh
+        expected = rate * seconds_left / 3600
+        self.log(
+            "Soc %s%% needs %s kwh the plan has %ss left at %skw",
+            soc,
+            need,
+            seconds_left,
+            rate,
+            level="DEBUG",
+        )
+        if expected >= need * 0.95 or rate <= 0:
+            return
+        if self.charge_profile:
+            # The start/stop of the extension would be outside the profile
+            # and get 0A, a current profile is only stopped when it is done.
+            self.log("The car is behind the charge profile", level="INFO")
+            return
+
+        plan = self.extend_chargeplan((need - expected) / rate, now)
+        if plan is not None:
+            self.log("The car is behind the plan, extended it to %s", plan, level="INFO")
+            self.chargeplan = plan
+            self.schedule_chargeplan(plan)
+
+    def extend_chargeplan(self, hours, now):
+        """The chargeplan with the cheapest free time before ready_at added
+        until there is hours more, None if there is no free time."""
+        series = self.price_series()
+        ready_until = self.get_ready_until(now)
+        first, last = series.window(
+            now.timestamp(),
+            ready_until.timestamp() if ready_until is not None else float("inf"),
+        )
+        planned = sorted((start.timestamp(), end.timestamp()) for start, end in self.chargeplan)
+
+        # The parts of the slots that isn't in the plan already.
+        free = []
+        for i in range(first, last):
+            start = max(series.starts[i], now.timestamp())
+            end = series.ends[i]
+            for p_start, p_end in planned:
+                if p_end <= start or p_start >= end:
+                    continue
+                if p_start > start:
+                    free.append((series.values[i], start, p_start, i))
+                start = max(start, p_end)
+            if start < end:
+                free.append((series.values[i], start, end, i))
+
+        need = hours * 3600
+        planned_starts = {start for start, _ in planned}
+        added = []
+        for value, start, end, i in sorted(free):
+            if need <= 0:
+                break
+            used = min(end - start, math.ceil(need / 60) * 60)
+            # Put a partial piece next to the plan so it doesn't add a start/stop.
+            if end in planned_starts:
+                start = end - used
+            else:
+                end = start + used
+            added.append(
+                {
+                    "start": series.to_datetime(start, i),
+                    "end": series.to_datetime(end, i),
+                }
+            )
+            need -= end - start
+
+        if not added:
+            return None
+        return get_continues_timespan(
+            [{"start": start, "end": end} for start, end in self.chargeplan] + added
+        )
+
+    def cb_vehicle_changed(self, entity, attribute, old, new, kwargs):
+        """Plan all the cars again when a car is connected or ready_at is changed."""
+        if old == new:
+            return
+        statuses = [vehicle.charger.status_entity for vehicle in self.vehicles]
+        if entity in statuses and "STANDBY" not in (old, new):
+            # Only connecting or disconnecting a car changes the plan.
+            return
+        self.create_joint_charge_plan()
+
+    def create_joint_charge_plan(self, *args, **kwargs):
+        """Plan the charging of all the vehicles together.
+
+        The plan is the max amps for each car in every slot, the load balancer
+        uses it as the limit for the charger of the car.
+        """
+        now = self.datetime(aware=True)
+        series = self.price_series()
+        kw_per_amp = self.amp_to_watt(1) / 1000
+
+        planned = []
+        latest = now.timestamp()
+        for vehicle in self.vehicles:
+            status = self.mirror.get(vehicle.charger.field("charger_status"))
+            soc = self.mirror.get(vehicle.field("car_battery"))
+            ready_at = self.parse_datetime(
+                self.mirror.get(vehicle.field("charger_ready_at")), aware=True
+            )
+            if status in (None, "STANDBY") or soc is None or ready_at is None:
+                self.schedule_vehicle_profile(vehicle, [])
+                continue
+            if ready_at < now:
+                ready_at += timedelta(days=1)
+            kwh = max(0.0, (vehicle.target_soc - soc) / 100 * vehicle.battery_kwh)
+            planned.append((vehicle, kwh, ready_at.timestamp()))
+            latest = max(latest, ready_at.timestamp())
+
+        if not planned:
+            return False
+
+        first, last = series.window(now.timestamp(), latest)
+        # What is left for the cars in each slot after the house usage, never
+        # more than the main fuse when there is no load profile.
+        fuse_kw = self.amp_to_watt(
+            self.args["main_fuse"] * float(self.args.get("main_fuse_limit", 0.9))
+        ) / 1000
+        total_kw = min(sum(vehicle.max_kw for vehicle, _, _ in planned), fuse_kw)
+        capacity = [
+            self.slot_charge_rate(series, i, series.starts[i], total_kw)
+            for i in range(first, last)
+        ]
+        allocation, unmet = plan_vehicles(
+            series,
+            first,
+            last,
+            [
+                (kwh, series.window(now.timestamp(), until)[1], vehicle.max_kw)
+                for vehicle, kwh, until in planned
+            ],
+            capacity,
+        )
+
+        msg = []
+        for (vehicle, kwh, until), kwhs, missing in zip(planned, allocation, unmet):
+            profile = []
+            cost = 0.0
+            for t, slot_kwh in enumerate(kwhs):
+                if slot_kwh <= 1e-6:
+                    continue
+                i = first + t
+                hours = (series.ends[i] - series.starts[i]) / 3600
+                amps = math.ceil(slot_kwh / hours / kw_per_amp)
+                profile.append((series.starts[i], series.ends[i], max(amps, 6)))
+                cost += slot_kwh * series.values[i]
+            self.schedule_vehicle_profile(vehicle, profile)
+            if self.decisions is not None:
+                self.decisions.record(
+                    TRACE_PLAN,
+                    0,
+                    self.balanced_chargers.index(vehicle.charger) + 1,
+                    now.timestamp(),
+                    kwh,
+                    sum(end - start for start, end, _ in profile) / 3600,
+                    cost,
+                    len(profile),
+                    missing,
+                )
+            msg.append(
+                "%s: %.1f kwh in %s slots cost %.2f %s"
+                % (vehicle.name, kwh - missing, len(profile), cost, series.currency)
+            )
+            if missing > 0.01:
+                msg.append("%s: can't charge %.1f kwh before ready_at" % (vehicle.name, missing))
+
+        self.notify("\n".join(msg), title="Created joint chargeplan")
+        return True
+
+    def schedule_vehicle_profile(self, vehicle, profile):
+        """Set the profile of the vehicle and make the timers that sets the
+        dynamic current of its charger match it, like schedule_charge_profile.
+
+        The balancer leaves a paused charger alone, so without the timers a
+        car paused between two slots would never start again.
+        """
+        vehicle.set_profile(profile)
+        tz = self.datetime(aware=True).tzinfo
+        now = self.get_now_ts()
+        old_timers = self.vehicle_profile_handles.get(vehicle.name, {})
+        # (time, amps) for every change of the amps, 0 when there is a gap.
+        changes = []
+        previous_end = None
+        for start, end, amps in profile:
+            if previous_end is not None and previous_end < start:
+                changes.append((previous_end, 0))
+            if not changes or changes[-1][1] != amps:
+                changes.append((start, amps))
+            previous_end = end
+        if previous_end is not None:
+            changes.append((previous_end, 0))
+
+        handles = {}
+        for i, (at, amps) in enumerate(changes):
+            key = (at, amps)
+            handle = old_timers.pop(key, None)
+            if handle is None:
+                if at > now:
+                    handle = self.run_at(
+                        self.cb_vehicle_profile_timer,
+                        datetime.fromtimestamp(at, tz),
+                        vehicle=vehicle.name,
+                        at=at,
+                        amps=amps,
+                    )
+                elif i + 1 < len(changes) and changes[i + 1][0] > now:
+                    # We are already in this part of the plan.
+                    handle = self.run_in(
+                        self.cb_vehicle_profile_timer, 0, vehicle=vehicle.name, at=at, amps=amps
+                    )
+                else:
+                    continue
+            handles[key] = handle
+
+        for handle in old_timers.values():
+            self.cancel_timer(handle)
+        self.vehicle_profile_handles[vehicle.name] = handles
+
+    def cb_vehicle_profile_timer(self, kwargs):
+        """Set the dynamic current of a planned car for the next slot."""
+        amps = kwargs["amps"]
+        self.vehicle_profile_handles.get(kwargs["vehicle"], {}).pop(
+            (kwargs["at"], amps), None
+        )
+        for vehicle in self.vehicles:
+            if vehicle.name == kwargs["vehicle"]:
+                self.set_circuit_current_limit(amps, charger=vehicle.charger)
+
+    def create_charge_profile(self, series, first, last, kwh):
+        """Plan the amps for every slot and charge in a single session."""
+        kw_per_amp = self.amp_to_watt(1) / 1000
+        profile = self.charge_planner().charge_profile(series, first, last, kwh)
+        if not profile:
+            return False
+
+        nor_str_format = "%d.%m.%Y %H:%M:%S"
+        cost = 0.0
+        msg = []
+        charge_profile = []
+        for i, start, end, amps in profile:
+            start = series.to_datetime(start, i)
+            end = series.to_datetime(end, i)
+            charge_profile.append((start, end, amps))
+            cost += series.values[i] * amps * kw_per_amp * (end - start).total_seconds() / 3600
+            msg.append(f"{start.strftime(nor_str_format)} {amps}A price: {series.values[i]}")
+
+        # Slots in between that isn't used gets 0A, that pauses the charger.
+        full_profile = []
+        for start, end, amps in charge_profile:
+            if full_profile and full_profile[-1][1] < start:
+                full_profile.append((full_profile[-1][1], start, 0))
+            full_profile.append((start, end, amps))
+
+        self.notify("\n".join(msg), title="Created charge profile")
+        self.log("Total cost should be %s %s", cost, series.currency, level="DEBUG")
+        if self.decisions is not None:
+            self.decisions.record(
+                TRACE_PLAN,
+                0,
+                0,
+                self.get_now_ts(),
+                kwh,
+                sum((end - start).total_seconds() for start, end, _ in charge_profile) / 3600,
+                cost,
+                len(charge_profile),
+                0.0,
+            )
+        self.chargeplan = [(full_profile[0][0], full_profile[-1][1])]
+        self.charge_profile = full_profile
+        return True
+
+    def charge_planner(self):
+        """The ChargePlanner for the car in the config."""
+        rate = None
+        if self.load_profile is not None or self.capacity is not None:
+            rate = self.slot_charge_rate
+        max_sessions = self.args.get("charge_max_sessions")
+        return ChargePlanner(
+            float(self.args["car_battery_size_kwh"]),
+            max_kw=float(self.args.get("car_onboard_charger_kwh", 11.0)),
+            target_soc=float(self.args.get("car_target_soc", 100)),
+            session_penalty=float(self.args.get("charge_session_penalty", 0)),
+            max_sessions=None if max_sessions is None else int(max_sessions),
+            min_session_minutes=float(self.args.get("charge_min_session_minutes", 0)),
+            current_loss=float(self.args.get("charge_current_loss", 0.005)),
+            max_amps=self.mirror.get("max_circuit_current", 32.0),
+            kw_per_amp=self.amp_to_watt(1) / 1000,
+            curve=self.charge_curve,
+            rate=rate,
+            log=self.log,
+        )
+
+    def pick_charge_slots(self, series, first, last, hours, kwh=None):
+        """Pick the slots to charge in, see ChargePlanner.pick_charge_slots.
+
+        The capacity tariff is ignored if the car can't be charged without it.
+        """
+        segments, short = self.charge_planner().pick_charge_slots(
+            series, first, last, hours, self.mirror.get("car_battery", 0.0), kwh=kwh
+        )
+        if short and self.capacity is not None and not self.capacity_override:
+            # The car is more important then the capacity tariff.
+            self.log(
+                "Can't reach the soc without a new peak, ignoring the capacity tariff",
+                level="INFO",
+            )
+            self.capacity_override = True
+            return self.pick_charge_slots(series, first, last, hours, kwh=kwh)
+        return segments
+
+    def slot_charge_rate(self, series, i, start, kw):
+        """The kw we can expect to charge with at start in slot i given the
+        house usage in the load profile and the capacity tariff."""
+        house = None
+        if self.load_profile is not None:
+            house = self.load_profile.percentile(
+                series.to_datetime(start, i),
+                float(self.args.get("load_profile_percentile", 90)),
+            )
+        rate = kw
+        if house is not None:
+            fuse = self.args["main_fuse"] * float(self.args.get("main_fuse_limit", 0.9))
+            rate = min(rate, self.amp_to_watt(fuse - house) / 1000)
+        if self.capacity is not None and not self.capacity_override:
+            house_kw = 0.0 if house is None else self.amp_to_watt(house) / 1000
+            rate = min(rate, self.capacity.allowed_kwh() - house_kw)
+        return max(0.0, rate)
+
+    def create_load_balance_controller(self, mode):
+        """Create the controller used by check_load."""
+        if mode == "pi":
+            return PIController(
+                kp=float(self.args.get("load_balance_kp", 0.5)),
+                ki=float(self.args.get("load_balance_ki", 0.05)),
+                deadband=float(self.args.get("load_balance_deadband", 1.0)),
+                slew_up=float(self.args.get("load_balance_slew_up", 0.5)),
+                integral_max=float(self.args.get("load_balance_integral_max", 10.0)),
+            )
+        elif mode == "step":
+            return StepController()
+        raise ValueError("Unknown load_balance_mode %s" % mode)
+
+    def fuse_limit_amps(self, house_usage_in_amps, now):
+        """The max amps we allow on the main fuse.
+
+        Without a forecast this is main_fuse * main_fuse_limit, with it the
+        margin follows the forecast of the house usage.
+        """
+        main_fuse = self.args["main_fuse"]
+        if self.load_forecast is None:
+            limit = main_fuse * float(self.args.get("main_fuse_limit", 0.9))
+        else:
+            self.load_forecast.add(now, house_usage_in_amps)
+            margin = max(
+                float(self.args.get("load_balance_min_margin", 2.0)),
+                self.load_forecast.margin(
+                    float(self.args.get("load_balance_forecast_horizon", 10)),
+                    float(self.args.get("load_balance_forecast_percentile", 95)),
+                ),
+            )
+            self.log("Keeping a margin of %sA to the main fuse", margin, level="DEBUG")
+            limit = main_fuse - margin
+
+        if self.capacity is not None and not self.capacity_override:
+            limit = min(limit, self.capacity_limit_amps(now))
+        return limit
+
+    def capacity_limit_amps(self, now):
+        """The amps we can use for the rest of the hour without making a new peak."""
+        capacity = self.capacity
+        seconds_left = (capacity.hour_end or now) - now
+        if seconds_left <= 0:
+            return float("inf")
+        kwh_left = capacity.allowed_kwh() - capacity.hour_kwh
+        return max(0.0, self.watt_to_amp(kwh_left * 3600000 / seconds_left))
+
     def watt_to_amp(self, value):
         return float(value) / self.args["volt"] / math.sqrt(self.args["phase"])
 
@@ -604,35 +1983,67 @@ class EaseeChargebot(hass.Hass):
         return value * self.args["volt"] * math.sqrt(self.args["phase"])
 
     @app_lock
+    @timed("check_load")
     def check_load(self, pw_state):
-        """helper to check the load of the power usage and see if we need to limit the amp to the charger."""
+        """helper to check the load of the power usage and see if we need to
+        limit the amp to the charger."""
+        if self.balanced_chargers:
+            return self.check_load_chargers(pw_state)
+        if self.phase_controllers and self.check_load_phases():
+            return
 
-        # I dont know why this is needed, seems to be some kind of race condition.
-        esn = self.args["entity_start_name"]
-        max_main_fuse_amps = self.args["main_fuse"] * 0.9
         total_usage_in_amps = self.watt_to_amp(pw_state)
+        now = self.get_now_ts()
 
         # How many amps are the charger using right now.
-        charger_usage_amps = float(self.get_state("sensor.%s_in_current" % esn))
+        # If the sensor is unavailable we assume the charger uses nothing,
+        # that way all the usage is counted as house usage and we err on the safe side.
+        if self.mirror.is_unavailable("charger_current"):
+            # Only logged when it goes unavailable, not on every tick.
+            if self._charger_current_stale is False:
+                self._charger_current_stale = True
+                self.log(
+                    "Charger current is unavailable, assuming the charger uses 0A",
+                    level="WARNING",
+                )
+            charger_usage_amps = 0.0
+        else:
+            self._charger_current_stale = False
+            charger_usage_amps = self.mirror.get("charger_current", 0.0)
         # Max amps that can be used on the charger atm.
-        dynamic_circuit_current_limit = float(
-            self.get_state("sensor.%s_dynamic_circuit_current" % esn)
-        )
-        charger_current_max_amps = float(
-            self.get_state("sensor.%s_max_circuit_current" % esn)
-        )
+        dynamic_circuit_current_limit = self.mirror.get("dynamic_circuit_current")
+        charger_current_max_amps = self.mirror.get("max_circuit_current", 0.0)
+        planned = self.planned_amps(now)
+        if planned is not None:
+            charger_current_max_amps = min(charger_current_max_amps, planned)
         # charger_current_max_amps = 16.0
 
         house_usage_in_amps = total_usage_in_amps - charger_usage_amps
-        # Right now we reserve 10% of the amps to create some kind of buffer
-        # that might be to much you have small fuse and 400 v.
-        # Make a config option.? # TODO
+        # Keep a buffer to the main fuse, either main_fuse_limit or from the forecast.
+        max_main_fuse_amps = self.fuse_limit_amps(house_usage_in_amps, now)
         amps_left = max_main_fuse_amps - house_usage_in_amps
 
         if self._loadbalancer_last_value is None:
             self._loadbalancer_last_value = 0  # dynamic_circuit_current_limit
 
-        if math.floor(amps_left) == math.floor(self._loadbalancer_last_value):
+        new_amp_limit = self.load_balance_controller.update(
+            amps_left, charger_current_max_amps, now, self._loadbalancer_last_value
+        )
+        if self.decisions is not None:
+            limit = self._loadbalancer_last_value if new_amp_limit is None else new_amp_limit
+            self.decisions.record(
+                TRACE_BALANCE,
+                (TRACE_PAUSED if limit < 6 else 0)
+                | (0 if new_amp_limit is None else TRACE_CHANGED),
+                0,
+                now,
+                total_usage_in_amps,
+                house_usage_in_amps,
+                charger_usage_amps,
+                amps_left,
+                limit,
+            )
+        if new_amp_limit is None:
             self.log(
                 "Has correct amps limit amps left %s last value %s",
                 amps_left,
@@ -640,9 +2051,10 @@ class EaseeChargebot(hass.Hass):
             )
             return
 
-        if amps_left < self._loadbalancer_last_value:
+        if new_amp_limit < self._loadbalancer_last_value:
             self.log(
-                "Need to limit the charger as we only got %sA (%sW) available but the charger can use %sA",
+                "Need to limit the charger as we only got %sA (%sW) available "
+                "but the charger can use %sA",
                 amps_left,
                 pw_state,
                 self._loadbalancer_last_value,
@@ -650,20 +2062,17 @@ class EaseeChargebot(hass.Hass):
             )
             # This is only for the logging, the charger should be paused if the amp is less then 6
             # maybe check what error code is used.
-            if amps_left < 6:
+            if new_amp_limit < 6:
                 self.log(
                     "Charger will paused because of amp %s < 6",
                     amps_left,
                     level="DEBUG",
                 )
                 self._charger_paused_by_loadbalance = True
-                amps_left = 5
-            new_amp_limit = min(amps_left, charger_current_max_amps)
             self.set_circuit_current_limit(new_amp_limit)
             self._loadbalancer_last_value = new_amp_limit
 
-        elif amps_left > self._loadbalancer_last_value:
-            new_amp_limit = min(amps_left, charger_current_max_amps)
+        else:
             self.log(
                 "Can increase the dynamic_circuit_current_limit %sA to current %sA",
                 self._loadbalancer_last_value,
@@ -678,7 +2087,8 @@ class EaseeChargebot(hass.Hass):
 
         self.log("Charger watt %s from sensor", self.amp_to_watt(charger_usage_amps))
         self.log(
-            "Using a total of %sA (%sW) amps house: %sA (%sW) main_fuse %sA charger: %sA (%sW) got %s left charger limit is %s fuse %s",
+            "Using a total of %sA (%sW) amps house: %sA (%sW) main_fuse %sA "
+            "charger: %sA (%sW) got %s left charger limit is %s fuse %s",
             total_usage_in_amps,
             self.amp_to_watt(total_usage_in_amps),
             house_usage_in_amps,
@@ -692,35 +2102,586 @@ class EaseeChargebot(hass.Hass):
             level="DEBUG",
         )
 
-    def simulate(self, fra=None, til=None):
-        """Grab the history, just do debugging, delete it later."""
+    def check_load_phases(self):
+        """Balance each phase on its own using the phase sensors.
 
-        if fra is None:
-            fra = "2020-10-24 00:00:00+02:00"
-        if til is None:
-            til = "2020-10-24 06:00:00+02:00"
+        Returns False if a phase sensor is stale, the caller should balance
+        on the total power usage instead.
+        """
+        now = self.get_now_ts()
+        max_age = self.args.get("state_max_age", 600)
+        names = ["phase_current_%s" % i for i in (1, 2, 3)]
+        if any(self.mirror.is_stale(name, now, max_age) for name in names):
+            if self._phase_stale is False:
+                self._phase_stale = True
+                self.log(
+                    "A phase sensor is stale, balancing on the total power usage",
+                    level="WARNING",
+                )
+                for controller in self.phase_controllers:
+                    controller.reset()
+            return False
+        self._phase_stale = False
+
+        if self.mirror.is_unavailable("charger_current"):
+            charger_usage_amps = 0.0
+        else:
+            charger_usage_amps = self.mirror.get("charger_current", 0.0)
+        charger_current_max_amps = self.mirror.get("max_circuit_current", 0.0)
+        planned = self.planned_amps(now)
+        if planned is not None:
+            charger_current_max_amps = min(charger_current_max_amps, planned)
+
+        if self._phase_last_values is None:
+            self._phase_last_values = [self._loadbalancer_last_value or 0] * 3
+
+        house = []
+        for i, name in enumerate(names):
+            charger_phase = "charger_phase_current_%s" % (i + 1)
+            if self.mirror.has(charger_phase) and not self.mirror.is_unavailable(
+                charger_phase
+            ):
+                charger_amps = self.mirror.get(charger_phase, 0.0)
+            else:
+                charger_amps = charger_usage_amps
+            house.append(self.mirror.get(name) - charger_amps)
+        # The forecast follows the most loaded phase.
+        max_main_fuse_amps = self.fuse_limit_amps(max(house), now)
+
+        phases = []
+        changed = False
+        for controller, last_value, house_amps in zip(
+            self.phase_controllers, self._phase_last_values, house
+        ):
+            new_amp_limit = controller.update(
+                max_main_fuse_amps - house_amps, charger_current_max_amps, now, last_value
+            )
+            if new_amp_limit is None:
+                phases.append(last_value)
+            else:
+                phases.append(new_amp_limit)
+                changed = True
 
-        stop_at = datetime.fromisoformat(til)
-        data = self.get_history(
-            entity_id="sensor.mqtt_relay_energy_usage", start_time=fra
+        self.log(
+            "House usage per phase %s limits %s changed %s", house, phases, changed,
+            level="DEBUG",
         )
+        lowest = min(phases)
+        if self.decisions is not None:
+            self.decisions.record(
+                TRACE_PHASES,
+                (TRACE_PAUSED if lowest < 6 else 0) | (TRACE_CHANGED if changed else 0),
+                0,
+                now,
+                max(self.mirror.get(name) for name in names),
+                max(house),
+                charger_usage_amps,
+                max_main_fuse_amps - max(house),
+                lowest,
+            )
+        if not changed:
+            return True
+
+        if lowest < 6:
+            self._charger_paused_by_loadbalance = True
+        elif lowest > 6:
+            self._charger_paused_by_loadbalance = False
+        self.set_circuit_current_limit(lowest, phases=phases)
+        return True
 
-        for d in data:
-            for z in d:
-                dt = datetime.fromisoformat(z["last_changed"])
+    def check_load_chargers(self, pw_state):
+        """Split what is left on the main fuse between all the balanced chargers.
 
-                if dt > stop_at:
-                    break
-                else:
-                    self.check_load(z["state"])
+        Every charger gets at most one dynamic current update for each call.
+        """
+        total_usage_in_amps = self.watt_to_amp(pw_state)
+        now = self.get_now_ts()
+
+        chargers_usage_amps = 0.0
+        active = []
+        for charger in self.balanced_chargers:
+            # A unavailable charger counts as 0A so all the usage is seen as house usage.
+            if self.mirror.is_unavailable(charger.field("charger_current")):
+                if charger.stale is False:
+                    charger.stale = True
+                    self.log(
+                        "Charger current for %s is unavailable, assuming it uses 0A",
+                        charger.name,
+                        level="WARNING",
+                    )
+            else:
+                charger.stale = False
+                chargers_usage_amps += self.mirror.get(charger.field("charger_current"), 0.0)
+
+            status = self.mirror.get(charger.field("charger_status"))
+            if status is not None and not self.charger_idle(
+                status, self.balancer_paused(charger)
+            ):
+                active.append(charger)
+
+        house_usage_in_amps = total_usage_in_amps - chargers_usage_amps
+        max_main_fuse_amps = self.fuse_limit_amps(house_usage_in_amps, now)
+        amps_left = max_main_fuse_amps - house_usage_in_amps
+        max_amps = [
+            self.mirror.get(charger.field("max_circuit_current"), 0.0) for charger in active
+        ]
+        # The joint chargeplan is the limit for the chargers of the planned cars.
+        for vehicle in self.vehicles:
+            planned = vehicle.planned_amps(now)
+            if planned is not None and vehicle.charger in active:
+                n = active.index(vehicle.charger)
+                max_amps[n] = min(max_amps[n], planned)
+        split = split_headroom(
+            amps_left,
+            [(m, charger.weight) for m, charger in zip(max_amps, active)],
+            policy=self.args.get("load_balance_policy", "fair"),
+        )
+
+        for charger, charger_max_amps, amps in zip(active, max_amps, split):
+            if charger.last_value is None:
+                charger.last_value = 0
+            new_amp_limit = charger.controller.update(
+                amps, charger_max_amps, now, charger.last_value
+            )
+            if self.decisions is not None:
+                limit = charger.last_value if new_amp_limit is None else new_amp_limit
+                self.decisions.record(
+                    TRACE_BALANCE,
+                    (TRACE_PAUSED if limit < 6 else 0)
+                    | (0 if new_amp_limit is None else TRACE_CHANGED),
+                    self.balanced_chargers.index(charger) + 1,
+                    now,
+                    total_usage_in_amps,
+                    house_usage_in_amps,
+                    self.mirror.get(charger.field("charger_current"), 0.0),
+                    amps,
+                    limit,
+                )
+            if new_amp_limit is None:
+                continue
+            if new_amp_limit < 6:
+                charger.paused = True
+            elif new_amp_limit > 6:
+                charger.paused = False
+            self.set_circuit_current_limit(new_amp_limit, charger=charger)
+
+        self.log(
+            "Using a total of %sA house: %sA chargers: %sA got %sA left split %s",
+            total_usage_in_amps,
+            house_usage_in_amps,
+            chargers_usage_amps,
+            amps_left,
+            dict(zip((charger.name for charger in active), split)),
+            level="DEBUG",
+        )
+
+    def balancer_paused(self, charger):
+        """True if the balancer (or the joint chargeplan) has the charger under 6A."""
+        return bool(charger.paused) or (charger.last_value is not None and charger.last_value < 6)
+
+    def charger_idle(self, status, balancer_paused):
+        """True if there is no car or the charger is paused by something else
+        then the load balancer. A charger we paused is not idle, it has to get
+        the current back when there is room for it again."""
+        return status == "STANDBY" or (status == "PAUSED" and not balancer_paused)
+
+    def export_trace(self, *args, **kwargs):
+        """Dump the recorded history of every entity the app uses to a jsonl file
+        that can be replayed offline using replay.py.
+
+        Use fra and til to select the period, defaults to the last 24 hours.
+        """
+        til = kwargs.get("til")
+        til = self.datetime(aware=True) if til is None else datetime.fromisoformat(til)
+        fra = kwargs.get("fra")
+        fra = til - timedelta(days=1) if fra is None else datetime.fromisoformat(fra)
+        filename = kwargs.get(
+            "filename",
+            os.path.join(
+                os.path.dirname(os.path.abspath(__file__)),
+                "trace_%s.jsonl" % fra.strftime("%Y%m%d%H%M"),
+            ),
+        )
+
+        entities = set(self.mirror.entities())
+        if self.args.get("power_price_entity"):
+            entities.add(self.args["power_price_entity"])
+
+        events = []
+        for entity in entities:
+            for states in self.get_history(
+                entity_id=entity, start_time=fra, end_time=til
+            ):
+                for state in states:
+                    events.append(
+                        (
+                            parse_timestamp(state.get("last_updated"), 0),
+                            {
+                                "ts": state.get("last_updated"),
+                                "entity_id": entity,
+                                "state": state.get("state"),
+                                "attributes": state.get("attributes", {}),
+                            },
+                        )
+                    )
+
+        events.sort(key=itemgetter(0))
+        with open(filename, "w") as f:
+            for _, event in events:
+                f.write(json.dumps(event, separators=(",", ":")))
+                f.write("\n")
+
+        self.log("Wrote %s events to %s", len(events), filename)
+        return filename
+
+    def dump_decision_trace(self, *args, **kwargs):
+        """Write the recorded load balancer decisions and plans to
+        decision_trace_dump or filename, decode it with decode_trace.py."""
+        if self.decisions is None:
+            self.log("decision_trace_size is 0, nothing is recorded", level="WARNING")
+            return None
+        filename = kwargs.get("filename") or self.args.get("decision_trace_dump")
+        if not filename:
+            filename = os.path.join(
+                os.path.dirname(os.path.abspath(__file__)),
+                "chargebot_%s_decisions.bin" % self.name,
+            )
+        meta = {
+            "app": self.name,
+            "sources": ["main"] + [charger.name for charger in self.balanced_chargers],
+            "main_fuse": self.args.get("main_fuse"),
+            "main_fuse_limit": self.args.get("main_fuse_limit", 0.9),
+        }
+        with open(filename, "wb") as f:
+            f.write(self.decisions.dump(meta))
+        self.log(
+            "Wrote %s decisions to %s",
+            min(self.decisions.recorded, self.decisions.size),
+            filename,
+        )
+        return filename
 
+    def compare_load_balancers(self, *args, **kwargs):
+        """Compare the step and pi controller on the recorded power usage.
+
+        Use fra and til to select the period, defaults to the last 24 hours.
+        """
+        til = kwargs.get("til")
+        til = self.datetime(aware=True) if til is None else datetime.fromisoformat(til)
+        fra = kwargs.get("fra")
+        fra = til - timedelta(days=1) if fra is None else datetime.fromisoformat(fra)
+
+        result = compare_controllers(
+            self.house_usage_history(fra, til)[0],
+            {
+                "step": self.create_load_balance_controller("step"),
+                "pi": self.create_load_balance_controller("pi"),
+            },
+            self.args["main_fuse"],
+            max_amps=self.mirror.get("max_circuit_current", 32.0),
+            car_max_amps=self.watt_to_amp(
+                float(self.args.get("car_onboard_charger_kwh", 11.0)) * 1000
+            ),
+        )
+        for name, res in result.items():
+            self.log(
+                "%s: %s commands %.2fAh delivered %ss over the main fuse",
+                name,
+                res["commands"],
+                res["amp_hours"],
+                res["overload_seconds"],
+            )
+        return result
+
+    def publish_metrics(self, kwargs):
+        """Write the metrics to metrics_file and/or the metrics sensors."""
+        now = self.get_now_ts()
+        with self.command_lock:
+            queue = self.command_queue.stats()
+
+        if self.metrics_file:
+            tmp = self.metrics_file + ".tmp"
+            try:
+                with open(tmp, "w") as f:
+                    f.write(self.metrics.prometheus(self.name, now, queue))
+                os.replace(tmp, self.metrics_file)
+            except OSError as e:
+                self.log("Failed to write %s %s", self.metrics_file, e, level="WARNING")
+
+        if not self.args.get("metrics_sensors", False):
+            return
+        metrics = self.metrics
+        latency = {}
+        # The event loop can add a name while this runs.
+        for name in sorted(metrics.buckets):
+            p95 = metrics.percentile(name, 95)
+            latency[name] = {
+                "calls": metrics.count(name),
+                "avg_ms": round(metrics.sums[name] / metrics.count(name) * 1000, 3),
+                "p95_ms": None if p95 == float("inf") else p95 * 1000,
+            }
+        check_load = latency.get("check_load", {})
+        self.set_state(
+            "sensor.chargebot_%s_latency_ms" % self.name,
+            state=check_load.get("avg_ms", 0.0),
+            attributes={"unit_of_measurement": "ms", **latency},
+        )
+        self.set_state(
+            "sensor.chargebot_%s_commands_per_hour" % self.name,
+            state=metrics.commands_last_hour(now),
+            attributes={
+                "unit_of_measurement": "commands/h",
+                "sent": metrics.commands_total,
+                "failed": queue["failed"],
+                "retries": queue["retries"],
+                "queue_depth": queue["depth"],
+            },
+        )
+        paused = {
+            key: round(metrics.paused_total(key, now) / 60, 1)
+            for key in metrics.paused_keys()
+        }
+        self.set_state(
+            "sensor.chargebot_%s_paused_minutes" % self.name,
+            state=round(sum(paused.values()), 1),
+            attributes={"unit_of_measurement": "min", **paused},
+        )
+
+    def house_usage_history(self, fra, til, charger_amps=0.0):
+        """The house usage in amps between fra and til from the recorder as a
+        list of (timestamp, amps), the charger usage is removed.
+
+        charger_amps is the charger current at fra, returns the trace and
+        the charger current at til so the next period can continue from it.
+        """
+        esn = self.args["entity_start_name"]
+        events = []
+        for entity, key in (
+            (self.args["power_usage_in_w"], "total"),
+            ("sensor.%s_in_current" % esn, "charger"),
+        ):
+            for states in self.get_history(
+                entity_id=entity, start_time=fra, end_time=til
+            ):
+                for state in states:
+                    ts = parse_timestamp(state.get("last_changed"))
+                    try:
+                        value = float(state["state"])
+                    except (TypeError, ValueError):
+                        continue
+                    if ts is not None:
+                        events.append((ts, key, value))
+
+        # Build a trace of the house usage, the charger usage is removed as it
+        # depends on the controller.
+        trace = []
+        for ts, key, value in sorted(events):
+            if key == "charger":
+                charger_amps = value
+            else:
+                trace.append((ts, self.watt_to_amp(value) - charger_amps))
+        return trace, charger_amps
+
+    def read_charge_curve(self):
+        """Read the learned charge curve, the default curve until there is one."""
+        if self.charge_curve_file is not None and os.path.exists(self.charge_curve_file):
+            try:
+                with open(self.charge_curve_file) as f:
+                    return ChargeCurve.from_dict(json.load(f))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                self.log(
+                    "Failed to read %s %s", self.charge_curve_file, e, level="WARNING"
+                )
+        return ChargeCurve()
+
+    def update_charge_curve(self, kwargs):
+        """Learn the charge curve from the soc and the charger current in the recorder."""
+        til = self.datetime(aware=True)
+        fra = til - timedelta(days=float(self.args.get("charge_curve_days", 30)))
+        esn = self.args["entity_start_name"]
+        events = []
+        for entity, key in (
+            (self.args["car_battery_sensor_entity"], "soc"),
+            ("sensor.%s_in_current" % esn, "charger"),
+        ):
+            for states in self.get_history(
+                entity_id=entity, start_time=fra, end_time=til
+            ):
+                for state in states:
+                    ts = parse_timestamp(state.get("last_changed"))
+                    try:
+                        value = float(state["state"])
+                    except (TypeError, ValueError):
+                        continue
+                    if ts is not None:
+                        events.append((ts, key, value))
+
+        samples = []
+        soc = None
+        kw = 0.0
+        for ts, key, value in sorted(events):
+            if key == "soc":
+                soc = value
+            else:
+                kw = self.amp_to_watt(value) / 1000
+            if soc is not None:
+                samples.append((ts, soc, kw))
+
+        curve = calibrate_charge_curve(
+            samples,
+            float(self.args["car_battery_size_kwh"]),
+            float(self.args.get("car_onboard_charger_kwh", 11.0)),
+        )
+        if curve is None:
+            self.log("Not enough charging to learn the charge curve", level="DEBUG")
+            return
+
+        self.charge_curve = curve
+        if self.charge_curve_file is not None:
+            try:
+                with open(self.charge_curve_file, "w") as f:
+                    json.dump(curve.to_dict(), f)
+            except OSError as e:
+                self.log("Failed to write %s %s", self.charge_curve_file, e, level="WARNING")
+        self.log("Learned the charge curve %s", curve.to_dict(), level="INFO")
+
+    def read_load_profile(self):
+        """Read the stored load profile, a empty one if there is none."""
+        if os.path.exists(self.load_profile_file):
+            try:
+                with open(self.load_profile_file) as f:
+                    return LoadProfile.from_dict(json.load(f))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                self.log(
+                    "Failed to read %s %s", self.load_profile_file, e, level="WARNING"
+                )
+        return LoadProfile()
+
+    def update_load_profile(self, kwargs):
+        """Add the history since the last update to the load profile.
+
+        The history is read one chunk at a time so a long period never has
+        to be in memory at once.
+        """
+        profile = self.load_profile
+        now = self.datetime(aware=True)
+        tz = now.tzinfo
+        now = now.timestamp()
+        days = float(self.args.get("load_profile_days", 28))
+        chunk = float(self.args.get("load_profile_chunk_hours", 24)) * 3600
+
+        fra = now - days * 24 * 3600
+        if profile.last_ts is not None:
+            profile.decay(0.5 ** ((now - profile.last_ts) / (days * 24 * 3600)))
+            fra = max(fra, profile.last_ts)
+
+        previous = None
+        samples = 0
+        charger_amps = 0.0
+        while fra < now:
+            til = min(fra + chunk, now)
+            trace, charger_amps = self.house_usage_history(
+                datetime.fromtimestamp(fra, tz), datetime.fromtimestamp(til, tz), charger_amps
+            )
+            for ts, amps in trace:
+                if previous is not None:
+                    profile.add(previous[0], ts, previous[1], tz)
+                previous = (ts, amps)
+                samples += 1
+            fra = til
+        if previous is not None:
+            profile.add(previous[0], now, previous[1], tz)
+        profile.last_ts = now
+
+        try:
+            with open(self.load_profile_file, "w") as f:
+                json.dump(profile.to_dict(), f, separators=(",", ":"))
+        except OSError as e:
+            self.log("Failed to write %s %s", self.load_profile_file, e, level="WARNING")
+        self.log("Added %s samples to the load profile", samples, level="DEBUG")
+
+    @timed("load_balance_cb")
     def load_balance_cb(self, entity, attribute, old, new, kwargs):
-        """Callback that use called when a new power usage is posted in ha."""
+        """Callback that use called when a new power usage is posted in ha.
+
+        This only adds the sample to the sampler, the balancing is done in
+        load_balance_tick.
+        """
+        now = self.get_now_ts()
+        self.sampler.add(new, now)
+        if self.capacity is not None:
+            try:
+                watt = float(new)
+            except (TypeError, ValueError):
+                pass
+            else:
+                if self.capacity.add(now, watt, self.capacity_tz):
+                    self.log(
+                        "Peaks this month %s", self.capacity.top(), level="DEBUG"
+                    )
+                    self.save_plan_store()
+        # A tick of 0 means that we should balance on every sample.
+        if self.load_balance_tick_interval <= 0:
+            self.load_balance_tick({})
+
+    def load_balance_tick(self, kwargs):
+        """Run the load balancer on the samples collected since the last tick."""
         # Quick check to see if need to compute anything.
-        use_balance = self.get_state(self.args["load_balance"])
-        charger_status = self.get_state(self.args["charger_status_entity"])
+        use_balance = self.mirror.get("load_balance")
+        if self.balanced_chargers:
+            idle = all(
+                self.charger_idle(
+                    self.mirror.get(charger.field("charger_status")),
+                    self.balancer_paused(charger),
+                )
+                for charger in self.balanced_chargers
+            )
+        else:
+            idle = self.charger_idle(
+                self.mirror.get("charger_status"), self._charger_paused_by_loadbalance is True
+            )
         # Cba loadbalance if the charger is idle.
-        if charger_status in ("STANDBY", "PAUSED") or use_balance == "off":
+        if idle or use_balance == "off":
+            self.sampler.discard()
             return
-        if old != new:
-            self.check_load(new)
+
+        window = self.sampler.take()
+        if window is None:
+            # No new samples, make sure the meter hasn't died on us.
+            max_age = float(self.args.get("power_usage_max_age", 60))
+            if self.mirror.is_stale("power_usage", self.get_now_ts(), max_age):
+                if self._power_usage_stale is False:
+                    self._power_usage_stale = True
+                    fallback = float(self.args.get("load_balance_fallback_amps", 6))
+                    self.log(
+                        "No power usage for %ss, setting the charger to at most %sA",
+                        max_age,
+                        fallback,
+                        level="WARNING",
+                    )
+                    # We are blind, the fallback can only lower the current.
+                    if self.balanced_chargers:
+                        for charger in self.balanced_chargers:
+                            last = charger.last_value
+                            self.set_circuit_current_limit(
+                                fallback if last is None else min(fallback, last),
+                                charger=charger,
+                            )
+                    else:
+                        last = self._loadbalancer_last_value
+                        self.set_circuit_current_limit(
+                            fallback if last is None else min(fallback, last)
+                        )
+            return
+
+        self._power_usage_stale = False
+        self.log(
+            "Balancing on %s samples (last %s max %s ewma %s) %s",
+            window["count"],
+            window["last"],
+            window["max"],
+            window["ewma"],
+            self.sampler.stats(),
+            level="DEBUG",
+        )
+        self.check_load(window[self.args.get("load_balance_sample", "max")])
@@ -0,0 +1,1859 @@
+"""
+The parts of the chargebot that doesn't need appdaemon or home assistant.
+
+Price parsing, the planners, the load balancer controllers and the queues
+are plain python so they can be used (and tested) without ha, see plan.py.
+chargebot.py is the appdaemon app on top of this.
+"""
+import json
+import math
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from heapq import heapify, heappop, heappush
+from itertools import count
+from operator import itemgetter
+
+
+def get_continues_timespan(data):
+    """Merge slots that follow each other into (start, end) timespans.
+
+    The slots can have any length, two slots are merged when the first ends
+    where the next one starts.
+    """
+    result = []
+    for d in sorted(data, key=itemgetter("start")):
+        if result and result[-1][1] == d["start"]:
+            result[-1] = (result[-1][0], d["end"])
+        else:
+            result.append((d["start"], d["end"]))
+
+    return result
+
+
+def pick_cheapest_slots(series, first, last, hours):
+    """Pick the cheapest slots between first and last until we have enough time
+    to charge for hours.
+
+    The last slot we need is only used partially, the part that is used is put
+    next to a picked neighbour so it doesn't create a extra start/stop. With no
+    picked neighbour the whole slot is used, a few minutes on its own would be
+    a start/stop for nothing and the car stops by itself when it is full.
+    Returns a list of (index, start_ts, end_ts) sorted by time.
+    """
+    need = hours * 3600
+    picked = {}
+    for i in sorted(range(first, last), key=series.values.__getitem__):
+        if need <= 0:
+            break
+        length = series.ends[i] - series.starts[i]
+        # Whole minutes is good enough.
+        used = min(length, math.ceil(need / 60) * 60)
+        picked[i] = used
+        need -= used
+
+    segments = []
+    for i in sorted(picked):
+        start = series.starts[i]
+        end = series.ends[i]
+        used = picked[i]
+        if used < end - start:
+            if i + 1 in picked and series.starts[i + 1] == end:
+                start = end - used
+            elif i - 1 in picked and series.ends[i - 1] == start:
+                end = start + used
+        segments.append((i, start, end))
+    return segments
+
+
+def plan_sessions(
+    series,
+    first,
+    last,
+    hours,
+    kw,
+    session_penalty=0.0,
+    max_sessions=None,
+    min_session_hours=0.0,
+):
+    """Find the cheapest way to charge for hours between slot first and last
+    where every charge session (a start/stop) costs session_penalty.
+
+    Solved exactly with dynamic programming over the slots in units of the
+    shortest slot, the state is (slot, units charged, sessions used) and a
+    transition is either skipping a slot or a whole session of contiguous
+    slots. Sessions must be at least min_session_hours long and max_sessions
+    limits the number of sessions. The time that is charged more then needed
+    is trimmed from the most expensive end of the last session as long as it
+    stays longer then min_session_hours.
+
+    Returns a list of (index, start_ts, end_ts) sorted by time like
+    pick_cheapest_slots or None if there is no solution.
+    """
+    if last <= first or hours <= 0:
+        return []
+
+    starts = series.starts
+    ends = series.ends
+    unit = min(ends[i] - starts[i] for i in range(first, last))
+    need = math.ceil(round(hours * 3600 / unit, 6))
+    min_units = math.ceil(round(min_session_hours * 3600 / unit, 6))
+    # Units and cost of the slots from first, so a session is O(1).
+    units = [0]
+    for i in range(first, last):
+        units.append(units[-1] + max(1, round((ends[i] - starts[i]) / unit)))
+
+    # Without a cap the number of sessions only matters for the penalty.
+    layers = 1 if max_sessions is None else max_sessions + 1
+    inf = float("inf")
+    n = last - first
+    # cost[i][s][j] the cheapest way to have j units using s sessions and be
+    # ready to start a new session at slot i.
+    cost = [[[inf] * (need + 1) for _ in range(layers)] for _ in range(n + 1)]
+    parent = {}
+    cost[0][0][0] = 0.0
+    best = (inf, None)
+
+    for i in range(n):
+        for s in range(layers):
+            row = cost[i][s]
+            ns = s if max_sessions is None else s + 1
+            for j in range(need):
+                c = row[j]
+                if c == inf:
+                    continue
+                # Skip this slot.
+                if c < cost[i + 1][s][j]:
+                    cost[i + 1][s][j] = c
+                    parent[(i + 1, s, j)] = ((i, s, j), None)
+
+                if ns >= layers:
+                    continue
+                # Charge from slot i to e.
+                for e in range(i + 1, n + 1):
+                    if e - 1 > i and starts[first + e - 1] != ends[first + e - 2]:
+                        # There is a hole in the prices, can't be one session.
+                        break
+                    u = units[e] - units[i]
+                    nj = j + u
+                    if u < min_units:
+                        continue
+                    nc = (
+                        c
+                        + series.window_cost(first + i, first + e) * kw
+                        + session_penalty
+                    )
+                    if nj >= need:
+                        if nc < best[0]:
+                            best = (nc, ((i, s, j), (i, e)))
+                        break
+
+                    # The slot after the session can't start a new one,
+                    # unless there is a hole in the prices.
+                    if e < n and starts[first + e] == ends[first + e - 1]:
+                        nxt = e + 1
+                    else:
+                        nxt = e
+                    if nxt <= n and nc < cost[nxt][ns][nj]:
+                        cost[nxt][ns][nj] = nc
+                        parent[(nxt, ns, nj)] = ((i, s, j), (i, e))
+
+    if best[1] is None:
+        return None
+
+    # Walk back to find the sessions.
+    sessions = [best[1][1]]
+    state = best[1][0]
+    while state in parent:
+        state, session = parent[state]
+        if session is not None:
+            sessions.append(session)
+    sessions.reverse()
+
+    segments = []
+    for i, e in sessions:
+        for k in range(first + i, first + e):
+            segments.append([k, starts[k], ends[k]])
+
+    # Trim what we don't need from the most expensive end of the last session.
+    over = sum(units[e] - units[i] for i, e in sessions) * unit - hours * 3600
+    i, e = sessions[-1]
+    over = min(over, (units[e] - units[i]) * unit - min_session_hours * 3600)
+    over = math.floor(over / 60) * 60
+    head = segments[-(e - i)]
+    tail = segments[-1]
+    for seg, at_start in sorted(
+        ((tail, False), (head, True)), key=lambda x: -series.values[x[0][0]]
+    ):
+        if over <= 0:
+            break
+        trim = min(over, seg[2] - seg[1] - 60)
+        if trim <= 0:
+            continue
+        if at_start:
+            seg[1] += trim
+        else:
+            seg[2] -= trim
+        over -= trim
+
+    return [tuple(seg) for seg in segments]
+
+
+def plan_current_profile(series, first, last, kwh, max_amps, kw_per_amp, loss=0.005, min_amps=6):
+    """Find the amps to charge with in every slot between first and last to
+    charge kwh as cheap as possible.
+
+    The energy lost grows with the current, so charging at a lower current in
+    more slots can be cheaper then full current in the cheapest slots.
+    max_amps is the max amps for each slot from first and a slot is either
+    not used or charged with at least min_amps. Solved greedily in steps of
+    1A on the price of each delivered kwh, which is exact except for the
+    min_amps step.
+
+    Returns a list of (index, start_ts, end_ts, amps) sorted by time for the
+    slots that is used.
+    """
+    amps = [0] * (last - first)
+    heap = [
+        (series.values[first + n] * (1 + loss * min_amps), n)
+        for n in range(last - first)
+        if max_amps[n] >= min_amps
+    ]
+    heapify(heap)
+    need = kwh
+    while need > 1e-9 and heap:
+        _, n = heappop(heap)
+        i = first + n
+        step = min_amps if amps[n] == 0 else 1
+        amps[n] += step
+        need -= step * kw_per_amp * (series.ends[i] - series.starts[i]) / 3600
+        if amps[n] + 1 <= max_amps[n]:
+            # The price of the next amp, the loss of all the amps goes up.
+            heappush(heap, (series.values[i] * (1 + loss * (2 * amps[n] + 1)), n))
+
+    return [
+        (first + n, series.starts[first + n], series.ends[first + n], a)
+        for n, a in enumerate(amps)
+        if a
+    ]
+
+
+class ChargeCurve:
+    """How fast the car can charge at a soc and how much of the energy from
+    the charger ends up in the battery.
+
+    points is a list of (soc, part of the max charge speed) sorted by soc,
+    linear in between. The battery gets efficiency of the charger power
+    minus overhead_kw, so slow charging loses more.
+    """
+
+    __slots__ = ("socs", "fractions", "efficiency", "overhead_kw")
+
+    def __init__(
+        self, points=((0, 1.0), (80, 1.0), (100, 0.3)), efficiency=0.92, overhead_kw=0.25
+    ):
+        points = sorted((float(soc), float(fraction)) for soc, fraction in points)
+        self.socs = [soc for soc, _ in points]
+        self.fractions = [fraction for _, fraction in points]
+        self.efficiency = efficiency
+        self.overhead_kw = overhead_kw
+
+    def fraction(self, soc):
+        i = bisect_right(self.socs, soc)
+        if i == 0:
+            return self.fractions[0]
+        if i == len(self.socs):
+            return self.fractions[-1]
+        soc0, soc1 = self.socs[i - 1], self.socs[i]
+        f0, f1 = self.fractions[i - 1], self.fractions[i]
+        return f0 + (f1 - f0) * (soc - soc0) / (soc1 - soc0)
+
+    def battery_kw(self, soc, kw, max_kw):
+        """kw into the battery when the charger can give kw."""
+        charger_kw = min(kw, self.fraction(soc) * max_kw)
+        return max(0.0, charger_kw * self.efficiency - self.overhead_kw)
+
+    def charge(self, soc, kw, max_kw, seconds, battery_kwh, step=300):
+        """Charge for seconds, returns the new soc and the kwh into the battery."""
+        added = 0.0
+        while seconds > 0 and soc < 100:
+            dt = min(step, seconds)
+            kwh = min(
+                self.battery_kw(soc, kw, max_kw) * dt / 3600,
+                (100 - soc) / 100 * battery_kwh,
+            )
+            if kwh <= 0:
+                break
+            soc += kwh / battery_kwh * 100
+            added += kwh
+            seconds -= dt
+        return soc, added
+
+    def hours_to_charge(self, soc, kwh, max_kw, battery_kwh, step=300):
+        """Hours at full speed to get kwh into the battery, None if it can't be done."""
+        seconds = 0.0
+        while kwh > 1e-6:
+            battery_kw = self.battery_kw(soc, max_kw, max_kw)
+            if battery_kw <= 0 or soc >= 100:
+                return None
+            dt = min(step, kwh / battery_kw * 3600)
+            soc += battery_kw * dt / 3600 / battery_kwh * 100
+            kwh -= battery_kw * dt / 3600
+            seconds += dt
+        return seconds / 3600
+
+    def to_dict(self):
+        return {
+            "points": list(zip(self.socs, self.fractions)),
+            "efficiency": self.efficiency,
+            "overhead_kw": self.overhead_kw,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["points"], data["efficiency"], data["overhead_kw"])
+
+
+def calibrate_charge_curve(samples, battery_kwh, max_kw, bin_size=5, min_kw=0.5):
+    """Learn a ChargeCurve from recorded charging.
+
+    samples is a list of (timestamp, soc, charger kw) sorted by time. The
+    efficiency and the overhead is a least squares fit of the battery power
+    against the charger power between each soc change, the curve is the 90
+    percentile of the charger power in each bin_size soc bin. Returns None if
+    there is to little charging in the samples.
+    """
+    # Charger power per soc bin, and (charger kw, battery kw) between soc changes.
+    powers = {}
+    pairs = []
+    grid_kwh = 0.0
+    seconds = 0.0
+    last_soc = None
+    prev = None
+    for ts, soc, kw in samples:
+        if prev is not None:
+            prev_ts, prev_soc, prev_kw = prev
+            dt = ts - prev_ts
+            if prev_kw >= min_kw and 0 < dt < 3600:
+                grid_kwh += prev_kw * dt / 3600
+                seconds += dt
+                powers.setdefault(int(prev_soc // bin_size), []).append(prev_kw)
+            else:
+                # Not charging, start over from the next soc change.
+                grid_kwh = seconds = 0.0
+                last_soc = None
+        if last_soc is None:
+            last_soc = soc
+        elif soc != last_soc and seconds > 0:
+            battery = (soc - last_soc) / 100 * battery_kwh
+            pairs.append((grid_kwh * 3600 / seconds, battery * 3600 / seconds))
+            grid_kwh = seconds = 0.0
+            last_soc = soc
+        prev = (ts, soc, kw)
+
+    if len(pairs) < 3:
+        return None
+
+    n = len(pairs)
+    mean_x = sum(x for x, _ in pairs) / n
+    mean_y = sum(y for _, y in pairs) / n
+    sxx = sum((x - mean_x) ** 2 for x, _ in pairs)
+    if sxx > 0:
+        efficiency = sum((x - mean_x) * (y - mean_y) for x, y in pairs) / sxx
+        overhead_kw = efficiency * mean_x - mean_y
+    else:
+        efficiency = mean_y / mean_x
+        overhead_kw = 0.0
+    efficiency = min(1.0, max(0.5, efficiency))
+    overhead_kw = min(2.0, max(0.0, overhead_kw))
+
+    points = []
+    for b in sorted(powers):
+        values = sorted(powers[b])
+        kw = values[int(0.9 * (len(values) - 1))]
+        points.append(((b + 0.5) * bin_size, min(1.0, kw / max_kw)))
+    return ChargeCurve(points, efficiency, overhead_kw)
+
+
+class PriceSeries:
+    """Parsed nordpool prices.
+
+    The slots are kept in arrays of posix timestamps and values (slots without
+    a price is left out) together with prefix sums of hours and value * hours
+    so the price of any window of slots can be found in O(1).
+    """
+
+    __slots__ = (
+        "starts",
+        "ends",
+        "offsets",
+        "values",
+        "prefix",
+        "prefix_hours",
+        "currency",
+        "last_updated",
+    )
+
+    def __init__(self, slots=(), currency=None, last_updated=None):
+        self.starts = array("d")
+        self.ends = array("d")
+        # utc offset in seconds so we can give back the local time.
+        self.offsets = array("l")
+        self.values = array("d")
+        self.prefix = array("d", [0.0])
+        self.prefix_hours = array("d", [0.0])
+        self.currency = currency
+        self.last_updated = last_updated
+
+        total = 0.0
+        total_hours = 0.0
+        for slot in sorted(slots, key=itemgetter("start")):
+            if slot.get("value") is None:
+                continue
+            start = slot["start"]
+            end = slot["end"]
+            if isinstance(start, str):
+                start = datetime.fromisoformat(start)
+            if isinstance(end, str):
+                end = datetime.fromisoformat(end)
+            value = float(slot["value"])
+            start_ts = start.timestamp()
+            end_ts = end.timestamp()
+            self.starts.append(start_ts)
+            self.ends.append(end_ts)
+            self.offsets.append(int(start.utcoffset().total_seconds()))
+            self.values.append(value)
+            hours = (end_ts - start_ts) / 3600
+            total += value * hours
+            total_hours += hours
+            self.prefix.append(total)
+            self.prefix_hours.append(total_hours)
+
+    @classmethod
+    def from_nordpool(cls, attributes, last_updated=None):
+        """Create a PriceSeries from the attributes of a nordpool sensor."""
+        attributes = attributes or {}
+        slots = list(attributes.get("raw_today") or []) + list(
+            attributes.get("raw_tomorrow") or []
+        )
+        return cls(slots, currency=attributes.get("currency"), last_updated=last_updated)
+
+    def __len__(self):
+        return len(self.values)
+
+    def start(self, i):
+        return datetime.fromtimestamp(
+            self.starts[i], timezone(timedelta(seconds=self.offsets[i]))
+        )
+
+    def end(self, i):
+        return datetime.fromtimestamp(
+            self.ends[i], timezone(timedelta(seconds=self.offsets[i]))
+        )
+
+    def slot(self, i):
+        return {"start": self.start(i), "end": self.end(i), "value": self.values[i]}
+
+    def to_datetime(self, ts, i):
+        """Convert ts to a datetime in the same timezone as slot i."""
+        return datetime.fromtimestamp(ts, timezone(timedelta(seconds=self.offsets[i])))
+
+    def index(self, ts):
+        """Index of the first slot that starts at or after ts."""
+        return bisect_left(self.starts, ts)
+
+    def window(self, start_ts, end_ts):
+        """Index range (i, j) of the slots that start in [start_ts, end_ts]."""
+        return bisect_left(self.starts, start_ts), bisect_right(self.starts, end_ts)
+
+    def window_cost(self, i, j):
+        """Price of using 1 kw for the slots i to j (not including j)."""
+        return self.prefix[j] - self.prefix[i]
+
+    def window_hours(self, i, j):
+        return self.prefix_hours[j] - self.prefix_hours[i]
+
+
+class ChargePlanner:
+    """Plans the charging of one car from the prices.
+
+    rate(series, i, start, kw) is the kw the car can charge with from start
+    in slot i, the app uses it for the load profile and the capacity tariff.
+    Without it the car charges with max_kw in every slot. log is called like
+    the appdaemon log.
+    """
+
+    def __init__(
+        self,
+        battery_kwh,
+        max_kw=11.0,
+        target_soc=100.0,
+        session_penalty=0.0,
+        max_sessions=None,
+        min_session_minutes=0.0,
+        current_loss=0.005,
+        max_amps=32.0,
+        kw_per_amp=0.230 * 3 ** 0.5,
+        curve=None,
+        rate=None,
+        log=None,
+    ):
+        self.battery_kwh = battery_kwh
+        self.max_kw = max_kw
+        self.target_soc = target_soc
+        self.session_penalty = session_penalty
+        self.max_sessions = max_sessions
+        self.min_session_minutes = min_session_minutes
+        self.current_loss = current_loss
+        self.max_amps = max_amps
+        self.kw_per_amp = kw_per_amp
+        self.curve = curve
+        self.rate = rate
+        self.log = log or (lambda msg, *args, **kwargs: None)
+
+    def kwh_to_charge(self, soc):
+        return max(0.0, self.battery_kwh / 100 * (self.target_soc - soc))
+
+    def hours_to_charge(self, soc, kwh):
+        """Hours at max_kw to charge kwh, with a charge curve the slow
+        charging at high soc is included."""
+        hours = kwh / self.max_kw
+        if self.curve is not None:
+            curve_hours = self.curve.hours_to_charge(soc, kwh, self.max_kw, self.battery_kwh)
+            if curve_hours is not None:
+                hours = curve_hours
+        return hours
+
+    def slot_rate(self, series, i, start):
+        if self.rate is None:
+            return self.max_kw
+        return self.rate(series, i, start, self.max_kw)
+
+    def pick_slots_for_hours(self, series, first, last, hours):
+        """Pick the slots to charge for hours, takes the cost of starting a new
+        charge session into account if any of the session options is set."""
+        if self.session_penalty or self.max_sessions is not None or self.min_session_minutes:
+            segments = plan_sessions(
+                series,
+                first,
+                last,
+                hours,
+                self.max_kw,
+                session_penalty=self.session_penalty,
+                max_sessions=self.max_sessions,
+                min_session_hours=self.min_session_minutes / 60,
+            )
+            if segments is not None:
+                return segments
+            self.log(
+                "Can't find a plan with max %s sessions of min %s minutes, "
+                "using the cheapest slots",
+                self.max_sessions,
+                self.min_session_minutes,
+                level="INFO",
+            )
+
+        return pick_cheapest_slots(series, first, last, hours)
+
+    def plan_energy(self, series, segments, soc):
+        """The kwh the segments should get into the battery.
+
+        The charge rate of each slot is from rate, with a charge curve the soc
+        is followed through the segments.
+        """
+        if self.curve is None:
+            return sum(
+                self.slot_rate(series, i, start) * (end - start) / 3600
+                for i, start, end in segments
+            )
+
+        total = 0.0
+        for i, start, end in segments:
+            soc, added = self.curve.charge(
+                soc,
+                self.slot_rate(series, i, start),
+                self.max_kw,
+                end - start,
+                self.battery_kwh,
+            )
+            total += added
+        return total
+
+    def pick_charge_slots(self, series, first, last, hours, soc, kwh=None):
+        """Pick the slots to charge in, returns the segments and True if they
+        are not enough for kwh (hours * max_kw if not set).
+
+        With a rate or a charge curve the energy the picked slots delivers
+        into the battery is estimated slot by slot, and more time is added
+        until it is enough.
+        """
+        segments = self.pick_slots_for_hours(series, first, last, hours)
+        if self.rate is None and self.curve is None:
+            return segments, False
+
+        need = hours * self.max_kw if kwh is None else kwh
+        planned_hours = hours
+        delivered = 0.0
+        for _ in range(5):
+            delivered = self.plan_energy(series, segments, soc)
+            if delivered >= need * 0.999:
+                break
+            planned_hours += (need - delivered) / self.max_kw
+            self.log(
+                "The plan only gives %s of %s kwh, planning for %s hours",
+                delivered,
+                need,
+                planned_hours,
+                level="DEBUG",
+            )
+            segments = self.pick_slots_for_hours(series, first, last, planned_hours)
+        else:
+            delivered = self.plan_energy(series, segments, soc)
+        return segments, delivered < need * 0.999
+
+    def charge_profile(self, series, first, last, kwh):
+        """The amps for every slot to charge kwh, see plan_current_profile."""
+        if self.curve is not None:
+            # The profile is planned in kwh from the charger.
+            kwh = kwh / self.curve.efficiency
+        max_amps = [
+            math.floor(
+                min(self.slot_rate(series, i, series.starts[i]) / self.kw_per_amp, self.max_amps)
+            )
+            for i in range(first, last)
+        ]
+        return plan_current_profile(
+            series,
+            first,
+            last,
+            kwh,
+            max_amps,
+            self.kw_per_amp,
+            loss=self.current_loss,
+        )
+
+    def plan(self, series, now_ts, ready_ts, soc, mode="on_off"):
+        """Plan from now_ts until ready_ts like create_a_charge_plan does.
+
+        Returns the kwh and hours to charge, the cost and the slots as
+        (start_ts, end_ts, amps), amps is None when charging at full speed.
+        """
+        first, last = series.window(now_ts, ready_ts)
+        kwh = self.kwh_to_charge(soc)
+        hours = self.hours_to_charge(soc, kwh)
+        slots = []
+        cost = 0.0
+        if mode == "current":
+            for i, start, end, amps in self.charge_profile(series, first, last, kwh):
+                slots.append((start, end, amps))
+                cost += series.values[i] * amps * self.kw_per_amp * (end - start) / 3600
+        else:
+            segments, _ = self.pick_charge_slots(series, first, last, hours, soc, kwh=kwh)
+            for i, start, end in sorted(segments, key=itemgetter(1)):
+                cost += series.values[i] * self.max_kw * (end - start) / 3600
+                # Slots that follow each other is one charge session.
+                if slots and slots[-1][1] == start:
+                    slots[-1] = (slots[-1][0], end, None)
+                else:
+                    slots.append((start, end, None))
+        return {"kwh": kwh, "hours": hours, "cost": cost, "slots": slots}
+
+
+def parse_timestamp(value, default=None):
+    """Convert a ha iso timestamp to a posix timestamp."""
+    if not value:
+        return default
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return default
+
+
+class EntityIndex:
+    """Sorted entity ids so entities can be looked up by prefix without
+    scanning every entity in ha."""
+
+    __slots__ = ("ids",)
+
+    def __init__(self, entity_ids):
+        self.ids = sorted(entity_ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, entity_id):
+        i = bisect_left(self.ids, entity_id)
+        return i < len(self.ids) and self.ids[i] == entity_id
+
+    def prefix(self, prefix):
+        """All entity ids that starts with prefix."""
+        i = bisect_left(self.ids, prefix)
+        j = bisect_left(self.ids, prefix + "\uffff")
+        return self.ids[i:j]
+
+    def find(self, prefix, suffix=""):
+        """All entity ids that starts with prefix and ends with suffix."""
+        return [i for i in self.prefix(prefix) if i.endswith(suffix)]
+
+
+def discover_entities(states):
+    """Find the easee chargers and the nordpool sensors in a dict of ha states."""
+    index = EntityIndex(states)
+    chargers = []
+    for entity in index.find("sensor.easee", "_status"):
+        serial = (states[entity] or {}).get("attributes", {}).get("id")
+        if not serial:
+            # Some other easee sensor that ends with status.
+            continue
+        esn = entity.split(".")[1][: -len("_status")]
+        no_current = "sensor.%s_reason_for_no_current" % esn
+        chargers.append(
+            {
+                "serial": serial,
+                "entity_start_name": esn,
+                "charger_status_entity": entity,
+                "charger_no_current_entity": no_current if no_current in index else None,
+            }
+        )
+    return {"chargers": chargers, "power_price_entities": index.prefix("sensor.nordpool")}
+
+
+class MirroredValue:
+    """The last known value of a mirrored field and when ha last updated it."""
+
+    __slots__ = ("value", "updated")
+
+    def __init__(self, value=None, updated=None):
+        self.value = value
+        self.updated = updated
+
+
+class StateMirror:
+    """In memory snapshot of the entities the app depends on.
+
+    Each field is fed by a listen_state subscription so the load balancer
+    can read the values directly instead of doing a get_state round-trip
+    for every power sample.
+    """
+
+    def __init__(self):
+        self._fields = {}
+        # entity_id -> [(field name, attribute, cast)]
+        self._entities = {}
+
+    def add_field(self, name, entity, attribute=None, cast=str):
+        """Mirror the state (or an attribute) of entity as name."""
+        if not entity:
+            return
+        self._fields[name] = MirroredValue()
+        self._entities.setdefault(entity, []).append((name, attribute, cast))
+
+    def entities(self):
+        return list(self._entities)
+
+    def update(self, entity, new, now):
+        """Update all fields that use entity from a full ha state dict."""
+        if not isinstance(new, dict):
+            new = {}
+
+        updated = parse_timestamp(new.get("last_updated"), now)
+        attributes = new.get("attributes", {})
+        for name, attribute, cast in self._entities.get(entity, []):
+            if attribute is None:
+                value = new.get("state")
+            else:
+                value = attributes.get(attribute)
+
+            if value is not None and value not in ("unknown", "unavailable"):
+                try:
+                    value = cast(value)
+                except (TypeError, ValueError):
+                    value = None
+            else:
+                value = None
+
+            field = self._fields[name]
+            field.value = value
+            field.updated = updated
+
+    def has(self, name):
+        return name in self._fields
+
+    def entity_of(self, name):
+        """The entity the field name is mirrored from."""
+        for entity, fields in self._entities.items():
+            for field, _, _ in fields:
+                if field == name:
+                    return entity
+        return None
+
+    def get(self, name, default=None):
+        field = self._fields.get(name)
+        if field is None or field.value is None:
+            return default
+        return field.value
+
+    def updated(self, name):
+        field = self._fields.get(name)
+        return None if field is None else field.updated
+
+    def age(self, name, now):
+        """Seconds since the field was updated, None if it never was."""
+        field = self._fields.get(name)
+        if field is None or field.updated is None:
+            return None
+        return now - field.updated
+
+    def is_stale(self, name, now, max_age):
+        age = self.age(name, now)
+        return age is None or age > max_age
+
+    def is_unavailable(self, name):
+        """True if the field has no value, ha sets unavailable or unknown when
+        the integration has lost the device.
+
+        Use this instead of is_stale for sensors that can keep the same value
+        for a long time, appdaemon only gets a new state when it changes.
+        """
+        return self.get(name) is None
+
+
+class PowerSampler:
+    """Folds raw power samples into a window that is consumed once per control tick.
+
+    Samples that arrive between two ticks supersede each other instead of
+    queueing up behind the app lock, only last, max and the ewma survive.
+    """
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.ewma = None
+        self.last = None
+        self.last_ts = None
+        self._max = None
+        self._count = 0
+
+        # Counters
+        self.samples = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.windows = 0
+
+    def add(self, value, ts):
+        """Add a raw sample, returns False if it was dropped."""
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            self.dropped += 1
+            return False
+
+        # Older than what we already have, nothing to use it for.
+        if self.last_ts is not None and ts < self.last_ts:
+            self.dropped += 1
+            return False
+
+        self.samples += 1
+        if self._count:
+            self.coalesced += 1
+
+        if self.ewma is None:
+            self.ewma = value
+        else:
+            self.ewma = self.alpha * value + (1 - self.alpha) * self.ewma
+
+        self.last = value
+        self.last_ts = ts
+        self._max = value if self._max is None else max(self._max, value)
+        self._count += 1
+        return True
+
+    def take(self):
+        """Return a dict with the window and start a new one, None if the window is empty."""
+        if not self._count:
+            return None
+
+        window = {
+            "last": self.last,
+            "max": self._max,
+            "ewma": self.ewma,
+            "count": self._count,
+            "ts": self.last_ts,
+        }
+        self.windows += 1
+        self._max = None
+        self._count = 0
+        return window
+
+    def discard(self):
+        """Throw away the current window, the samples is counted as dropped."""
+        self.dropped += self._count
+        self._max = None
+        self._count = 0
+
+    def stats(self):
+        return {
+            "samples": self.samples,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "windows": self.windows,
+        }
+
+
+class LoadForecast:
+    """Fixed size ring buffer of the house usage used to forecast the usage
+    a few seconds ahead.
+
+    The margin is how much the usage can be expected to rise within horizon
+    seconds, the trend from a least squares fit plus the percentile of the
+    samples above the fitted line.
+    """
+
+    __slots__ = ("size", "timestamps", "values", "pos", "count")
+
+    def __init__(self, size=120):
+        self.size = size
+        self.timestamps = array("d", bytes(8 * size))
+        self.values = array("d", bytes(8 * size))
+        self.pos = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, ts, value):
+        self.timestamps[self.pos] = ts
+        self.values[self.pos] = value
+        self.pos = (self.pos + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def clear(self):
+        self.pos = 0
+        self.count = 0
+
+    def margin(self, horizon=10.0, percentile=95.0):
+        """Expected rise in usage within horizon seconds, 0 if there is to few samples."""
+        n = self.count
+        if n < 3:
+            return 0.0
+        if n < self.size:
+            ts = self.timestamps[:n]
+            values = self.values[:n]
+        else:
+            ts = self.timestamps
+            values = self.values
+
+        # Relative to the newest sample to keep the sums small.
+        last_ts = self.timestamps[self.pos - 1]
+        xs = [t - last_ts for t in ts]
+        mean_x = sum(xs) / n
+        mean_y = sum(values) / n
+        sxx = sum((x - mean_x) ** 2 for x in xs)
+        if sxx == 0:
+            slope = 0.0
+        else:
+            slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, values)) / sxx
+
+        intercept = mean_y - slope * mean_x
+        residuals = sorted(y - (intercept + slope * x) for x, y in zip(xs, values))
+        envelope = residuals[min(n - 1, int(percentile / 100.0 * (n - 1) + 0.5))]
+        # What we expect at horizon compared to the fitted line now.
+        return max(0.0, slope * horizon) + max(0.0, envelope)
+
+
+class LoadProfile:
+    """The house usage for each hour of the week.
+
+    Every hour of the week has a histogram of the usage in bins of bin_size
+    amps weighted by seconds, so it can be built one chunk of history at a
+    time and updated with the new history every day.
+    """
+
+    __slots__ = ("bin_size", "bins", "hours", "last_ts")
+
+    def __init__(self, bin_size=1.0, bins=100):
+        self.bin_size = bin_size
+        self.bins = bins
+        self.hours = [array("d", bytes(8 * bins)) for _ in range(168)]
+        # The history until this is in the profile.
+        self.last_ts = None
+
+    def add(self, start_ts, end_ts, amps, tz):
+        """Add that the usage was amps from start_ts to end_ts."""
+        b = min(self.bins - 1, max(0, int(amps / self.bin_size)))
+        ts = start_ts
+        while ts < end_ts:
+            dt = datetime.fromtimestamp(ts, tz)
+            hour_end = dt.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+            nxt = min(end_ts, hour_end.timestamp())
+            self.hours[dt.weekday() * 24 + dt.hour][b] += nxt - ts
+            ts = nxt
+
+    def decay(self, factor):
+        """Make the old history count less."""
+        for hist in self.hours:
+            for b in range(self.bins):
+                hist[b] *= factor
+
+    def percentile(self, dt, percentile=90.0):
+        """The usage in amps that isn't exceeded percentile % of the time in
+        the hour of the week of dt, None if there is no history for it."""
+        hist = self.hours[dt.weekday() * 24 + dt.hour]
+        total = sum(hist)
+        if total <= 0:
+            return None
+        limit = total * percentile / 100.0
+        seen = 0.0
+        for b, seconds in enumerate(hist):
+            seen += seconds
+            if seen >= limit:
+                return (b + 1) * self.bin_size
+        return self.bins * self.bin_size
+
+    def to_dict(self):
+        hours = []
+        for hist in self.hours:
+            values = [round(i, 1) for i in hist]
+            while values and values[-1] == 0:
+                values.pop()
+            hours.append(values)
+        return {
+            "bin_size": self.bin_size,
+            "bins": self.bins,
+            "last_ts": self.last_ts,
+            "hours": hours,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        profile = cls(data["bin_size"], data["bins"])
+        profile.last_ts = data["last_ts"]
+        for hist, values in zip(profile.hours, data["hours"]):
+            hist[: len(values)] = array("d", values)
+        return profile
+
+
+class PeakTracker:
+    """Energy used in each clock hour and the highest hour of each day this month.
+
+    The power samples are integrated as they arrive, the usage is assumed to
+    stay at the last sample until the next one.
+    """
+
+    __slots__ = (
+        "peaks",
+        "steps",
+        "month",
+        "day_peaks",
+        "day",
+        "hour_end",
+        "hour_kwh",
+        "last_ts",
+        "last_watt",
+        "last_month_peaks",
+    )
+
+    def __init__(self, peaks=3, steps=()):
+        self.peaks = peaks
+        self.steps = sorted(steps)
+        self.month = None
+        # day -> kwh of the highest hour that day
+        self.day_peaks = {}
+        self.day = None
+        self.hour_end = None
+        self.hour_kwh = 0.0
+        self.last_ts = None
+        self.last_watt = 0.0
+        # The billed peaks of the last month we know of.
+        self.last_month_peaks = []
+
+    def add(self, ts, watt, tz):
+        """Add a power sample, returns True if a hour was finished."""
+        finished = False
+        if self.hour_end is None:
+            self.start_hour(ts, tz)
+        elif self.last_ts is None or ts - self.last_ts > 900:
+            # We don't know the usage in a gap this long, like when ha was down.
+            if ts >= self.hour_end:
+                self.finish_hour()
+                self.start_hour(ts, tz)
+                finished = True
+        elif ts > self.last_ts:
+            t = self.last_ts
+            while t < ts:
+                if t >= self.hour_end:
+                    self.finish_hour()
+                    self.start_hour(t, tz)
+                    finished = True
+                nxt = min(ts, self.hour_end)
+                self.hour_kwh += self.last_watt * (nxt - t) / 3600000
+                t = nxt
+        self.last_ts = ts
+        self.last_watt = watt
+        return finished
+
+    def start_hour(self, ts, tz):
+        dt = datetime.fromtimestamp(ts, tz)
+        hour_start = dt.replace(minute=0, second=0, microsecond=0)
+        month = hour_start.strftime("%Y-%m")
+        if month != self.month:
+            if self.day_peaks:
+                self.last_month_peaks = self.top()
+            self.month = month
+            self.day_peaks = {}
+        self.day = hour_start.strftime("%Y-%m-%d")
+        self.hour_end = (hour_start + timedelta(hours=1)).timestamp()
+        self.hour_kwh = 0.0
+
+    def finish_hour(self):
+        if self.hour_kwh > self.day_peaks.get(self.day, 0.0):
+            self.day_peaks[self.day] = self.hour_kwh
+
+    def top(self):
+        """The kwh of the hours that is billed, highest first."""
+        return sorted(self.day_peaks.values(), reverse=True)[: self.peaks]
+
+    def allowed_kwh(self):
+        """How many kwh a hour today can use without making the bill higher.
+
+        Until there is a peak for every billed hour this month the missing
+        ones is taken from last month, without them there is no limit.
+        """
+        top = self.top()
+        if len(top) < self.peaks:
+            top = sorted(top + self.last_month_peaks, reverse=True)[: self.peaks]
+            if len(top) < self.peaks:
+                return float("inf")
+        today = self.day_peaks.get(self.day, 0.0)
+        lowest = top[-1]
+        allowed = max(lowest, today)
+
+        average = sum(top) / self.peaks
+        for step in self.steps:
+            if step > average:
+                # The hour that gets replaced if this hour is a new peak.
+                if today in top:
+                    replaced = today
+                else:
+                    replaced = lowest
+                allowed = max(allowed, step * self.peaks - (sum(top) - replaced))
+                break
+        else:
+            if self.steps:
+                # Above the last step, peaks doesn't cost anything more.
+                allowed = float("inf")
+        return allowed
+
+    def to_dict(self):
+        return {
+            "month": self.month,
+            "day_peaks": self.day_peaks,
+            "day": self.day,
+            "hour_end": self.hour_end,
+            "hour_kwh": self.hour_kwh,
+            "last_ts": self.last_ts,
+            "last_watt": self.last_watt,
+            "last_month_peaks": self.last_month_peaks,
+        }
+
+    def restore(self, data):
+        for key, value in data.items():
+            setattr(self, key, value)
+
+
+class StepController:
+    """The original load balancer logic, jumps straight to the amps that is left."""
+
+    def __init__(self, min_amps=6):
+        self.min_amps = min_amps
+
+    def reset(self):
+        pass
+
+    def update(self, amps_left, max_amps, now, last_value):
+        """Return the new current limit or None if it should be kept."""
+        if math.floor(amps_left) == math.floor(last_value):
+            return None
+
+        if amps_left < last_value:
+            # The charger is paused if the limit is less then 6
+            if amps_left < self.min_amps:
+                amps_left = self.min_amps - 1
+            return min(amps_left, max_amps)
+        return min(amps_left, max_amps)
+
+
+class PIController:
+    """PI controller for the dynamic circuit current.
+
+    Reductions are applied at once so we never wait with protecting the main
+    fuse, increases are ramped up using the pi terms and limited to slew_up
+    amps per second. Changes smaller then the deadband are ignored and the
+    integral is clamped to integral_max (and frozen while the output is slew
+    limited) to avoid windup.
+    """
+
+    def __init__(
+        self,
+        kp=0.5,
+        ki=0.05,
+        deadband=1.0,
+        slew_up=0.5,
+        integral_max=10.0,
+        min_amps=6,
+    ):
+        self.kp = kp
+        self.ki = ki
+        self.deadband = deadband
+        self.slew_up = slew_up
+        self.integral_max = integral_max
+        self.min_amps = min_amps
+        self.reset()
+
+    def reset(self):
+        self.output = None
+        self.integral = 0.0
+        self.last_ts = None
+
+    def update(self, amps_left, max_amps, now, last_value):
+        """Return the new current limit or None if it should be kept."""
+        target = max(0.0, min(amps_left, max_amps))
+        dt = 0.0 if self.last_ts is None else max(0.0, now - self.last_ts)
+        self.last_ts = now
+        if self.output is None:
+            self.output = float(last_value)
+
+        error = target - self.output
+        if error < 0:
+            self.output = target
+            self.integral = 0.0
+        elif error > self.deadband:
+            step = self.kp * error + self.ki * (self.integral + error * dt)
+            max_step = self.slew_up * dt
+            if step > max_step:
+                step = max_step
+            else:
+                self.integral = min(self.integral + error * dt, self.integral_max)
+            self.output = min(self.output + step, target)
+        else:
+            # Close enough, let the integral bleed off.
+            self.integral *= 0.5
+
+        new_value = self.output
+        if new_value < self.min_amps:
+            new_value = self.min_amps - 1
+        new_value = math.floor(new_value)
+        if new_value == math.floor(last_value):
+            return None
+        return new_value
+
+
+def compare_controllers(
+    trace, controllers, main_fuse, fuse_limit=0.9, max_amps=32.0, car_max_amps=16.0
+):
+    """Run each controller over the same trace of house usage.
+
+    trace is a list of (timestamp, house usage in amps) and controllers is a dict
+    of name: controller. The charger is assumed to use the limit it was given,
+    capped by car_max_amps, and nothing when the limit is below 6A.
+    """
+    result = {}
+    for name, controller in controllers.items():
+        controller.reset()
+        limit = 0
+        charger_amps = 0.0
+        commands = 0
+        amp_hours = 0.0
+        overload_seconds = 0.0
+        prev_ts = None
+        for ts, house_amps in trace:
+            if prev_ts is not None:
+                dt = ts - prev_ts
+                amp_hours += charger_amps * dt / 3600
+                if house_amps + charger_amps > main_fuse:
+                    overload_seconds += dt
+
+            new_value = controller.update(
+                main_fuse * fuse_limit - house_amps, max_amps, ts, limit
+            )
+            if new_value is not None:
+                commands += 1
+                limit = new_value
+            charger_amps = min(limit, car_max_amps) if limit >= 6 else 0.0
+            prev_ts = ts
+
+        result[name] = {
+            "commands": commands,
+            "amp_hours": amp_hours,
+            "overload_seconds": overload_seconds,
+        }
+    return result
+
+
+def split_headroom(amps, chargers, policy="fair", min_amps=6):
+    """Split the amps that is left on the main fuse between chargers.
+
+    chargers is a list of (max amps, weight > 0) in priority order. Every charger
+    gets at least min_amps or nothing at all, if there isn't enough for all of
+    them the lowest priority (or weight for fair) ones gets nothing. Returns
+    the amps for each charger in the same order.
+    """
+    result = [0.0] * len(chargers)
+    order = [i for i, (max_amps, _) in enumerate(chargers) if max_amps >= min_amps]
+    if policy == "fair":
+        order.sort(key=lambda i: -chargers[i][1])
+    elif policy != "priority":
+        raise ValueError("Unknown load_balance_policy %s" % policy)
+
+    order = order[: max(0, int(amps // min_amps))]
+    for i in order:
+        result[i] = float(min_amps)
+    left = amps - min_amps * len(order)
+
+    if policy == "priority":
+        for i in order:
+            add = min(left, chargers[i][0] - result[i])
+            result[i] += add
+            left -= add
+        return result
+
+    # Water filling, chargers that hit their max gives the rest to the others.
+    unfilled = [i for i in order if chargers[i][0] > result[i]]
+    while left > 1e-9 and unfilled:
+        total_weight = sum(chargers[i][1] for i in unfilled)
+        capped = []
+        used = 0.0
+        for i in unfilled:
+            share = left * chargers[i][1] / total_weight
+            add = min(share, chargers[i][0] - result[i])
+            result[i] += add
+            used += add
+            if result[i] >= chargers[i][0]:
+                capped.append(i)
+        left -= used
+        if not capped:
+            break
+        unfilled = [i for i in unfilled if i not in capped]
+    return result
+
+
+def plan_vehicles(series, first, last, vehicles, capacity):
+    """Plan the charging of several cars sharing the main fuse.
+
+    vehicles is a list of (kwh, last slot, max kw) where the car must be
+    charged before the last slot (not including it). capacity is the kw that
+    is left for the cars in each slot from first. Solved as a min cost flow
+    from the cars to the slots using successive shortest paths, so as much as
+    possible is charged and as cheap as possible.
+
+    Returns the kwh for each car in each slot from first and the kwh that
+    could not be planned for each car.
+    """
+    n = len(vehicles)
+    slots = last - first
+    source = n + slots
+    sink = source + 1
+    # Residual graph as edge lists, an edge is [to, capacity, cost, reverse index].
+    graph = [[] for _ in range(sink + 1)]
+
+    def add_edge(a, b, cap, cost):
+        graph[a].append([b, cap, cost, len(graph[b])])
+        graph[b].append([a, 0.0, -cost, len(graph[a]) - 1])
+
+    hours = [(series.ends[i] - series.starts[i]) / 3600 for i in range(first, last)]
+    car_edges = []
+    for v, (kwh, until, max_kw) in enumerate(vehicles):
+        add_edge(source, v, kwh, 0.0)
+        edges = {}
+        for t in range(max(0, min(until, last) - first)):
+            edges[t] = len(graph[v])
+            add_edge(v, n + t, max_kw * hours[t], 0.0)
+        car_edges.append(edges)
+    for t in range(slots):
+        add_edge(n + t, sink, max(0.0, capacity[t]) * hours[t], series.values[first + t])
+
+    while True:
+        # Bellman-Ford as the residual graph has negative costs.
+        dist = [float("inf")] * (sink + 1)
+        prev = [None] * (sink + 1)
+        dist[source] = 0.0
+        changed = True
+        while changed:
+            changed = False
+            for a in range(sink + 1):
+                if dist[a] == float("inf"):
+                    continue
+                for k, (b, cap, cost, _) in enumerate(graph[a]):
+                    if cap > 1e-9 and dist[a] + cost < dist[b] - 1e-12:
+                        dist[b] = dist[a] + cost
+                        prev[b] = (a, k)
+                        changed = True
+        if prev[sink] is None:
+            break
+
+        flow = float("inf")
+        b = sink
+        while b != source:
+            a, k = prev[b]
+            flow = min(flow, graph[a][k][1])
+            b = a
+        b = sink
+        while b != source:
+            a, k = prev[b]
+            edge = graph[a][k]
+            edge[1] -= flow
+            graph[b][edge[3]][1] += flow
+            b = a
+
+    allocation = []
+    unmet = []
+    for v, (kwh, _, _) in enumerate(vehicles):
+        kwhs = [0.0] * slots
+        for t, k in car_edges[v].items():
+            edge = graph[v][k]
+            # The flow is what the reverse edge got.
+            kwhs[t] = graph[edge[0]][edge[3]][1]
+        allocation.append(kwhs)
+        unmet.append(max(0.0, kwh - sum(kwhs)))
+    return allocation, unmet
+
+
+class Vehicle:
+    """A car that is planned together with the other cars, the mirror
+    fields for it is named field:name."""
+
+    __slots__ = ("name", "charger", "battery_kwh", "max_kw", "target_soc", "profile", "starts")
+
+    def __init__(self, name, charger, battery_kwh, max_kw, target_soc):
+        self.name = name
+        self.charger = charger
+        self.battery_kwh = battery_kwh
+        self.max_kw = max_kw
+        self.target_soc = target_soc
+        # [(start_ts, end_ts, amps)]
+        self.profile = []
+        self.starts = []
+
+    def field(self, name):
+        return "%s:%s" % (name, self.name)
+
+    def set_profile(self, profile):
+        # Read by the balancer from another thread, see planned_amps.
+        self.starts = [start for start, _, _ in profile]
+        self.profile = profile
+
+    def planned_amps(self, ts):
+        """The planned amps at ts, None without a plan."""
+        profile = self.profile
+        if not profile:
+            return None
+        i = bisect_right(self.starts, ts) - 1
+        if i < 0 or i >= len(profile) or ts >= profile[i][1]:
+            return 0
+        return profile[i][2]
+
+
+class BalancedCharger:
+    """A charger that shares the main fuse with other chargers.
+
+    The mirror fields for it is named field:name.
+    """
+
+    __slots__ = (
+        "name",
+        "status_entity",
+        "weight",
+        "controller",
+        "last_value",
+        "paused",
+        "stale",
+        "serial",
+    )
+
+    def __init__(self, name, status_entity, weight, controller, serial=None):
+        self.name = name
+        self.status_entity = status_entity
+        # The commands to the charger is rate limited by this.
+        self.serial = serial
+        self.weight = weight
+        self.controller = controller
+        self.last_value = None
+        self.paused = None
+        self.stale = False
+
+    def field(self, name):
+        return "%s:%s" % (name, self.name)
+
+
+# Command priorities, lower is sent first.
+PRIORITY_PROTECT = 0
+PRIORITY_CONTROL = 1
+
+
+class Command:
+    """A queued service call."""
+
+    __slots__ = (
+        "key",
+        "target",
+        "service",
+        "data",
+        "priority",
+        "queued_at",
+        "not_before",
+        "attempts",
+    )
+
+    def __init__(self, key, target, service, data, priority, queued_at):
+        self.key = key
+        self.target = target
+        self.service = service
+        self.data = data
+        self.priority = priority
+        self.queued_at = queued_at
+        self.not_before = queued_at
+        self.attempts = 0
+
+
+class CommandQueue:
+    """Outbound queue for service calls.
+
+    Commands with the same key are coalesced so only the latest value is sent,
+    commands to the same target (charger) are spaced at least min_interval
+    seconds apart and failed commands are retried with exponential backoff.
+    A command that is the same as the last one sent ok for its key is
+    dropped, unless that was more than resend_after seconds ago.
+    """
+
+    def __init__(
+        self, min_interval=2.0, max_retries=3, backoff=2.0, max_backoff=60.0, resend_after=600.0
+    ):
+        self.min_interval = min_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.resend_after = resend_after
+        self._pending = {}
+        self._last_sent = {}
+        # key -> (service, data, time) of the last command that was sent ok.
+        self._acked = {}
+        # key -> the command that is being sent
+        self._sending = {}
+
+        # Counters
+        self.enqueued = 0
+        self.coalesced = 0
+        self.skipped = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, key, target, service, data, priority, now):
+        """Queue a command, replacing any pending command with the same key."""
+        self.enqueued += 1
+        sending = self._sending.get(key)
+        if sending is not None:
+            current = (sending.service, sending.data)
+        else:
+            acked = self._acked.get(key)
+            current = None
+            if acked is not None and now - acked[2] < self.resend_after:
+                current = acked[:2]
+        if current == (service, data):
+            # The charger already has this value, a older pending value is stale.
+            self.skipped += 1
+            self._pending.pop(key, None)
+            return
+
+        cmd = self._pending.get(key)
+        if cmd is None:
+            self._pending[key] = Command(key, target, service, data, priority, now)
+            return
+
+        # Keep queued_at so the latency is measured from the first request.
+        self.coalesced += 1
+        cmd.service = service
+        cmd.data = data
+        cmd.priority = min(cmd.priority, priority)
+        cmd.attempts = 0
+
+    def _ready_at(self, cmd):
+        ready = cmd.not_before
+        if cmd.target is not None and cmd.target in self._last_sent:
+            ready = max(ready, self._last_sent[cmd.target] + self.min_interval)
+        return ready
+
+    def pop_ready(self, now):
+        """Pop the most important command that can be sent now."""
+        best = None
+        for cmd in self._pending.values():
+            if self._ready_at(cmd) > now:
+                continue
+            if best is None or (cmd.priority, cmd.queued_at) < (
+                best.priority,
+                best.queued_at,
+            ):
+                best = cmd
+
+        if best is not None:
+            del self._pending[best.key]
+            self._sending[best.key] = best
+            if best.target is not None:
+                self._last_sent[best.target] = now
+        return best
+
+    def next_due(self, now):
+        """Seconds until the next command can be sent, None if the queue is empty."""
+        if not self._pending:
+            return None
+        return max(0.0, min(self._ready_at(cmd) for cmd in self._pending.values()) - now)
+
+    def done(self, cmd, now):
+        if self._sending.get(cmd.key) is cmd:
+            del self._sending[cmd.key]
+        self._acked[cmd.key] = (cmd.service, cmd.data, now)
+        latency = now - cmd.queued_at
+        self.sent += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def retry(self, cmd, now):
+        """Requeue a failed command, returns False if we gave up on it."""
+        if self._sending.get(cmd.key) is cmd:
+            del self._sending[cmd.key]
+        # We don't know what the charger has now.
+        self._acked.pop(cmd.key, None)
+        cmd.attempts += 1
+        if cmd.attempts > self.max_retries:
+            self.failed += 1
+            return False
+
+        # A newer command with the same key is already waiting, let that win.
+        if cmd.key in self._pending:
+            return True
+
+        self.retries += 1
+        cmd.not_before = now + min(
+            self.backoff * 2 ** (cmd.attempts - 1), self.max_backoff
+        )
+        self._pending[cmd.key] = cmd
+        return True
+
+    def stats(self):
+        return {
+            "depth": len(self._pending),
+            "enqueued": self.enqueued,
+            "coalesced": self.coalesced,
+            "skipped": self.skipped,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "latency_avg": self.latency_total / self.sent if self.sent else 0.0,
+            "latency_max": self.latency_max,
+        }
+
+
+class Metrics:
+    """Call counts and latency histograms for the hot paths, the commands
+    sent the last hour and how long the chargers has been paused (< 6A)
+    by the load balancer."""
+
+    # Upper bound of each latency bucket in seconds, the last bucket is +Inf.
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+    def __init__(self):
+        # name -> [count for each bucket]
+        self.buckets = {}
+        self.sums = {}
+        self.commands = deque()
+        self.commands_total = 0
+        self.paused_seconds = {}
+        self._paused_since = {}
+
+    def observe(self, name, seconds):
+        buckets = self.buckets.get(name)
+        if buckets is None:
+            buckets = self.buckets[name] = [0] * (len(self.BUCKETS) + 1)
+            self.sums[name] = 0.0
+        buckets[bisect_left(self.BUCKETS, seconds)] += 1
+        self.sums[name] += seconds
+
+    def count(self, name):
+        return sum(self.buckets.get(name, ()))
+
+    def percentile(self, name, p):
+        """Upper bound of the bucket the p percentile is in, None without calls."""
+        buckets = self.buckets.get(name)
+        if not buckets:
+            return None
+        wanted = sum(buckets) * p / 100
+        seen = 0
+        for bound, n in zip(self.BUCKETS + (float("inf"),), buckets):
+            seen += n
+            if n and seen >= wanted:
+                return bound
+        return None
+
+    def command_sent(self, now):
+        self.commands_total += 1
+        self.commands.append(now)
+
+    def commands_last_hour(self, now):
+        while self.commands and self.commands[0] <= now - 3600:
+            self.commands.popleft()
+        return len(self.commands)
+
+    def set_paused(self, key, paused, now):
+        """Track when the charger key is paused by the load balancer."""
+        since = self._paused_since.get(key)
+        if paused and since is None:
+            self._paused_since[key] = now
+        elif not paused and since is not None:
+            del self._paused_since[key]
+            self.paused_seconds[key] = self.paused_seconds.get(key, 0.0) + now - since
+
+    def paused_keys(self):
+        return sorted(set(self.paused_seconds) | set(self._paused_since))
+
+    def paused_total(self, key, now):
+        since = self._paused_since.get(key)
+        return self.paused_seconds.get(key, 0.0) + (0.0 if since is None else now - since)
+
+    def prometheus(self, app, now, queue):
+        """The metrics in the prometheus text format, queue is the command queue stats."""
+        lines = [
+            "# HELP chargebot_calls_total Calls to the hot paths.",
+            "# TYPE chargebot_calls_total counter",
+        ]
+        for name in sorted(self.buckets):
+            lines.append(
+                'chargebot_calls_total{app="%s",name="%s"} %s' % (app, name, self.count(name))
+            )
+        lines += [
+            "# HELP chargebot_latency_seconds Time spent in the hot paths.",
+            "# TYPE chargebot_latency_seconds histogram",
+        ]
+        for name in sorted(self.buckets):
+            labels = 'app="%s",name="%s"' % (app, name)
+            seen = 0
+            for bound, n in zip(self.BUCKETS + (float("inf"),), self.buckets[name]):
+                seen += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('chargebot_latency_seconds_bucket{%s,le="%s"} %s' % (labels, le, seen))
+            lines.append("chargebot_latency_seconds_sum{%s} %r" % (labels, self.sums[name]))
+            lines.append("chargebot_latency_seconds_count{%s} %s" % (labels, seen))
+
+        counters = (
+            ("commands_total", "Commands sent to the charger.", self.commands_total),
+            ("command_failures_total", "Commands given up on.", queue["failed"]),
+            ("command_retries_total", "Commands that was retried.", queue["retries"]),
+        )
+        for name, text, value in counters:
+            lines += [
+                "# HELP chargebot_%s %s" % (name, text),
+                "# TYPE chargebot_%s counter" % name,
+                'chargebot_%s{app="%s"} %s' % (name, app, value),
+            ]
+        lines += [
+            "# HELP chargebot_commands_last_hour Commands sent the last hour.",
+            "# TYPE chargebot_commands_last_hour gauge",
+            'chargebot_commands_last_hour{app="%s"} %s' % (app, self.commands_last_hour(now)),
+            "# HELP chargebot_command_queue_depth Commands waiting to be sent.",
+            "# TYPE chargebot_command_queue_depth gauge",
+            'chargebot_command_queue_depth{app="%s"} %s' % (app, queue["depth"]),
+            "# HELP chargebot_paused_seconds_total Time a charger was paused by the load balancer.",
+            "# TYPE chargebot_paused_seconds_total counter",
+        ]
+        for key in self.paused_keys():
+            lines.append(
+                'chargebot_paused_seconds_total{app="%s",charger="%s"} %r'
+                % (app, key, self.paused_total(key, now))
+            )
+        return "\n".join(lines) + "\n"
+
+
+TRACE_BALANCE = 0
+TRACE_PHASES = 1
+TRACE_PLAN = 2
+TRACE_KINDS = {TRACE_BALANCE: "balance", TRACE_PHASES: "phases", TRACE_PLAN: "plan"}
+TRACE_PAUSED = 1
+TRACE_CHANGED = 2
+
+
+class DecisionTrace:
+    """Fixed size ring buffer with the last load balancer decisions and plans.
+
+    Every record is kind, flags, source (0 is the main charger, else the
+    index in load_balance_chargers + 1), the timestamp and five values:
+
+        balance/phases: total, house and charger amps, amps left and the limit
+        plan: kwh, hours, cost, parts and the kwh that could not be planned
+
+    Recording is a single struct.pack_into so it can be done on every sample.
+    """
+
+    RECORD = struct.Struct("<BBBxdfffff")
+    MAGIC = b"CBDT"
+    # magic, version, record size, length of the json meta
+    HEADER = struct.Struct("<4sHHI")
+    VERSION = 1
+
+    def __init__(self, size):
+        self.size = size
+        self.buffer = bytearray(self.RECORD.size * size)
+        self._seq = count()
+        self.recorded = 0
+
+    def record(self, kind, flags, source, ts, a, b, c, d, e):
+        # next() on a count is atomic, so the balancer and the planner can
+        # record from their own threads.
+        i = next(self._seq)
+        self.RECORD.pack_into(
+            self.buffer,
+            (i % self.size) * self.RECORD.size,
+            kind,
+            flags,
+            source,
+            ts,
+            a,
+            b,
+            c,
+            d,
+            e,
+        )
+        self.recorded = i + 1
+
+    def dump(self, meta):
+        """The records oldest first with a header and the json meta."""
+        recorded = self.recorded
+        data = bytes(self.buffer)
+        if recorded <= self.size:
+            records = data[: recorded * self.RECORD.size]
+        else:
+            split = (recorded % self.size) * self.RECORD.size
+            records = data[split:] + data[:split]
+        meta = dict(meta, recorded=recorded, size=self.size)
+        meta = json.dumps(meta, separators=(",", ":")).encode()
+        return (
+            self.HEADER.pack(self.MAGIC, self.VERSION, self.RECORD.size, len(meta))
+            + meta
+            + records
+        )
+
+
+def read_decision_trace(data):
+    """Decode a DecisionTrace dump, returns the meta and a list of the records."""
+    magic, version, size, meta_size = DecisionTrace.HEADER.unpack_from(data)
+    if magic != DecisionTrace.MAGIC or size != DecisionTrace.RECORD.size:
+        raise ValueError("Not a decision trace dump")
+    start = DecisionTrace.HEADER.size
+    meta = json.loads(data[start : start + meta_size])
+    records = list(DecisionTrace.RECORD.iter_unpack(data[start + meta_size :]))
+    return meta, records
@@ -0,0 +1,103 @@
+"""
+Decode a decision trace dump to csv.
+
+The dump is written by the chargebot/dump_decision_trace service, it has the
+last load balancer decisions and chargeplans the app made. Balancer rows has
+the amps columns filled in, plan rows the kwh, hours, cost, parts and
+unmet_kwh columns.
+
+Usage:
+    python decode_trace.py chargebot_decisions.bin > decisions.csv
+    python decode_trace.py chargebot_decisions.bin -o decisions.csv --tz Europe/Oslo
+"""
+import argparse
+import csv
+import sys
+from datetime import datetime, timezone
+
+from chargebot_core import (
+    TRACE_CHANGED,
+    TRACE_KINDS,
+    TRACE_PAUSED,
+    TRACE_PLAN,
+    read_decision_trace,
+)
+
+COLUMNS = [
+    "time",
+    "kind",
+    "source",
+    "total_amps",
+    "house_amps",
+    "charger_amps",
+    "amps_left",
+    "limit",
+    "paused",
+    "changed",
+    "kwh",
+    "hours",
+    "cost",
+    "parts",
+    "unmet_kwh",
+]
+
+
+def rows(meta, records, tz=timezone.utc):
+    """The records as dicts with the COLUMNS as keys."""
+    sources = meta.get("sources", [])
+    for kind, flags, source, ts, *values in records:
+        # The values is stored as float32, don't show the noise.
+        a, b, c, d, e = (round(value, 3) for value in values)
+        row = {
+            "time": datetime.fromtimestamp(ts, tz).isoformat(),
+            "kind": TRACE_KINDS.get(kind, kind),
+            "source": sources[source] if source < len(sources) else source,
+        }
+        if kind == TRACE_PLAN:
+            row.update(kwh=a, hours=b, cost=c, parts=int(d), unmet_kwh=e)
+        else:
+            row.update(
+                total_amps=a,
+                house_amps=b,
+                charger_amps=c,
+                amps_left=d,
+                limit=e,
+                paused=int(bool(flags & TRACE_PAUSED)),
+                changed=int(bool(flags & TRACE_CHANGED)),
+            )
+        yield row
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Decode a chargebot decision trace to csv.")
+    parser.add_argument("dump", help="file written by chargebot/dump_decision_trace")
+    parser.add_argument("-o", "--output", help="csv file, default stdout")
+    parser.add_argument("--tz", help="timezone for the time column, default utc")
+    options = parser.parse_args(argv)
+
+    tz = timezone.utc
+    if options.tz:
+        from zoneinfo import ZoneInfo
+
+        tz = ZoneInfo(options.tz)
+
+    with open(options.dump, "rb") as f:
+        meta, records = read_decision_trace(f.read())
+
+    out = open(options.output, "w", newline="") if options.output else sys.stdout
+    try:
+        writer = csv.DictWriter(out, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows(meta, records, tz))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(
+        "%s of %s recorded decisions from %s"
+        % (len(records), meta.get("recorded"), meta.get("app")),
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
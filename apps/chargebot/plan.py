@@ -0,0 +1,182 @@
+"""
+Create chargeplans in bulk without home assistant.
+
+Every price file is planned for every vehicle using the same planner as the
+app (chargebot_core.ChargePlanner). A price file is the attributes of a
+nordpool sensor as json (raw_today, raw_tomorrow and currency), or a full
+state with the attributes in it. The vehicles file is a json or yaml list,
+the keys are the same as in the app config:
+
+    - name: tesla
+      soc: 35
+      ready_at: "07:00"   # time of day or a iso datetime, default the last price
+      car_battery_size_kwh: 72.5
+      car_onboard_charger_kwh: 11.0
+      car_target_soc: 80
+      charge_mode: on_off
+      charge_session_penalty: 0.5
+      charge_curve: [[0, 1.0], [80, 1.0], [100, 0.3]]
+
+The plans are written as jsonl (one line for each price file and vehicle) or
+as csv with one row for each slot.
+
+Usage:
+    python plan.py prices/*.json --vehicles vehicles.yaml
+    python plan.py prices.json --vehicles vehicles.json --now 2024-01-08T15:00:00+01:00 --csv
+"""
+import argparse
+import csv
+import json
+import math
+import sys
+from datetime import datetime, time, timedelta
+
+from chargebot_core import ChargeCurve, ChargePlanner, PriceSeries
+
+
+def load_prices(filename):
+    with open(filename) as f:
+        data = json.load(f)
+    if "attributes" in data:
+        data = data["attributes"]
+    return PriceSeries.from_nordpool(data)
+
+
+def load_vehicles(filename):
+    with open(filename) as f:
+        if filename.endswith(".json"):
+            vehicles = json.load(f)
+        else:
+            import yaml
+
+            vehicles = yaml.safe_load(f)
+    if isinstance(vehicles, dict):
+        vehicles = [dict(value, name=key) for key, value in vehicles.items()]
+    return vehicles
+
+
+def create_planner(vehicle):
+    """A ChargePlanner from the vehicle options, like EaseeChargebot.charge_planner."""
+    curve = None
+    if vehicle.get("charge_curve"):
+        curve = ChargeCurve(
+            vehicle["charge_curve"],
+            float(vehicle.get("charge_efficiency", 0.92)),
+            float(vehicle.get("charge_overhead_kw", 0.25)),
+        )
+    max_sessions = vehicle.get("charge_max_sessions")
+    volt = float(vehicle.get("volt", 230.0))
+    phase = float(vehicle.get("phase", 3.0))
+    return ChargePlanner(
+        float(vehicle["car_battery_size_kwh"]),
+        max_kw=float(vehicle.get("car_onboard_charger_kwh", 11.0)),
+        target_soc=float(vehicle.get("car_target_soc", 100)),
+        session_penalty=float(vehicle.get("charge_session_penalty", 0)),
+        max_sessions=None if max_sessions is None else int(max_sessions),
+        min_session_minutes=float(vehicle.get("charge_min_session_minutes", 0)),
+        current_loss=float(vehicle.get("charge_current_loss", 0.005)),
+        max_amps=float(vehicle.get("max_circuit_current", 32.0)),
+        kw_per_amp=volt * math.sqrt(phase) / 1000,
+        curve=curve,
+    )
+
+
+def ready_at(value, now):
+    """The timestamp of ready_at, a time of day is the next time after now."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        pass
+    ready = datetime.combine(now.date(), time.fromisoformat(value), now.tzinfo)
+    if ready <= now:
+        ready += timedelta(days=1)
+    return ready.timestamp()
+
+
+def plan(series, vehicle, now=None):
+    """Plan one vehicle, returns a dict that can be dumped as json."""
+    if not len(series):
+        raise ValueError("No prices")
+    if now is None:
+        now = series.start(0)
+    if now.timestamp() >= series.ends[-1]:
+        raise ValueError(
+            "No prices after %s, the last price ends %s"
+            % (now.isoformat(), series.to_datetime(series.ends[-1], len(series) - 1).isoformat())
+        )
+    ready = vehicle.get("ready_at")
+    ready_ts = series.ends[-1] if ready is None else ready_at(ready, now)
+    result = create_planner(vehicle).plan(
+        series,
+        now.timestamp(),
+        ready_ts,
+        float(vehicle.get("soc", 0)),
+        mode=vehicle.get("charge_mode", "on_off"),
+    )
+    # now can be in the last slot, after it has started.
+    i = min(series.index(now.timestamp()), len(series) - 1)
+    return {
+        "vehicle": vehicle.get("name"),
+        "kwh": result["kwh"],
+        "hours": result["hours"],
+        "cost": result["cost"],
+        "currency": series.currency,
+        "slots": [
+            [
+                series.to_datetime(start, i).isoformat(),
+                series.to_datetime(end, i).isoformat(),
+                amps,
+            ]
+            for start, end, amps in result["slots"]
+        ],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create chargeplans from nordpool prices.")
+    parser.add_argument("prices", nargs="+", help="nordpool attributes as json")
+    parser.add_argument("--vehicles", required=True, help="json or yaml list of vehicles")
+    parser.add_argument("--now", help="iso datetime to plan from, default the first price")
+    parser.add_argument("--csv", action="store_true", help="one csv row for each slot")
+    parser.add_argument("-o", "--output", help="output file, default stdout")
+    options = parser.parse_args(argv)
+
+    now = datetime.fromisoformat(options.now) if options.now else None
+    vehicles = load_vehicles(options.vehicles)
+
+    out = open(options.output, "w", newline="") if options.output else sys.stdout
+    try:
+        if options.csv:
+            writer = csv.writer(out)
+            writer.writerow(["prices", "vehicle", "start", "end", "amps", "kwh", "cost"])
+        for filename in options.prices:
+            series = load_prices(filename)
+            for vehicle in vehicles:
+                try:
+                    result = plan(series, vehicle, now)
+                except ValueError as e:
+                    sys.exit("%s: %s" % (filename, e))
+                if not options.csv:
+                    out.write(json.dumps(dict(result, prices=filename)) + "\n")
+                    continue
+                for start, end, amps in result["slots"]:
+                    writer.writerow(
+                        [
+                            filename,
+                            result["vehicle"],
+                            start,
+                            end,
+                            amps,
+                            round(result["kwh"], 3),
+                            round(result["cost"], 3),
+                        ]
+                    )
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
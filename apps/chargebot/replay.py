@@ -0,0 +1,551 @@
+"""
+Offline replay of recorded traces through the chargebot.
+
+The trace is a jsonl file (see EaseeChargebot.export_trace) or a csv file with
+the columns ts, entity_id, state and optionally attributes (as json). Every
+line is a state change, ts is a iso or posix timestamp and the lines must be
+sorted by ts. The file is streamed so it can be as big as you like.
+
+The app runs with an injected clock, an in memory entity store and a service
+sink so nothing is sent to home assistant and timers fire as fast as the
+trace can be read. The charger is simulated, it uses the dynamic current the
+app sets (capped by the car) and the power usage the app sees is rebuilt as
+the recorded house usage + the simulated charger usage. Recorded charger
+status changes are applied as is, start/stop/pause commands from the app
+changes the simulated status in between.
+
+The app is initialized on the first power sample so the state of everything
+recorded before that is known to setup_config.
+
+Usage:
+    python replay.py trace.jsonl --config apps.yaml --app charge_bot
+"""
+import argparse
+import asyncio
+import atexit
+import csv
+import heapq
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from datetime import time as dt_time
+
+try:
+    import hassapi  # noqa: F401
+except ImportError:
+    # Not running inside appdaemon, add the same paths appdaemon adds for apps.
+    import appdaemon
+
+    _base = os.path.dirname(appdaemon.__file__)
+    sys.path.append(_base)
+    sys.path.append(os.path.join(_base, "plugins", "hass"))
+
+from chargebot import EaseeChargebot
+from chargebot_core import parse_timestamp
+
+
+def parse_ts(value):
+    """Parse a posix or iso timestamp."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        ts = parse_timestamp(value)
+        if ts is None:
+            raise ValueError("Invalid timestamp %s" % value)
+        return ts
+
+
+def read_trace(filename):
+    """Yield (ts, entity_id, state, attributes) from a jsonl or csv trace."""
+    with open(filename, newline="") as f:
+        if filename.endswith(".csv"):
+            for row in csv.DictReader(f):
+                attributes = row.get("attributes")
+                yield (
+                    parse_ts(row["ts"]),
+                    row["entity_id"],
+                    row["state"],
+                    json.loads(attributes) if attributes else {},
+                )
+        else:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                event = json.loads(line)
+                yield (
+                    parse_ts(event["ts"]),
+                    event["entity_id"],
+                    event.get("state"),
+                    event.get("attributes") or {},
+                )
+
+
+_loop = None
+
+
+def event_loop():
+    """One event loop for the async callbacks of all the apps, like appdaemon
+    has. Closed at exit so it isn't left to the garbage collector."""
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+        atexit.register(_loop.close)
+    return _loop
+
+
+class Scheduler:
+    """Timers ordered by when they should fire."""
+
+    def __init__(self):
+        self._heap = []
+        self._timers = {}
+        self._seq = itertools.count()
+
+    def add(self, ts, callback, kwargs, interval=None):
+        handle = next(self._seq)
+        self._timers[handle] = (callback, kwargs, interval)
+        heapq.heappush(self._heap, (ts, handle))
+        return handle
+
+    def cancel(self, handle):
+        self._timers.pop(handle, None)
+
+    def next_ts(self):
+        while self._heap and self._heap[0][1] not in self._timers:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop(self):
+        """Pop the next timer, periodic timers are added again."""
+        ts, handle = heapq.heappop(self._heap)
+        callback, kwargs, interval = self._timers[handle]
+        if interval:
+            heapq.heappush(self._heap, (ts + interval, handle))
+        else:
+            del self._timers[handle]
+        return callback, kwargs
+
+
+class ReplayChargebot(EaseeChargebot):
+    """EaseeChargebot with the appdaemon api replaced by a clock, a state store
+    and a service sink."""
+
+    # The app name from the appdaemon config.
+    name = "replay"
+
+    def __init__(self, args, tz=timezone.utc, verbose=False):
+        self.args = dict(args)
+        # Never touch the plan store of the real app.
+        self.args.setdefault("plan_store", False)
+        self.args.setdefault("discovery_cache", False)
+        self.lock = threading.RLock()
+        self.tz = tz
+        self.verbose = verbose
+        self.now = 0.0
+        self.states = {}
+        self.scheduler = Scheduler()
+        self.notifications = []
+        self.on_service = None
+        self._listeners = {}
+        self._listener_seq = itertools.count()
+
+    # Clock
+    def get_now_ts(self, aware=False):
+        return self.now
+
+    def datetime(self, aware=False):
+        now = datetime.fromtimestamp(self.now, self.tz)
+        return now if aware else now.replace(tzinfo=None)
+
+    def get_now(self, aware=True):
+        return self.datetime(aware=aware)
+
+    def parse_datetime(self, value, aware=False, **kwargs):
+        if value is None:
+            return None
+        try:
+            result = datetime.fromisoformat(value)
+        except ValueError:
+            result = datetime.combine(
+                self.datetime(aware=True).date(), dt_time.fromisoformat(value)
+            )
+        if result.tzinfo is None:
+            result = result.replace(tzinfo=self.tz)
+        return result if aware else result.replace(tzinfo=None)
+
+    def log(self, msg, *args, level="INFO", **kwargs):
+        if self.verbose or level in ("WARNING", "ERROR"):
+            print("%s %s %s" % (self.datetime(), level, msg % args if args else msg))
+
+    def notify(self, message, **kwargs):
+        self.notifications.append((self.now, message))
+        self.log(message, level="DEBUG")
+
+    # States
+    def get_state(self, entity_id=None, attribute=None, default=None, **kwargs):
+        if entity_id is None:
+            return dict(self.states)
+        if "." not in entity_id:
+            prefix = entity_id + "."
+            return {k: v for k, v in self.states.items() if k.startswith(prefix)}
+        state = self.states.get(entity_id)
+        if state is None:
+            return default
+        if attribute == "all":
+            return state
+        if attribute is not None:
+            return state["attributes"].get(attribute, default)
+        return state["state"]
+
+    def entity_exists(self, entity_id, **kwargs):
+        return entity_id in self.states
+
+    def set_state(self, entity_id, state=None, attributes=None, **kwargs):
+        old = self.states.get(entity_id)
+        if attributes is None:
+            attributes = old["attributes"] if old is not None else {}
+        if old is not None and old["state"] == state and old["attributes"] == attributes:
+            # Like ha, nothing is updated and appdaemon gets no state change.
+            return old
+        ts = datetime.fromtimestamp(self.now, timezone.utc).isoformat()
+        new = {
+            "entity_id": entity_id,
+            "state": state,
+            "attributes": attributes,
+            "last_changed": ts
+            if old is None or old["state"] != state
+            else old["last_changed"],
+            "last_updated": ts,
+        }
+        self.states[entity_id] = new
+
+        for callback, attribute, kwargs in list(
+            self._listeners.get(entity_id, {}).values()
+        ):
+            if attribute == "all":
+                callback(entity_id, attribute, old, new, kwargs)
+            elif attribute is not None:
+                old_value = old["attributes"].get(attribute) if old else None
+                new_value = attributes.get(attribute)
+                if old_value != new_value:
+                    callback(entity_id, attribute, old_value, new_value, kwargs)
+            else:
+                old_state = old["state"] if old else None
+                if old_state != state:
+                    callback(entity_id, attribute, old_state, state, kwargs)
+        return new
+
+    def listen_state(self, callback, entity_id=None, attribute=None, **kwargs):
+        handle = next(self._listener_seq)
+        self._listeners.setdefault(entity_id, {})[handle] = (
+            callback,
+            attribute,
+            kwargs,
+        )
+        return handle
+
+    def cancel_listen_state(self, handle):
+        for listeners in self._listeners.values():
+            listeners.pop(handle, None)
+
+    def get_history(self, **kwargs):
+        return []
+
+    # Timers
+    def run_in(self, callback, delay, **kwargs):
+        return self.scheduler.add(self.now + delay, callback, kwargs)
+
+    def run_at(self, callback, start, **kwargs):
+        if start == "now":
+            ts = self.now
+        else:
+            ts = start.timestamp()
+        return self.scheduler.add(ts, callback, kwargs)
+
+    def run_every(self, callback, start, interval, **kwargs):
+        ts = self.now if start == "now" else start.timestamp()
+        return self.scheduler.add(ts, callback, kwargs, interval=interval)
+
+    def cancel_timer(self, handle):
+        self.scheduler.cancel(handle)
+
+    def fire(self, callback, kwargs):
+        """Run a timer callback, async callbacks are run to the end."""
+        result = callback(kwargs)
+        if asyncio.iscoroutine(result):
+            result = event_loop().run_until_complete(result)
+        return result
+
+    # Services
+    def register_service(self, service, callback, **kwargs):
+        pass
+
+    def call_service(self, service, **kwargs):
+        if self.on_service is not None:
+            self.on_service(service, kwargs)
+        return True
+
+    def set_value(self, entity_id, value, **kwargs):
+        return self.call_service(
+            "input_number/set_value", entity_id=entity_id, value=value
+        )
+
+    def turn_off(self, entity_id, **kwargs):
+        self.set_state(entity_id, state="off")
+
+    def turn_on(self, entity_id, **kwargs):
+        self.set_state(entity_id, state="on")
+
+
+class Replay:
+    """Stream a trace through a ReplayChargebot and collect the results."""
+
+    def __init__(self, args, car_max_amps=None, tz=timezone.utc, verbose=False):
+        self.app = ReplayChargebot(args, tz=tz, verbose=verbose)
+        self.app.on_service = self.on_service
+        self.power_entity = args["power_usage_in_w"]
+        self.main_fuse = float(args["main_fuse"])
+        if car_max_amps is None:
+            car_max_amps = self.app.watt_to_amp(
+                float(args.get("car_onboard_charger_kwh", 11.0)) * 1000
+            )
+        self.car_max_amps = car_max_amps
+
+        self.initialized = False
+        self.last_ts = None
+        self.limit = 0.0
+        self.status = None
+        self.house_amps = 0.0
+        self.recorded_charger_amps = 0.0
+
+        # Results
+        self.events = 0
+        self.samples = 0
+        self.commands = Counter()
+        self.amp_hours = 0.0
+        self.fuse_violations = 0
+        self.fuse_violation_seconds = 0.0
+        self.max_total_amps = 0.0
+        self._overloaded = False
+        self._first_ts = None
+
+    @property
+    def charger_amps(self):
+        if self.status != "CHARGING" or self.limit < 6:
+            return 0.0
+        return min(self.limit, self.car_max_amps)
+
+    def _entity(self, suffix):
+        return "sensor.%s_%s" % (self.app.args.get("entity_start_name"), suffix)
+
+    def integrate(self, ts):
+        """Account for the time from the last update until ts."""
+        if self.last_ts is not None and ts > self.last_ts:
+            dt = ts - self.last_ts
+            charger_amps = self.charger_amps
+            self.amp_hours += charger_amps * dt / 3600
+            if self.house_amps + charger_amps > self.main_fuse:
+                self.fuse_violation_seconds += dt
+        self.last_ts = ts
+
+    def check_fuse(self):
+        total = self.house_amps + self.charger_amps
+        self.max_total_amps = max(self.max_total_amps, total)
+        overloaded = total > self.main_fuse
+        if overloaded and not self._overloaded:
+            self.fuse_violations += 1
+        self._overloaded = overloaded
+
+    def advance(self, ts):
+        """Fire every timer that is due up to ts."""
+        scheduler = self.app.scheduler
+        while True:
+            due = scheduler.next_ts()
+            if due is None or due > ts:
+                break
+            due = max(due, self.app.now)
+            self.integrate(due)
+            self.app.now = due
+            callback, kwargs = scheduler.pop()
+            self.app.fire(callback, kwargs)
+        self.integrate(ts)
+        self.app.now = max(self.app.now, ts)
+
+    def update_charger(self):
+        """Publish the simulated charger usage like a polling integration would."""
+        self.app.set_state(self._entity("in_current"), state=str(self.charger_amps))
+        self.check_fuse()
+
+    def on_service(self, service, data):
+        self.commands[service] += 1
+        if not self.initialized:
+            return
+
+        if service == "easee/set_circuit_dynamic_current":
+            self.limit = min(
+                float(data.get(phase, 0)) for phase in ("currentP1", "currentP2", "currentP3")
+            )
+            self.app.set_state(
+                self._entity("dynamic_circuit_current"), state=str(self.limit)
+            )
+        elif service in ("easee/start", "easee/resume"):
+            self.set_status("CHARGING")
+        elif service == "easee/pause":
+            self.set_status("PAUSED")
+        elif service == "easee/stop":
+            self.set_status("READY_TO_CHARGE")
+        else:
+            return
+        self.update_charger()
+
+    def set_status(self, status):
+        self.status = status
+        self.app.set_state(self.app.args["charger_status_entity"], state=status)
+
+    def apply(self, ts, entity, state, attributes):
+        self.events += 1
+        app = self.app
+        if self._first_ts is None:
+            self._first_ts = ts
+
+        if not self.initialized:
+            app.now = ts
+            if entity != self.power_entity:
+                app.set_state(entity, state=state, attributes=attributes)
+                if entity.endswith("_in_current"):
+                    self.recorded_charger_amps = float(state)
+                return
+
+            app.set_state(entity, state=state, attributes=attributes)
+            app.initialize()
+            self.initialized = True
+            self.status = app.get_state(app.args["charger_status_entity"])
+            try:
+                self.limit = float(app.get_state(self._entity("dynamic_circuit_current")))
+            except (TypeError, ValueError):
+                self.limit = 0.0
+
+        if entity == self.power_entity:
+            try:
+                total = app.watt_to_amp(state)
+            except (TypeError, ValueError):
+                return
+            self.samples += 1
+            self.house_amps = total - self.recorded_charger_amps
+            self.update_charger()
+            app.set_state(
+                entity, state=str(app.amp_to_watt(self.house_amps + self.charger_amps))
+            )
+        elif entity == self._entity("in_current"):
+            try:
+                self.recorded_charger_amps = float(state)
+            except (TypeError, ValueError):
+                pass
+        elif entity == self._entity("dynamic_circuit_current"):
+            # This is simulated.
+            pass
+        elif entity == app.args["charger_status_entity"]:
+            self.status = state
+            app.set_state(entity, state=state, attributes=attributes)
+            self.update_charger()
+        else:
+            app.set_state(entity, state=state, attributes=attributes)
+
+    def run(self, events):
+        started = time.perf_counter()
+        for ts, entity, state, attributes in events:
+            self.advance(ts)
+            self.apply(ts, entity, state, attributes)
+            # Commands queued by the callbacks is sent right away.
+            self.advance(ts)
+        return self.report(time.perf_counter() - started)
+
+    def report(self, wall_seconds=0.0):
+        duration = (self.last_ts or 0) - (self._first_ts or 0)
+        report = {
+            "events": self.events,
+            "samples": self.samples,
+            "duration_hours": duration / 3600,
+            "wall_seconds": wall_seconds,
+            "samples_per_second": self.samples / wall_seconds if wall_seconds else 0.0,
+            "fuse_violations": self.fuse_violations,
+            "fuse_violation_seconds": self.fuse_violation_seconds,
+            "max_total_amps": self.max_total_amps,
+            "commands": dict(self.commands),
+            "delivered_kwh": self.app.amp_to_watt(self.amp_hours) / 1000,
+            "notifications": len(self.app.notifications),
+        }
+        if self.initialized:
+            report["sampler"] = self.app.sampler.stats()
+            report["command_queue"] = self.app.command_queue.stats()
+        return report
+
+
+def load_args(filename, app_name=None):
+    """Load the app args from a appdaemon yaml (or json) config."""
+    with open(filename) as f:
+        if filename.endswith(".json"):
+            config = json.load(f)
+        else:
+            import yaml
+
+            config = yaml.safe_load(f)
+
+    if app_name is not None:
+        config = config[app_name]
+    elif "module" not in config:
+        # Use the first app that uses chargebot.
+        for value in config.values():
+            if isinstance(value, dict) and value.get("module") == "chargebot":
+                config = value
+                break
+    return config
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a recorded trace offline.")
+    parser.add_argument("trace", help="jsonl or csv trace")
+    parser.add_argument("--config", required=True, help="apps.yaml or json")
+    parser.add_argument("--app", help="name of the app in the config")
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="override a config value, can be used many times",
+    )
+    parser.add_argument("--car-max-amps", type=float)
+    parser.add_argument("--tz", help="time zone used for the clock, default UTC")
+    parser.add_argument("--verbose", action="store_true")
+    options = parser.parse_args(argv)
+
+    args = load_args(options.config, options.app)
+    for override in options.set:
+        key, _, value = override.partition("=")
+        try:
+            args[key] = json.loads(value)
+        except ValueError:
+            args[key] = value
+
+    tz = timezone.utc
+    if options.tz:
+        from zoneinfo import ZoneInfo
+
+        tz = ZoneInfo(options.tz)
+
+    replay = Replay(
+        args, car_max_amps=options.car_max_amps, tz=tz, verbose=options.verbose
+    )
+    report = replay.run(read_trace(options.trace))
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == "__main__":
+    main()
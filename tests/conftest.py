@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The app and the tools are plain modules in the apps directory, like
+# appdaemon loads them.
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "apps", "chargebot")
+)
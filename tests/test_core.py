@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta, timezone
+
+from chargebot_core import PriceSeries, pick_cheapest_slots
+
+START = datetime(2024, 1, 8, tzinfo=timezone(timedelta(hours=1)))
+
+
+def series(values, minutes=15):
+    slot = timedelta(minutes=minutes)
+    return PriceSeries(
+        [
+            {"start": START + i * slot, "end": START + (i + 1) * slot, "value": value}
+            for i, value in enumerate(values)
+        ]
+    )
+
+
+def test_partial_slot_is_put_next_to_picked_neighbour():
+    prices = series([3.0, 1.0, 2.0, 3.0])
+    segments = pick_cheapest_slots(prices, 0, 4, 20 / 60)
+    # The 5 minutes in slot 2 follows right after slot 1.
+    assert segments == [
+        (1, prices.starts[1], prices.ends[1]),
+        (2, prices.starts[2], prices.starts[2] + 300),
+    ]
+
+
+def test_partial_slot_without_neighbour_uses_whole_slot():
+    prices = series([1.0, 3.0, 2.0, 3.0])
+    segments = pick_cheapest_slots(prices, 0, 4, 17 / 60)
+    # 2 minutes on its own would be a extra start/stop for nothing.
+    assert segments == [
+        (0, prices.starts[0], prices.ends[0]),
+        (2, prices.starts[2], prices.ends[2]),
+    ]
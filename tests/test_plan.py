@@ -0,0 +1,41 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import plan
+
+START = datetime(2024, 1, 8, tzinfo=timezone(timedelta(hours=1)))
+
+
+@pytest.fixture
+def files(tmp_path):
+    fmt = "%Y-%m-%dT%H:%M:%S%z"
+    slots = [
+        {
+            "start": (START + timedelta(hours=i)).strftime(fmt),
+            "end": (START + timedelta(hours=i + 1)).strftime(fmt),
+            "value": 1.0 + i % 3,
+        }
+        for i in range(24)
+    ]
+    prices = tmp_path / "prices.json"
+    prices.write_text(json.dumps({"raw_today": slots, "raw_tomorrow": [], "currency": "NOK"}))
+    vehicles = tmp_path / "vehicles.json"
+    vehicles.write_text(json.dumps([{"name": "car", "soc": 50, "car_battery_size_kwh": 60}]))
+    return str(prices), str(vehicles)
+
+
+def test_plan(files, capsys):
+    prices, vehicles = files
+    plan.main([prices, "--vehicles", vehicles])
+    result = json.loads(capsys.readouterr().out)
+    assert result["vehicle"] == "car"
+    assert result["slots"]
+
+
+def test_now_after_last_price(files):
+    prices, vehicles = files
+    with pytest.raises(SystemExit) as e:
+        plan.main([prices, "--vehicles", vehicles, "--now", "2024-01-09T00:00:00+01:00"])
+    assert "No prices after 2024-01-09T00:00:00+01:00" in str(e.value.code)
@@ -0,0 +1,54 @@
+from replay import Replay
+
+ARGS = {
+    "load_balance": "input_boolean.test_load_balance",
+    "smart_charging": "input_boolean.test_smart_charging",
+    "power_usage_in_w": "sensor.test_power",
+    "charger_ready_at": "input_datetime.test_ready_at",
+    "car_battery_sensor_entity": "sensor.test_soc",
+    "car_battery_size_kwh": 72.5,
+    "main_fuse": 63.0,
+    "volt": 230.0,
+    "phase": 3.0,
+    "notify": False,
+    "verify_car_connected_and_home": False,
+    "state_max_age": 60,
+}
+
+
+def steady_charger_trace(seconds, house_amps=30.0):
+    """A charging car that draws the same 16A the whole time, only the house
+    usage changes. The charger current is recorded once, like ha does when
+    the value doesn't change."""
+    ts = 1704668400.0
+    yield ts, "sensor.easee_test_status", "CHARGING", {"id": "EHTEST", "circuit_id": 1}
+    yield ts, "sensor.easee_test_in_current", "16.0", {}
+    yield ts, "sensor.easee_test_dynamic_circuit_current", "32.0", {}
+    yield ts, "sensor.easee_test_max_circuit_current", "32.0", {}
+    yield ts, ARGS["load_balance"], "on", {}
+    yield ts, ARGS["smart_charging"], "off", {}
+    for i in range(0, seconds, 5):
+        # 1% noise so every sample is a state change.
+        amps = house_amps + 16.0 + (0.3 if i % 10 else -0.3)
+        yield ts + i + 1, ARGS["power_usage_in_w"], str(amps * 230.0 * 3 ** 0.5), {}
+
+
+def test_steady_charger_current_is_not_stale():
+    """A charger that keeps the same current for longer then state_max_age
+    is still counted as charger usage, not as house usage."""
+    replay = Replay(ARGS, car_max_amps=16.0)
+    limits = []
+    on_service = replay.on_service
+
+    def record(service, data):
+        on_service(service, data)
+        if service == "easee/set_circuit_dynamic_current":
+            limits.append(data["currentP1"])
+
+    replay.app.on_service = record
+    report = replay.run(steady_charger_trace(1800))
+
+    # 56.7A left on the fuse - 30A house, the car never has to be throttled.
+    assert limits and min(limits) >= 16
+    assert report["fuse_violations"] == 0
+    assert replay.app._charger_current_stale is False